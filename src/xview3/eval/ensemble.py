@@ -1,16 +1,26 @@
 import json
-import math
 import numpy as np
 import os.path
 import pandas as pd
 import skimage.io
 import sys
 
-from xview3.utils.grid_index import GridIndex
+from xview3.eval.prune import get_neighbor_pairs
 
-distance_thresh = 10
+def merge(preds, distance_thresh=10):
+    '''
+    Merge predictions from several ensemble members into one dataframe.
+    Each point's score becomes the average, over members, of the highest score
+    among that member's points within distance_thresh (0 if there are none),
+    using the point's own score for its own member.
 
-def merge(preds):
+    Args:
+        preds (list): dataframes of detections, one per member
+        distance_thresh: distance within which points from different members are considered the same detection
+
+    Returns:
+        concatenated dataframe with input_idx column and merged scores
+    '''
     for i, pred in enumerate(preds):
         if 'input_idx' in pred.columns:
             pred = pred.drop(columns=['input_idx'])
@@ -18,44 +28,32 @@ def merge(preds):
 
     pred = pd.concat(preds).reset_index()
 
-    new_scores = {}
+    new_scores = pred.score.to_numpy(dtype=np.float64).copy()
 
     for scene_id in pred.scene_id.unique():
         print(scene_id)
-        cur = pred[pred.scene_id == scene_id]
-
-        # Insert into grid index.
-        grid_index = GridIndex(distance_thresh)
-        for index, row in cur.iterrows():
-            grid_index.insert((row.detect_scene_row, row.detect_scene_column), index)
-
-        # Set score of each point to the average over highest-scoring neighbors from each input_idx.
-        for index, row in cur.iterrows():
-            rect = [
-                row.detect_scene_row - distance_thresh,
-                row.detect_scene_column - distance_thresh,
-                row.detect_scene_row + distance_thresh,
-                row.detect_scene_column + distance_thresh,
-            ]
-            best = [0.0]*len(preds)
-
-            for other_index in grid_index.search(rect):
-                other = pred.loc[other_index]
-
-                dx = other.detect_scene_column - row.detect_scene_column
-                dy = other.detect_scene_row - row.detect_scene_row
-                distance = math.sqrt(dx*dx+dy*dy)
-                if distance > distance_thresh:
-                    continue
-
-                best[other.input_idx] = max(best[other.input_idx], other.score)
-
-            best[row.input_idx] = row.score
-            new_scores[index] = np.mean(best)
+        indices = np.flatnonzero((pred.scene_id == scene_id).to_numpy())
+        cur = pred.iloc[indices]
+        points = np.stack([
+            cur.detect_scene_row.to_numpy(dtype=np.float64),
+            cur.detect_scene_column.to_numpy(dtype=np.float64),
+        ], axis=1)
+        scores = cur.score.to_numpy(dtype=np.float64)
+        input_idx = cur.input_idx.to_numpy(dtype=np.int64)
+
+        # best[i, k] is the highest score of a member k point within distance_thresh of point i.
+        # fmax ignores NaN scores like max() did.
+        best = np.zeros((len(cur), len(preds)), dtype=np.float64)
+        pairs = get_neighbor_pairs(points, distance_thresh)
+        src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        np.fmax.at(best, (src, input_idx[dst]), scores[dst])
+        best[np.arange(len(cur)), input_idx] = scores
+
+        new_scores[indices] = np.mean(best, axis=1)
 
     print('set scores')
-    for index, score in new_scores.items():
-        pred.loc[index, 'score'] = score
+    pred['score'] = new_scores
 
     pred = pred.drop(columns=['index'])
     return pred
@@ -1,9 +1,12 @@
+import collections
 import json
 
 import numpy as np
 import pandas as pd
 from scipy.optimize import linear_sum_assignment
-from scipy.spatial import KDTree, distance_matrix
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import KDTree, distance_matrix, minkowski_distance
 from tqdm import tqdm
 import sys
 
@@ -74,30 +77,165 @@ def match_low_confidence_preds(preds, gt, distance_tolerance=200, costly_dist=Fa
     """
 
     # Getting pixel-level predicted and ground-truth detections
-    pred_array = np.array(
-        list(zip(preds["detect_scene_row"], preds["detect_scene_column"]))
-    )
-    gt_array = np.array(list(zip(gt["detect_scene_row"], gt["detect_scene_column"])))
+    pred_array = get_point_array(preds)
+    gt_array = get_point_array(gt)
+
+    # Mask of LOW confidence labels in the ground truth dataframe
+    low_gt = (gt["confidence"] == "LOW").values
+
+    # Using Hungarian matching algorithm to assign lowest-cost gt-pred pairs
+    rows, cols = match_points(pred_array, gt_array, distance_tolerance=distance_tolerance, costly_dist=costly_dist)
+
+    low_inds = [
+        {"pred_idx": preds.index[row], "gt_idx": gt.index[col]}
+        for row, col in zip(rows, cols)
+        if low_gt[col]
+    ]
 
-    # Getting a list of index with LOW in the ground truth dataframe
-    low_gt_inds = list(gt[gt["confidence"] == "LOW"].index)
+    return low_inds
 
+def get_distance_matrix(pred_array, gt_array, distance_tolerance=200, costly_dist=False):
+    """
+    Distance matrix in meters between predicted and ground truth points, as used for matching.
+    """
     # Building distance matrix using Euclidean distance pixel space
     # multiplied by the UTM resolution (10 m per pixel)
     dist_mat = distance_matrix(pred_array, gt_array, p=2) * PIX_TO_M
     if costly_dist:
         dist_mat[dist_mat > distance_tolerance] = 9999999 * PIX_TO_M
+    return dist_mat
 
-    # Using Hungarian matching algorithm to assign lowest-cost gt-pred pairs
-    rows, cols = linear_sum_assignment(dist_mat)
 
-    low_inds = [
-        {"pred_idx": preds.index[rows[ii]], "gt_idx": gt.index[cols[ii]]}
-        for ii in range(len(rows))
-        if (dist_mat[rows[ii], cols[ii]] < distance_tolerance) and (gt.index[cols[ii]] in low_gt_inds)
-    ]
+def match_points(pred_array, gt_array, distance_tolerance=200, costly_dist=False):
+    """
+    Match predicted to ground truth points with the Hungarian algorithm, and
+    return the matched pairs that are closer than distance_tolerance.
+
+    With costly_dist, every pair farther than distance_tolerance has the same
+    large cost, so the assignment maximizes the number of pairs within
+    tolerance and then minimizes their total distance. That decomposes over
+    connected components of the graph of pairs within tolerance, so only
+    those pairs are found (with a KD-tree) and each component is solved on
+    its own small distance matrix. Without costly_dist, far pairs also affect
+    the assignment, so the full distance matrix is used.
+
+    Args:
+        pred_array (np.ndarray): (P, 2) predicted (row, column) points
+        gt_array (np.ndarray): (G, 2) ground truth (row, column) points
+        distance_tolerance (int, optional): Maximum distance
+            for valid detection. Defaults to 200.
+        costly_dist (bool): whether to assign 9999999 to entries in the distance metrics greater than distance_tolerance; defaults to False
+
+    Returns:
+        (pred_pos, gt_pos) int arrays of matched positions in pred_array and
+        gt_array, ordered by pred_pos
+    """
+    if not costly_dist:
+        dist_mat = get_distance_matrix(pred_array, gt_array, distance_tolerance, costly_dist)
+        rows, cols = linear_sum_assignment(dist_mat)
+        matched = dist_mat[rows, cols] < distance_tolerance
+        return rows[matched], cols[matched]
+
+    pairs = find_candidate_pairs(pred_array, gt_array, distance_tolerance)
+    return match_components(pred_array, gt_array, pairs, distance_tolerance)
+
+
+def find_candidate_pairs(pred_array, gt_array, distance_tolerance=200):
+    """
+    Find the (pred, gt) pairs within distance_tolerance, i.e. the entries that
+    get_distance_matrix does not set to the large cost with costly_dist.
+
+    Returns:
+        (pred_pos, gt_pos, dists) arrays, one entry per pair
+    """
+    if len(pred_array) == 0 or len(gt_array) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.float64)
+    # Query with a slightly larger radius, then apply the exact threshold.
+    pred_tree = KDTree(pred_array)
+    gt_tree = KDTree(gt_array)
+    coo = pred_tree.sparse_distance_matrix(gt_tree, distance_tolerance / PIX_TO_M * (1 + 1e-9), output_type="coo_matrix")
+    pred_pos, gt_pos = coo.row.astype(np.int64), coo.col.astype(np.int64)
+    dists = minkowski_distance(pred_array[pred_pos], gt_array[gt_pos], 2) * PIX_TO_M
+    near = dists <= distance_tolerance
+    return pred_pos[near], gt_pos[near], dists[near]
+
+
+def match_components(pred_array, gt_array, pairs, distance_tolerance=200):
+    """
+    Solve the costly_dist assignment separately for each connected component
+    of the candidate pairs from find_candidate_pairs.
+
+    Returns:
+        (pred_pos, gt_pos) like match_points
+    """
+    pred_pos, gt_pos, dists = pairs
+    num_pred, num_gt = len(pred_array), len(gt_array)
+    if len(pred_pos) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+
+    # Connected components of the bipartite graph, with gt nodes after pred nodes.
+    graph = coo_matrix(
+        (np.ones((len(pred_pos),), dtype=bool), (pred_pos, num_pred + gt_pos)),
+        shape=(num_pred + num_gt, num_pred + num_gt),
+    )
+    _, labels = connected_components(graph, directed=False)
+    pair_labels = labels[pred_pos]
+
+    matched_pred, matched_gt = [], []
+    order = np.argsort(pair_labels, kind="stable")
+    splits = np.flatnonzero(np.diff(pair_labels[order])) + 1
+    for component in np.split(order, splits):
+        comp_pred = np.unique(pred_pos[component])
+        comp_gt = np.unique(gt_pos[component])
+        if len(component) == 1:
+            dist_mat = dists[component]
+            rows, cols = np.zeros((1,), dtype=np.int64), np.zeros((1,), dtype=np.int64)
+        else:
+            dist_mat = get_distance_matrix(pred_array[comp_pred], gt_array[comp_gt], distance_tolerance, costly_dist=True)
+            rows, cols = linear_sum_assignment(dist_mat)
+            dist_mat = dist_mat[rows, cols]
+        matched = dist_mat < distance_tolerance
+        matched_pred.append(comp_pred[rows[matched]])
+        matched_gt.append(comp_gt[cols[matched]])
+
+    matched_pred = np.concatenate(matched_pred)
+    matched_gt = np.concatenate(matched_gt)
+    order = np.argsort(matched_pred)
+    return matched_pred[order], matched_gt[order]
+
+
+class SceneMatcher(object):
+    """
+    Matches subsets of a scene's predictions (e.g. those above a score
+    threshold) to its labels, finding candidate pairs only once for all subsets.
+    """
+
+    def __init__(self, preds, gt, distance_tolerance=200, costly_dist=False):
+        self.pred_array = get_point_array(preds)
+        self.gt_array = get_point_array(gt)
+        self.distance_tolerance = distance_tolerance
+        self.costly_dist = costly_dist
+        if costly_dist:
+            self.pairs = find_candidate_pairs(self.pred_array, self.gt_array, distance_tolerance)
+
+    def match(self, keep):
+        """
+        Same as match_points on the predictions selected by the boolean mask keep.
+        Returned pred positions are positions within the selected predictions.
+        """
+        pred_array = self.pred_array[keep]
+        if not self.costly_dist:
+            return match_points(pred_array, self.gt_array, self.distance_tolerance, self.costly_dist)
+        pred_pos, gt_pos, dists = self.pairs
+        selected = keep[pred_pos]
+        new_pos = np.cumsum(keep) - 1
+        pairs = (new_pos[pred_pos[selected]], gt_pos[selected], dists[selected])
+        return match_components(pred_array, self.gt_array, pairs, self.distance_tolerance)
+
+
+def get_point_array(df):
+    return np.array(list(zip(df["detect_scene_row"], df["detect_scene_column"])))
 
-    return low_inds
 
 def get_shore_preds(df, shoreline_root, scene_id, shore_tolerance_km):
     """
@@ -112,34 +250,115 @@ def get_shore_preds(df, shoreline_root, scene_id, shore_tolerance_km):
     Returns:
         df_close (pd.DataFrame): subset of df containing only detections close to shore
     """
+    close_shore = get_shore_mask(df, shoreline_root, scene_id, shore_tolerance_km)
+
+    # If there are no shorelines in the scene
+    if close_shore is None:
+        return pd.DataFrame()
+
+    df_close = df.iloc[np.where(close_shore)]
+    return df_close
+
+
+# Shoreline KD-trees by (shoreline_root, scene_id), least recently used first.
+SHORELINE_CACHE_SIZE = 64
+shoreline_trees = collections.OrderedDict()
+
+def get_shoreline_tree(shoreline_root, scene_id):
+    """
+    KD-tree over a scene's shoreline contour points, or None if there are no
+    shorelines in the scene. Trees are kept for the SHORELINE_CACHE_SIZE most
+    recently used scenes.
+    """
+    k = (shoreline_root, scene_id)
+    if k in shoreline_trees:
+        shoreline_trees.move_to_end(k)
+        return shoreline_trees[k]
+
     # Loading shoreline contours for distance-to-shore calculation
     shoreline_contours = np.load(
         f"{shoreline_root}/{scene_id}_shoreline.npy", allow_pickle=True
     )
+    if len(shoreline_contours) == 0:
+        tree = None
+    else:
+        tree = KDTree(np.vstack(shoreline_contours))
+
+    shoreline_trees[k] = tree
+    while len(shoreline_trees) > SHORELINE_CACHE_SIZE:
+        shoreline_trees.popitem(last=False)
+    return tree
+
+
+def get_shore_mask(df, shoreline_root, scene_id, shore_tolerance_km):
+    """
+    Boolean mask of the detections in df that are close to the shoreline,
+    or None if there are no shorelines in the scene. See get_shore_preds.
+    """
+    tree = get_shoreline_tree(shoreline_root, scene_id)
 
     # If there are no shorelines in the scene
-    if len(shoreline_contours) == 0:
-        return pd.DataFrame()
+    if tree is None:
+        return None
 
-    contour_points = np.vstack(shoreline_contours)
+    points = np.array([df["detect_scene_row"], df["detect_scene_column"]], dtype=np.float64).transpose()
+    max_dist = shore_tolerance_km * 1000 / PIX_TO_M
 
-    # Creating KD trees and computing distance matrix
-    tree1 = KDTree(np.array(contour_points))
-    tree2 = KDTree(
-        np.array([df["detect_scene_row"], df["detect_scene_column"]]).transpose()
-    )
-    sdm = tree1.sparse_distance_matrix(tree2, shore_tolerance_km * 1000 / PIX_TO_M, p=2)
-    dists = sdm.toarray()
-
-    # Make it so we can use np.min() to find smallest distance b/t each detection and any contour point
-    dists[dists == 0] = 9999999
-    min_shore_dists = np.min(dists, axis=0)
-    close_shore_inds = np.where(min_shore_dists != 9999999)
-    df_close = df.iloc[close_shore_inds]
-    return df_close
+    # Nearest contour point within max_dist (inf if none).
+    # Query with a slightly larger bound since the bound is exclusive.
+    dists, _ = tree.query(points, distance_upper_bound=max_dist * (1 + 1e-9))
+    close_shore = dists <= max_dist
+
+    # Contour points at distance zero are not counted, so a detection on a
+    # contour point is only close if some other contour point is within max_dist.
+    for i in np.flatnonzero(dists == 0):
+        neighbors = tree.data[tree.query_ball_point(points[i], max_dist)]
+        close_shore[i] = (neighbors != points[i]).any()
+    return close_shore
 
 
-def compute_loc_performance(preds, gt, distance_tolerance=200, costly_dist=False):
+class ScoreCache(object):
+    """
+    Per-scene matching and shoreline state for one prediction dataframe,
+    so that score() can be run on many subsets of it (e.g. for a sweep over
+    score thresholds) without redoing the work that does not depend on the subset.
+    """
+
+    def __init__(self, pred, shore_root=None, distance_tolerance=200, shore_tolerance=2, costly_dist=False):
+        self.pred = pred
+        self.shore_root = shore_root
+        self.distance_tolerance = distance_tolerance
+        self.shore_tolerance_km = shore_tolerance + distance_tolerance / 1000
+        self.costly_dist = costly_dist
+        self.scene_rows = {}
+        self.shore_masks = {}
+        self.matchers = {}
+
+    # Positions in pred of the scene's predictions.
+    def get_scene_rows(self, scene_id):
+        if scene_id not in self.scene_rows:
+            self.scene_rows[scene_id] = np.flatnonzero((self.pred["scene_id"] == scene_id).values)
+        return self.scene_rows[scene_id]
+
+    # Mask over the scene's predictions of those close to shore, or None if the scene has no shorelines.
+    def get_shore_mask(self, scene_id):
+        if scene_id not in self.shore_masks:
+            pred_sc = self.pred.iloc[self.get_scene_rows(scene_id)]
+            self.shore_masks[scene_id] = get_shore_mask(pred_sc, self.shore_root, scene_id, self.shore_tolerance_km)
+        return self.shore_masks[scene_id]
+
+    # SceneMatcher between the scene's predictions (or only those close to shore) and gt_sc.
+    def get_matcher(self, scene_id, gt_sc, shore=False):
+        k = (scene_id, shore)
+        if k not in self.matchers:
+            pred_sc = self.pred.iloc[self.get_scene_rows(scene_id)]
+            if shore:
+                pred_sc = pred_sc[self.get_shore_mask(scene_id)]
+            self.matchers[k] = SceneMatcher(pred_sc, gt_sc, self.distance_tolerance, self.costly_dist)
+        return self.matchers[k]
+
+
+def compute_loc_performance(preds, gt, distance_tolerance=200, costly_dist=False, matcher=None, keep=None):
     """
     Computes maritime object detection performance from a prediction
     dataframe and a ground truth datafr
@@ -152,6 +371,8 @@ def compute_loc_performance(preds, gt, distance_tolerance=200, costly_dist=False
         distance_tolerance (int, optional): Maximum distance
             for valid detection. Defaults to 200.
         costly_dist (bool): whether to assign 9999999 to entries in the distance metrics greater than distance_tolerance; defaults to False
+        matcher (SceneMatcher, optional): matcher for a superset of preds, used instead of matching from scratch
+        keep (np.ndarray, optional): boolean mask selecting preds from the matcher's predictions
 
     Returns:
         tp_ind (list, dict): list of dicts with keys 'pred_idx', 'gt_idx';
@@ -167,32 +388,24 @@ def compute_loc_performance(preds, gt, distance_tolerance=200, costly_dist=False
     if len(preds) == 0:
         return [], [], [a for a in gt.index]
 
-    # Getting pixel-level predicted and ground-truth detections
-    pred_array = np.array(
-        list(zip(preds["detect_scene_row"], preds["detect_scene_column"]))
-    )
-    gt_array = np.array(list(zip(gt["detect_scene_row"], gt["detect_scene_column"])))
-
-    # Building distance matrix using Euclidean distance pixel space
-    # multiplied by the UTM resolution (10 m per pixel)
-    dist_mat = distance_matrix(pred_array, gt_array, p=2) * PIX_TO_M
-    if costly_dist:
-        dist_mat[dist_mat > distance_tolerance] = 9999999 * PIX_TO_M
-
     # Using Hungarian matching algorithm to assign lowest-cost gt-pred pairs
-    rows, cols = linear_sum_assignment(dist_mat)
+    if matcher is not None:
+        rows, cols = matcher.match(keep)
+    else:
+        rows, cols = match_points(get_point_array(preds), get_point_array(gt), distance_tolerance=distance_tolerance, costly_dist=costly_dist)
 
     # Recording indices for tp, fp, fn
     tp_inds = [
-        {"pred_idx": preds.index[rows[ii]], "gt_idx": gt.index[cols[ii]]}
-        for ii in range(len(rows))
-        if dist_mat[rows[ii], cols[ii]] < distance_tolerance
+        {"pred_idx": preds.index[row], "gt_idx": gt.index[col]}
+        for row, col in zip(rows, cols)
     ]
-    tp_pred_inds = [a["pred_idx"] for a in tp_inds]
-    tp_gt_inds = [a["gt_idx"] for a in tp_inds]
 
-    fp_inds = [a for a in preds.index if a not in tp_pred_inds]
-    fn_inds = [a for a in gt.index if a not in tp_gt_inds]
+    matched_pred = np.zeros((len(preds),), dtype=bool)
+    matched_pred[rows] = True
+    matched_gt = np.zeros((len(gt),), dtype=bool)
+    matched_gt[cols] = True
+    fp_inds = preds.index[~matched_pred].tolist()
+    fn_inds = gt.index[~matched_gt].tolist()
 
     # Making sure each GT is associated with one true positive
     # or is in the false negative bin
@@ -397,7 +610,7 @@ def aggregate_f(
     return aggregate
 
 
-def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet=False, weights_fname=None, costly_dist=False):
+def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet=False, weights_fname=None, costly_dist=False, cache=None, keep=None, with_meta=True):
     """Compute xView3 aggregate score from
 
     Args:
@@ -408,6 +621,10 @@ def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet
             for valid detection. Defaults to 200.
         shore_tolerance (float): "close to shore" tolerance in km; defaults to 2
         costly_dist (bool): whether to assign 9999999 to entries in the distance metrics greater than distance_tolerance; defaults to False
+        cache (ScoreCache, optional): cache created with the same settings for a prediction
+            dataframe that pred is a subset of; pred must be cache.pred[keep].reset_index(drop=True)
+        keep (np.ndarray, optional): boolean mask over cache.pred selecting pred
+        with_meta (bool): build the visualization metadata; if False, meta is None
 
     Returns:
         scores (dict): dictionary containing aggregate xView score and
@@ -429,8 +646,13 @@ def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet
     for scene_id in gt["scene_id"].unique():
         pred_sc = pred[pred["scene_id"] == scene_id]
         gt_sc = gt[gt["scene_id"] == scene_id]
+        if cache is not None:
+            keep_sc = keep[cache.get_scene_rows(scene_id)]
+            matcher = cache.get_matcher(scene_id, gt_sc)
+        else:
+            keep_sc, matcher = None, None
         tp_inds_sc, fp_inds_sc, fn_inds_sc, = compute_loc_performance(
-            pred_sc, gt_sc, distance_tolerance=distance_tolerance, costly_dist=costly_dist
+            pred_sc, gt_sc, distance_tolerance=distance_tolerance, costly_dist=costly_dist, matcher=matcher, keep=keep_sc
         )
 
         tp_inds += tp_inds_sc
@@ -458,12 +680,21 @@ def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet
                 (gt["scene_id"] == scene_id)
                 & (gt["distance_from_shore_km"] <= shore_tolerance)
             ]
-            pred_sc_shore = get_shore_preds(
-                pred_sc,
-                shore_root,
-                scene_id,
-                shore_tolerance + distance_tolerance / 1000,
-            )
+            if cache is not None:
+                keep_sc = keep[cache.get_scene_rows(scene_id)]
+                shore_mask = cache.get_shore_mask(scene_id)
+                if shore_mask is None:
+                    pred_sc_shore = pd.DataFrame()
+                else:
+                    pred_sc_shore = pred_sc[shore_mask[keep_sc]]
+                    keep_sc = keep_sc[shore_mask]
+            else:
+                pred_sc_shore = get_shore_preds(
+                    pred_sc,
+                    shore_root,
+                    scene_id,
+                    shore_tolerance + distance_tolerance / 1000,
+                )
             if not quiet:
                 print(
                     f"{len(gt_sc_shore)} ground truth, {len(pred_sc_shore)} predictions close to shore"
@@ -476,7 +707,12 @@ def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet
                     fp_inds_sc_shore,
                     fn_inds_sc_shore,
                 ) = compute_loc_performance(
-                    pred_sc_shore, gt_sc_shore, distance_tolerance=distance_tolerance, costly_dist=costly_dist
+                    pred_sc_shore,
+                    gt_sc_shore,
+                    distance_tolerance=distance_tolerance,
+                    costly_dist=costly_dist,
+                    matcher=cache.get_matcher(scene_id, gt_sc_shore, shore=True) if cache is not None else None,
+                    keep=keep_sc if cache is not None else None,
                 )
                 tp_inds_shore += tp_inds_sc_shore
                 fp_inds_shore += fp_inds_sc_shore
@@ -551,6 +787,9 @@ def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet
         "loc_recall_shore": loc_recall_shore,
     }
 
+    if not with_meta:
+        return scores, None
+
     # Metadata that's useful for creating visualizations of detection performance.
     get_pos = lambda a: [
         a['scene_id'],
@@ -570,6 +809,57 @@ def score(pred, gt, shore_root, distance_tolerance=200, shore_tolerance=2, quiet
     return scores, meta
 
 
+def get_threshold_mask(pred, threshold):
+    """
+    Boolean mask of predictions with score >= threshold; all predictions if threshold <= 0.
+    """
+    if threshold > 0:
+        return (pred["score"] >= threshold).values
+    return np.ones((len(pred),), dtype=bool)
+
+
+def score_thresholds(pred, gt, shore_root, thresholds, distance_tolerance=200, shore_tolerance=2, quiet=True, weights_fname=None, costly_dist=False):
+    """
+    Score predictions at several score thresholds in one pass. The result at
+    each threshold is the same as calling score() on
+    pred[pred["score"] >= threshold].reset_index(drop=True) (or on all of pred
+    if threshold <= 0), but candidate matches and distances to shore are
+    computed once and reused.
+
+    Args:
+        pred ([pd.Dataframe)): contains inference results for all scenes
+        thresholds (list): score thresholds
+        others: see score
+
+    Returns:
+        table (pd.DataFrame): one row per threshold, with a threshold column and the
+            score() fields (loc_fscore, loc_fscore_shore, vessel_fscore, fishing_fscore, length_acc, ...)
+        cache (ScoreCache): cache for scoring other subsets of pred with score()
+    """
+    cache = ScoreCache(pred, shore_root=shore_root, distance_tolerance=distance_tolerance, shore_tolerance=shore_tolerance, costly_dist=costly_dist)
+    rows = []
+    for threshold in thresholds:
+        keep = get_threshold_mask(pred, threshold)
+        cur_pred = pred[keep].reset_index(drop=True)
+        scores, _ = score(
+            cur_pred,
+            gt,
+            shore_root,
+            distance_tolerance=distance_tolerance,
+            shore_tolerance=shore_tolerance,
+            quiet=quiet,
+            weights_fname=weights_fname,
+            costly_dist=costly_dist,
+            cache=cache,
+            keep=keep,
+            with_meta=False,
+        )
+        if not quiet:
+            print(threshold, scores)
+        rows.append(dict(threshold=threshold, **scores))
+    return pd.DataFrame(rows), cache
+
+
 def main(args):
     print(f"--score_all: {args.score_all}")
     print(f"--costly_dist: {args.costly_dist}")
@@ -629,26 +919,36 @@ def main(args):
     else:
         thresholds = [args.threshold]
 
+    # Skip thresholds that leave no predictions.
+    thresholds = [threshold for threshold in thresholds if get_threshold_mask(inference, threshold).any()]
+
+    table, cache = score_thresholds(
+        inference,
+        ground_truth,
+        args.shore_root,
+        thresholds,
+        distance_tolerance=args.distance_tolerance,
+        shore_tolerance=args.shore_tolerance,
+        quiet=False,
+        weights_fname=args.weights,
+        costly_dist=args.costly_dist,
+    )
     best = None
-    for threshold in thresholds:
-        if threshold > 0:
-            cur_pred = inference[inference["score"] >= threshold].reset_index(drop=True)
-        else:
-            cur_pred = inference
-        if len(cur_pred) == 0:
-            continue
-        out, meta = score(
-            cur_pred,
+    if len(table) > 0:
+        # Re-score the threshold with the best loc_fscore to get its metadata.
+        keep = get_threshold_mask(inference, table["threshold"][table["loc_fscore"].idxmax()])
+        best = score(
+            inference[keep].reset_index(drop=True),
             ground_truth,
             args.shore_root,
             args.distance_tolerance,
             args.shore_tolerance,
+            quiet=True,
             weights_fname=args.weights,
             costly_dist=args.costly_dist,
+            cache=cache,
+            keep=keep,
         )
-        print(threshold, out)
-        if best is None or out['loc_fscore'] > best[0]['loc_fscore']:
-            best = (out, meta)
 
     print('best', best[0])
     if args.output:
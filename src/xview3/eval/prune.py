@@ -1,16 +1,120 @@
-import json
 import math
 import numpy as np
 import os.path
 import pandas as pd
-import skimage.io
+import rasterio
+from rasterio.windows import Window
+import scipy.ndimage
+from scipy.spatial import cKDTree
 
+from xview3.processing.chip_store import gather_chip_pixels, load_chip
+from xview3.utils.chip_index import load_chip_index
 from xview3.utils.grid_index import GridIndex
 
+def get_neighbor_pairs(points, distance_thresh):
+    '''
+    Find all pairs of points within distance_thresh of each other.
+
+    Args:
+        points (np.ndarray): (N, 2) array of points
+        distance_thresh: maximum distance, inclusive
+
+    Returns:
+        (N, 2) array of index pairs (i, j) with i < j
+    '''
+    tree = cKDTree(points)
+    # Query with a slightly larger radius, then apply the exact threshold so
+    # boundary cases match math.sqrt(dx*dx+dy*dy) <= distance_thresh.
+    pairs = tree.query_pairs(distance_thresh*(1+1e-9), output_type='ndarray')
+    d = points[pairs[:, 1]] - points[pairs[:, 0]]
+    return pairs[np.sqrt(d[:, 0]*d[:, 0] + d[:, 1]*d[:, 1]) <= distance_thresh]
+
+def nms_points(points, scores, tiebreak, distance_thresh=10):
+    '''
+    Vectorized core of nms for the points of one scene.
+
+    Points are visited in array order. A point is eliminated if it is within
+    distance_thresh of a point with a higher score (or equal score and higher
+    tiebreak) that has not already been eliminated by that time, unless its
+    score is 1.
+
+    Args:
+        points (np.ndarray): (N, 2) array of points
+        scores (np.ndarray): N scores
+        tiebreak (np.ndarray): N keys deciding which of two equal-score points wins
+        distance_thresh: NMS distance threshold
+
+    Returns:
+        boolean array, True for eliminated points
+    '''
+    n = len(points)
+    elim = np.zeros((n,), dtype=bool)
+    if n < 2:
+        return elim
+
+    pairs = get_neighbor_pairs(points, distance_thresh)
+    # Directed edges from each point to the neighbors that would suppress it.
+    src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    suppress = (scores[dst] > scores[src]) | ((scores[dst] == scores[src]) & (tiebreak[dst] > tiebreak[src]))
+    suppress &= scores[src] != 1
+    src = src[suppress]
+    dst = dst[suppress]
+
+    # A suppressor visited later has not been eliminated yet when src is visited.
+    later = dst > src
+    elim[src[later]] = True
+
+    # The rest only have suppressors visited earlier, so whether they are
+    # eliminated depends on those suppressors, in visiting order.
+    pending = ~elim[src]
+    src = src[pending]
+    dst = dst[pending]
+    order = np.argsort(src, kind='stable')
+    src = src[order]
+    dst = dst[order]
+    starts = np.flatnonzero(np.concatenate([[True], src[1:] != src[:-1]])) if len(src) > 0 else np.zeros((0,), dtype=np.int64)
+    ends = np.append(starts[1:], len(src))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if not elim[dst[start:end]].all():
+            elim[src[start]] = True
+
+    return elim
+
 def nms(pred, distance_thresh=10):
     '''
     Prune detections that are redundant due to a nearby higher-scoring detection.
 
+    Args:
+        pred (pd.DataFrame): dataframe containing detections, from inference.py
+        distance_threshold (int): if points are within this threshold, only keep higher score point
+    '''
+    elim_inds = []
+
+    for scene_id in pred.scene_id.unique():
+        cur = pred[pred.scene_id == scene_id]
+        points = np.stack([
+            cur.detect_scene_row.to_numpy(dtype=np.float64),
+            cur.detect_scene_column.to_numpy(dtype=np.float64),
+        ], axis=1)
+        elim = nms_points(
+            points,
+            cur.score.to_numpy(dtype=np.float64),
+            cur.index.to_numpy(),
+            distance_thresh=distance_thresh,
+        )
+        elim_inds.extend(cur.index[elim].tolist())
+
+    print('nms: drop {} of {}'.format(len(elim_inds), len(pred)))
+
+    return pred.drop(elim_inds)
+
+def nms_loop(pred, distance_thresh=10):
+    '''
+    Original per-row implementation of nms, kept for benchmarking.
+
+    Prune detections that are redundant due to a nearby higher-scoring detection.
+
     Args:
         pred (pd.DataFrame): dataframe containing detections, from inference.py
         distance_threshold (int): if points are within this threshold, only keep higher score point
@@ -64,27 +168,72 @@ def clip(x, lo, hi):
         return hi
     return x
 
-def bathymetry_pruning(pred, image_path, threshold=0, padding=0, opposite=False, use_max=False):
-    # Create table index so we can refer to rows by unique index.
-    pred.reset_index()
+def sample_raster_windows(path, rows, cols, padding=0, use_max=False):
+    '''
+    For each point, get the min (or max) of a raster over the (2*padding+1)-pixel
+    square window around it. Windows are shifted to stay inside the raster.
+    Only the part of the raster covering the points is read.
 
-    bathymetries = {} # scene_id to bathymetry
-    elim_inds = []
-    for index, row in pred.iterrows():
-        scene_id = row['scene_id']
-        if scene_id not in bathymetries:
-            bathymetries[scene_id] = skimage.io.imread(os.path.join(image_path, scene_id, 'bathymetry.tif'))
+    Args:
+        path (str): path to a single-band raster
+        rows, cols (np.ndarray): pixel coordinates of the points in the raster
+        padding (int): window half-size
+        use_max (bool): take the max instead of the min
 
-        r = clip(row.detect_scene_row//50, padding, bathymetries[scene_id].shape[0]-padding-1)
-        c = clip(row.detect_scene_column//50, padding, bathymetries[scene_id].shape[1]-padding-1)
+    Returns:
+        np.ndarray of values, one per point
+    '''
+    size = 2*padding+1
+    with rasterio.open(path) as src:
+        height, width = src.height, src.width
+
+        if height < size or width < size:
+            # Windows cannot fit inside the raster, so just do it per point.
+            im = src.read(1)
+            values = []
+            for row, col in zip(rows, cols):
+                r = clip(row, padding, height-padding-1)
+                c = clip(col, padding, width-padding-1)
+                window = im[r-padding:r+padding+1, c-padding:c+padding+1]
+                values.append(window.max() if use_max else window.min())
+            return np.array(values)
+
+        r = np.clip(rows, padding, height-padding-1)
+        c = np.clip(cols, padding, width-padding-1)
+        r0, r1 = r.min()-padding, r.max()+padding+1
+        c0, c1 = c.min()-padding, c.max()+padding+1
+        im = src.read(1, window=Window(c0, r0, c1-c0, r1-r0))
+
+    # Every window is inside the part that was read, so the filter's border mode does not matter.
+    if use_max:
+        im = scipy.ndimage.maximum_filter(im, size=size)
+    else:
+        im = scipy.ndimage.minimum_filter(im, size=size)
+    return im[r-r0, c-c0]
+
+def get_scene_raster_values(pred, image_path, fname, padding=0, use_max=False):
+    '''
+    Sample a 50x-downsampled scene raster (like bathymetry.tif) around every
+    detection, see sample_raster_windows.
 
-        if use_max:
-            bathymetry = bathymetries[scene_id][r-padding:r+padding+1, c-padding:c+padding+1].max()
-        else:
-            bathymetry = bathymetries[scene_id][r-padding:r+padding+1, c-padding:c+padding+1].min()
+    Returns:
+        np.ndarray of values, aligned with the rows of pred
+    '''
+    values = np.zeros((len(pred),), dtype=np.float64)
+    for scene_id, indices in pred.groupby('scene_id', sort=False).indices.items():
+        cur = pred.iloc[indices]
+        values[indices] = sample_raster_windows(
+            os.path.join(image_path, scene_id, fname),
+            cur.detect_scene_row.to_numpy(dtype=np.int64)//50,
+            cur.detect_scene_column.to_numpy(dtype=np.int64)//50,
+            padding=padding,
+            use_max=use_max,
+        )
+    return values
 
-        if bathymetry >= threshold:
-            elim_inds.append(index)
+def bathymetry_pruning(pred, image_path, threshold=0, padding=0, opposite=False, use_max=False):
+    bathymetry = get_scene_raster_values(pred, image_path, 'bathymetry.tif', padding=padding, use_max=use_max)
+    elim_inds = pred.index[bathymetry >= threshold].tolist()
 
     print('bathymetry: drop {} of {}'.format(len(elim_inds), len(pred)))
 
@@ -94,22 +243,8 @@ def bathymetry_pruning(pred, image_path, threshold=0, padding=0, opposite=False,
     return pred.drop(elim_inds)
 
 def owimask_pruning(pred, image_path, padding=0):
-    # Create table index so we can refer to rows by unique index.
-    pred.reset_index()
-
-    masks = {} # scene_id to owimask
-    elim_inds = []
-    for index, row in pred.iterrows():
-        scene_id = row['scene_id']
-        if scene_id not in masks:
-            masks[scene_id] = skimage.io.imread(os.path.join(image_path, scene_id, 'owiMask.tif'))
-
-        r = clip(row.detect_scene_row//50, padding, masks[scene_id].shape[0]-padding-1)
-        c = clip(row.detect_scene_column//50, padding, masks[scene_id].shape[1]-padding-1)
-        value = masks[scene_id][r-padding:r+padding+1, c-padding:c+padding+1].min()
-
-        if value != 0:
-            elim_inds.append(index)
+    value = get_scene_raster_values(pred, image_path, 'owiMask.tif', padding=padding)
+    elim_inds = pred.index[value != 0].tolist()
 
     print('owimask: drop {} of {}'.format(len(elim_inds), len(pred)))
 
@@ -124,75 +259,80 @@ def confidence_pruning(pred, threshold=0):
 def prune_invalid(pred, chips_path, chip_size=800, channel='vh'):
     pred.reset_index()
     elim_inds = []
-    chip_offsets = {}
-
-    for index, row in pred.iterrows():
-        scene_id = row.scene_id
-        if scene_id not in chip_offsets:
-            with open(os.path.join(chips_path, scene_id, 'coords.json'), 'r') as f:
-                chip_offsets[scene_id] = json.load(f)['offsets']
 
-        valid = False
-        for chip_index, (chip_col, chip_row) in enumerate(chip_offsets[scene_id]):
-            if row.detect_scene_column < chip_col:
-                continue
-            if row.detect_scene_column >= chip_col+chip_size:
-                continue
-            if row.detect_scene_row < chip_row:
-                continue
-            if row.detect_scene_row >= chip_row+chip_size:
-                continue
-            cur_path = os.path.join(chips_path, scene_id, channel, '{}_{}.npy'.format(chip_index, channel))
-            if not os.path.exists(cur_path):
-                continue
-            im = np.load(cur_path)
-            offset_col = row.detect_scene_column - chip_col
-            offset_row = row.detect_scene_row - chip_row
-            if im[offset_row, offset_col] < -30000:
-                continue
-            valid = True
-            break
+    for scene_id, scene_pred in pred.groupby('scene_id', sort=False):
+        scene_path = os.path.join(chips_path, scene_id)
+        lookup = load_chip_index(scene_path, chip_size=chip_size)
+        cols = scene_pred.detect_scene_column.values
+        rows = scene_pred.detect_scene_row.values
+
+        if lookup.aligned:
+            # Each point is covered by at most one chip, so read the pixels a chip at a time.
+            valid = np.zeros((len(scene_pred),), dtype=bool)
+            for positions, values in gather_chip_pixels(scene_path, channel, lookup, cols, rows):
+                valid[positions] = ~(values < -30000)
+        else:
+            valid = np.array([
+                is_valid_point(lookup, scene_path, channel, col, row)
+                for col, row in zip(cols.tolist(), rows.tolist())
+            ], dtype=bool)
 
-        if not valid:
-            elim_inds.append(index)
+        elim_inds.extend(scene_pred.index[~valid])
 
+    # Drop in frame order.
+    elim_inds = pred.index[pred.index.isin(elim_inds)]
     print('valid: drop {} of {}'.format(len(elim_inds), len(pred)))
     return pred.drop(elim_inds)
 
+# Point is valid if some chip covering it has image data there.
+def is_valid_point(lookup, scene_path, channel, col, row):
+    for chip_index in lookup.covering(col, row):
+        chip_col, chip_row = lookup.offsets[chip_index]
+        im = load_chip(scene_path, channel, chip_index, mmap=True)
+        if im is None:
+            continue
+        if im[row - chip_row, col - chip_col] < -30000:
+            continue
+        return True
+    return False
+
 # Prune unless Google channel indicates water.
 def prune_google(pred, chips_path, chip_size=800):
     pred.reset_index()
     elim_inds = []
-    chip_offsets = {}
 
-    for index, row in pred.iterrows():
-        scene_id = row.scene_id
-        if scene_id not in chip_offsets:
-            with open(os.path.join(chips_path, scene_id, 'coords.json'), 'r') as f:
-                chip_offsets[scene_id] = json.load(f)['offsets']
+    for scene_id, scene_pred in pred.groupby('scene_id', sort=False):
+        scene_path = os.path.join(chips_path, scene_id)
+        lookup = load_chip_index(scene_path, chip_size=chip_size)
+        cols = scene_pred.detect_scene_column.values
+        rows = scene_pred.detect_scene_row.values
 
-        for chip_index, (chip_col, chip_row) in enumerate(chip_offsets[scene_id]):
-            if row.detect_scene_column < chip_col:
-                continue
-            if row.detect_scene_column >= chip_col+chip_size:
-                continue
-            if row.detect_scene_row < chip_row:
-                continue
-            if row.detect_scene_row >= chip_row+chip_size:
-                continue
-            cur_path = os.path.join(chips_path, scene_id, 'google', '{}_google.npy'.format(chip_index))
-            if not os.path.exists(cur_path):
-                continue
-            im = np.load(cur_path)
-            offset_col = row.detect_scene_column - chip_col
-            offset_row = row.detect_scene_row - chip_row
-            if np.abs(im[offset_row, offset_col] - 146.0/255) > 0.02:
-                elim_inds.append(index)
-            break
+        if lookup.aligned:
+            elim = np.zeros((len(scene_pred),), dtype=bool)
+            for positions, values in gather_chip_pixels(scene_path, 'google', lookup, cols, rows):
+                elim[positions] = np.abs(values - 146.0/255) > 0.02
+        else:
+            elim = np.array([
+                is_google_land(lookup, scene_path, col, row)
+                for col, row in zip(cols.tolist(), rows.tolist())
+            ], dtype=bool)
 
+        elim_inds.extend(scene_pred.index[elim])
+
+    elim_inds = pred.index[pred.index.isin(elim_inds)]
     print('google: drop {} of {}'.format(len(elim_inds), len(pred)))
     return pred.drop(elim_inds)
 
+# Decide using the first chip covering the point with Google image data; keep if there is none.
+def is_google_land(lookup, scene_path, col, row):
+    for chip_index in lookup.covering(col, row):
+        chip_col, chip_row = lookup.offsets[chip_index]
+        im = load_chip(scene_path, 'google', chip_index, mmap=True)
+        if im is None:
+            continue
+        return bool(np.abs(im[row - chip_row, col - chip_col] - 146.0/255) > 0.02)
+    return False
+
 if __name__ == "__main__":
     import argparse
 
@@ -0,0 +1,182 @@
+import numpy as np
+import torch
+
+from xview3.processing.constants import FISHING, NONFISHING
+
+
+def get_window_offsets(im_shape, window_size, padding, row_offset=0, col_offset=0):
+    """
+    Get the top-left offsets of the sliding windows over a scene.
+
+    Args:
+        im_shape (tuple): shape of the (channels, rows, cols) scene image
+        window_size (int): sliding window size
+        padding (int): padding between sliding windows
+        row_offset, col_offset (int): shift of the window grid (augmentation)
+
+    Returns:
+        (row_offsets, col_offsets) lists
+    """
+    row_offsets = [0] + list(range(
+        window_size-2*padding - row_offset,
+        im_shape[1]-window_size,
+        window_size-2*padding,
+    )) + [im_shape[1]-window_size]
+    col_offsets = [0] + list(range(
+        window_size-2*padding - col_offset,
+        im_shape[2]-window_size,
+        window_size-2*padding,
+    )) + [im_shape[2]-window_size]
+    return row_offsets, col_offsets
+
+
+def get_keep_bounds(row_offset, col_offset, im_shape, window_size, padding, overlap):
+    """
+    Get the [row_min, col_min, row_max, col_max] bounds, within a sliding window
+    at (row_offset, col_offset), of detections that this window is responsible for.
+
+    Args:
+        row_offset, col_offset (int): top-left of the window in the scene
+        im_shape (tuple): shape of the (channels, rows, cols) scene image
+        window_size (int): sliding window size
+        padding (int): padding between sliding windows
+        overlap (int): overlap allowed for predictions between windows
+
+    Returns:
+        keep_bounds list
+    """
+    keep_bounds = [
+        padding,
+        padding,
+        window_size - padding,
+        window_size - padding,
+    ]
+    if row_offset == 0:
+        keep_bounds[0] = 0
+    if col_offset == 0:
+        keep_bounds[1] = 0
+    if row_offset >= im_shape[1] - window_size:
+        keep_bounds[2] = window_size
+    if col_offset >= im_shape[2] - window_size:
+        keep_bounds[3] = window_size
+
+    keep_bounds[0] -= overlap
+    keep_bounds[1] -= overlap
+    keep_bounds[2] += overlap
+    keep_bounds[3] += overlap
+    return keep_bounds
+
+
+def decode_points(boxes, crop_size, clip_boxes=False, bbox_size=5, fliplr=False, flipud=False):
+    """
+    Convert predicted boxes to integer points in untransformed crop coordinates.
+
+    Args:
+        boxes (torch.Tensor): (N, 4) tensor of xmin, ymin, xmax, ymax boxes
+        crop_size (tuple): (height, width) of the crop the boxes were predicted on
+        clip_boxes (bool): whether boxes touching the crop edge were clipped during training,
+            in which case the point is bbox_size from the unclipped side
+        bbox_size (int): half the size of training boxes
+        fliplr, flipud (bool): undo these flips of the crop
+
+    Returns:
+        (pred_rows, pred_cols) int64 tensors
+    """
+    # Truncate toward zero like int().
+    # Like np.mean, float16 boxes are averaged with a float32 intermediate.
+    def center(lo, hi):
+        if boxes.dtype == torch.float16:
+            return ((lo.float() + hi.float()) / 2).half().to(torch.int64)
+        return ((lo + hi) / 2).to(torch.int64)
+
+    pred_cols = center(boxes[:, 0], boxes[:, 2])
+    pred_rows = center(boxes[:, 1], boxes[:, 3])
+
+    if clip_boxes:
+        # Boxes on edges of image might not be the right size.
+        pred_cols = torch.where(
+            boxes[:, 0] < bbox_size,
+            (boxes[:, 2] - bbox_size).to(torch.int64),
+            torch.where(boxes[:, 2] >= crop_size[1]-bbox_size, (boxes[:, 0] + bbox_size).to(torch.int64), pred_cols),
+        )
+        pred_rows = torch.where(
+            boxes[:, 1] < bbox_size,
+            (boxes[:, 3] - bbox_size).to(torch.int64),
+            torch.where(boxes[:, 3] >= crop_size[0]-bbox_size, (boxes[:, 1] + bbox_size).to(torch.int64), pred_rows),
+        )
+
+    # Undo any transformations.
+    if fliplr:
+        pred_cols = crop_size[1] - pred_cols
+    if flipud:
+        pred_rows = crop_size[0] - pred_rows
+
+    return pred_rows, pred_cols
+
+
+def decode_detections(output, crop_size, scene_id, row_offset=0, col_offset=0, clip_boxes=False, bbox_size=5, fliplr=False, flipud=False, keep_bounds=None, score_columns=False):
+    """
+    Convert one model output dict to a block of scene-level detections, to
+    append to a DetectionBuffer with DETECTION_SCHEMA (and SCORE_SCHEMA).
+    The decoding runs as tensor ops on the device of the output, and the kept
+    detections are copied to the CPU once.
+
+    Args:
+        output (dict): model output for one crop, with boxes, labels, scores and optionally lengths,
+            fishing_scores and vessel_scores
+        crop_size (tuple): (height, width) of the crop
+        scene_id (str): scene the crop is from
+        row_offset, col_offset (int): top-left of the crop in the scene
+        clip_boxes, bbox_size, fliplr, flipud: see decode_points
+        keep_bounds (list): if set, only keep points within these [row_min, col_min, row_max, col_max]
+            bounds, which are pre-transformation crop coordinates
+        score_columns (bool): also return fishing_score and vessel_score
+
+    Returns:
+        dict from column name to numpy array
+    """
+    pred_rows, pred_cols = decode_points(
+        output["boxes"],
+        crop_size=crop_size,
+        clip_boxes=clip_boxes,
+        bbox_size=bbox_size,
+        fliplr=fliplr,
+        flipud=flipud,
+    )
+
+    if keep_bounds is not None:
+        valid = (
+            (pred_rows >= keep_bounds[0])
+            & (pred_rows < keep_bounds[2])
+            & (pred_cols >= keep_bounds[1])
+            & (pred_cols < keep_bounds[3])
+        )
+        pred_rows = pred_rows[valid]
+        pred_cols = pred_cols[valid]
+    else:
+        valid = slice(None)
+
+    def get_field(k):
+        # Float fields are widened to float64 so they match python floats from .item().
+        if k not in output:
+            return np.zeros((len(pred_rows),), dtype=np.int64)
+        v = output[k][valid].cpu()
+        if v.is_floating_point():
+            v = v.to(torch.float64)
+        return v.numpy()
+
+    labels = output["labels"][valid].cpu().numpy()
+    detections = {
+        "detect_scene_row": row_offset + pred_rows.cpu().numpy(),
+        "detect_scene_column": col_offset + pred_cols.cpu().numpy(),
+        "scene_id": np.full((len(labels),), scene_id, dtype=object),
+        "is_vessel": (labels == FISHING) | (labels == NONFISHING),
+        "is_fishing": labels == FISHING,
+        "vessel_length_m": get_field("lengths"),
+        "score": get_field("scores"),
+    }
+    if score_columns:
+        detections["fishing_score"] = get_field("fishing_scores")
+        detections["vessel_score"] = get_field("vessel_scores")
+    return detections
+
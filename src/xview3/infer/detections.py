@@ -0,0 +1,196 @@
+import numpy as np
+import pandas as pd
+import torch
+
+# Schemas are lists of (column name, dtype, fill value for rows where the column is not set).
+# Columns of detections from the detector, in output CSV order.
+# Outputs that the detector may not have (e.g. lengths without a length head) are filled
+# with integer zeros by decode_detections, so their columns start as integers and are
+# widened to float by DetectionBuffer.promote once a float value is added, like the
+# dataframes built from lists of rows in the original inference code.
+DETECTION_SCHEMA = [
+    ("detect_scene_row", np.int64, 0),
+    ("detect_scene_column", np.int64, 0),
+    ("scene_id", object, None),
+    ("is_vessel", bool, False),
+    ("is_fishing", bool, False),
+    ("vessel_length_m", np.int64, 0),
+    ("score", np.float64, np.nan),
+]
+# Attribute scores that some detectors output in addition to DETECTION_SCHEMA.
+SCORE_SCHEMA = [
+    ("fishing_score", np.int64, 0),
+    ("vessel_score", np.int64, 0),
+]
+# Columns added by the attribute (postprocessing) model.
+ATTRIBUTE_SCHEMA = [
+    ("fishing_score", np.float64, np.nan),
+    ("vessel_score", np.float64, np.nan),
+    ("low_score", np.float64, np.nan),
+    ("correct_score", np.float64, np.nan),
+]
+
+
+class DetectionBuffer(object):
+    """
+    Growable columnar table of detections, with one preallocated numpy array
+    per column of an explicit schema.
+    Detections are added and updated a block at a time, and the final
+    dataframe is built once with to_dataframe.
+    """
+
+    def __init__(self, schema, capacity=1024):
+        self.schema = []
+        self.columns = {}
+        self.size = 0
+        self.capacity = max(capacity, 1)
+        for name, dtype, fill in schema:
+            self.add_column(name, dtype, fill)
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """
+        Create a buffer holding the rows of df, with its column dtypes as the schema.
+        Rows are addressed by position, not by the dataframe index.
+        """
+        buffer = cls([], capacity=len(df))
+        for name in df.columns:
+            column = df[name].to_numpy()
+            buffer.add_column(name, column.dtype, None)
+            buffer.columns[name][:len(df)] = column
+        buffer.size = len(df)
+        return buffer
+
+    def __len__(self):
+        return self.size
+
+    def add_column(self, name, dtype, fill):
+        """
+        Add a column to the schema, set to fill for existing rows.
+        Does nothing if the column already exists.
+        """
+        if name in self.columns:
+            return
+        dtype = np.dtype(dtype)
+        if fill is None and dtype != object:
+            fill = 0
+        self.schema.append((name, dtype, fill))
+        self.columns[name] = np.full((self.capacity,), fill, dtype=dtype)
+
+    def reserve(self, n):
+        """
+        Make room for n more rows, doubling the capacity as needed.
+        """
+        if self.size + n <= self.capacity:
+            return
+        capacity = self.capacity
+        while self.size + n > capacity:
+            capacity *= 2
+        for name, dtype, fill in self.schema:
+            column = np.full((capacity,), fill, dtype=dtype)
+            column[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = column
+        self.capacity = capacity
+
+    def promote(self, name, values):
+        """
+        Widen an integer or bool column to float if values are float, like
+        pandas does when assigning floats to it, so they are not truncated.
+        This happens with integer columns of DETECTION_SCHEMA, and with columns
+        from from_dataframe, e.g. an all-integer vessel_length_m in a CSV from
+        a detector without a length head.
+        """
+        values = np.asarray(values)
+        column = self.columns[name]
+        if column.dtype.kind not in 'biu' or values.dtype.kind != 'f':
+            return
+        dtype = np.result_type(column.dtype, values.dtype)
+        self.columns[name] = column.astype(dtype)
+        self.schema = [
+            (cur_name, dtype if cur_name == name else cur_dtype, fill)
+            for cur_name, cur_dtype, fill in self.schema
+        ]
+
+    def append(self, block):
+        """
+        Append a block of detections.
+
+        Args:
+            block (dict): column name to array, all of the same length;
+                schema columns missing from the block are left at their fill value
+        """
+        if len(block) == 0:
+            return
+        n = len(next(iter(block.values())))
+        self.reserve(n)
+        for name, values in block.items():
+            self.promote(name, values)
+            self.columns[name][self.size:self.size+n] = values
+        self.size += n
+
+    def update(self, rows, block):
+        """
+        Overwrite columns of existing detections.
+
+        Args:
+            rows (np.ndarray): positions of the detections to update
+            block (dict): column name to array of new values, aligned with rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        for name, values in block.items():
+            self.promote(name, values)
+            self.columns[name][rows] = values
+
+    def to_dataframe(self, keep=None):
+        """
+        Build a dataframe of the detections.
+
+        Args:
+            keep (np.ndarray): optional boolean mask over rows of detections to include
+        """
+        data = {}
+        for name, _, _ in self.schema:
+            column = self.columns[name][:self.size]
+            if keep is not None:
+                column = column[keep]
+            data[name] = column.copy()
+        return pd.DataFrame(data, columns=[name for name, _, _ in self.schema])
+
+
+def get_attribute_updates(outputs, mode):
+    """
+    Convert a batch of attribute model outputs to a DetectionBuffer update.
+
+    Args:
+        outputs (list): CPU tensors (length, confidence, correct, source, fishing, vessel) from the attribute model
+        mode (str): postprocessing mode, one of length, attribute or full
+
+    Returns:
+        (low, block) where low is a boolean mask of detections predicted as confidence=LOW,
+        which should be pruned in full mode, and block maps columns to new values
+        for the detections that are not pruned
+    """
+    pred_length, pred_confidence, pred_correct, pred_source, pred_fishing, pred_vessel = outputs
+
+    if mode == 'full':
+        low = (pred_confidence.argmax(dim=1) == 0).numpy()
+    else:
+        low = np.zeros((len(pred_length),), dtype=bool)
+    select = ~low
+
+    def get(t):
+        return t.to(torch.float64).numpy()[select]
+
+    block = {
+        'vessel_length_m': get(pred_length),
+    }
+    if mode in ['full', 'attribute']:
+        block['fishing_score'] = get(pred_fishing[:, 1])
+        block['vessel_score'] = get(pred_vessel[:, 1])
+        block['low_score'] = get(pred_confidence[:, 0])
+        block['is_fishing'] = ((pred_fishing[:, 1] > 0.5) & (pred_vessel[:, 1] > 0.5)).numpy()[select]
+        block['is_vessel'] = (pred_vessel[:, 1] > 0.5).numpy()[select]
+        block['correct_score'] = get(pred_correct[:, 1])
+    if mode == 'full':
+        block['score'] = get(pred_correct[:, 1])
+    return low, block
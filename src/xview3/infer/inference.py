@@ -1,85 +1,32 @@
 import argparse
+import concurrent.futures
 import configparser
 import json
-import numpy as np
 import os
 import pandas as pd
 from pathlib import Path
-import skimage.io
-import skimage.transform
 import sys
+import time
 import torch
 import torch.utils.data
-import torchvision
 from tqdm import tqdm
 
 sys.path.insert(1, '/home/xview3/src') # use an appropriate path if not in the docker volume
 
+from xview3.infer.decode import decode_detections, get_keep_bounds
+from xview3.infer.detections import DetectionBuffer, DETECTION_SCHEMA
+from xview3.infer.prefetch import ScenePrefetcher, format_stage_times
+from xview3.infer.window_plan import WindowPlanner
 from xview3.processing.constants import FISHING, NONFISHING, PIX_TO_M
 import xview3.models
 from xview3.utils import clip
 import xview3.transforms
 
 
-# Map from channel names to filenames.
-channel_map = {
-    'vv': 'VV_dB.tif',
-    'vh': 'VH_dB.tif',
-    'bathymetry': 'bathymetry.tif',
-    'wind_speed': 'owiWindSpeed.tif',
-    'wind_quality': 'owiWindQuality.tif',
-    'wind_direction': 'owiWindDirection.tif',
-}
-
-
 def center(coord):
     return (coord[0] + (coord[2] / 2), coord[1] + (coord[3] / 2))
 
 
-class SceneDataset(object):
-    def __init__(self, image_folder, scene_ids, channels, transforms):
-        self.image_folder = image_folder
-        self.scene_ids = scene_ids
-        self.channels = channels
-        self.transforms = transforms
-
-    def __len__(self):
-        return len(self.scene_ids)
-
-    def __getitem__(self, idx):
-        scene_id = self.scene_ids[idx]
-
-        # Load scene channels.
-        # We always load bathymetry so we can eliminate detections on land.
-        def get_channel(channel, shape=None):
-            path = os.path.join(self.image_folder, scene_id, channel_map[channel])
-            print(scene_id, 'read', path)
-            cur = skimage.io.imread(path)
-            cur = torch.tensor(cur, dtype=torch.float32)
-
-            # If not same size as first channel, resample before chipping
-            # to ensure chips from different channels are co-registered
-            if shape is not None and cur.shape != shape:
-                cur = torchvision.transforms.functional.resize(img=cur.unsqueeze(0), size=shape)[0, :, :]
-
-            return cur
-
-        im_channels = [get_channel(self.channels[0])] # nb this precludes vv/vh being first channel
-        for channel in self.channels[1:]:
-            if channel == "vv_over_vh":
-                vvovervh = get_channel("vv", shape=im_channels[0].shape) / get_channel("vh", shape=im_channels[0].shape)
-                vvovervh = np.nan_to_num(vvovervh, nan=0, posinf=0, neginf=0)
-                im_channels.append(torch.tensor(vvovervh, dtype=torch.float32))
-            else:
-                im_channels.append(get_channel(channel, shape=im_channels[0].shape))
-
-        # Stack channels and apply transforms.
-        im = torch.stack(im_channels, dim=0)
-        im, _ = self.transforms(im, None)
-
-        print(scene_id, 'done reading')
-        return scene_id, im
-
 def main(args, config):
     if args.scene_ids is not None:
         scene_ids = args.scene_ids.split(",")
@@ -105,11 +52,29 @@ def main(args, config):
         'channels': channels,
         'bbox_size': bbox_size,
     })
-    dataset = SceneDataset(
+    # Windows that only cover nodata (or land, if set) are not run.
+    planner = WindowPlanner(
+        window_size=args.window_size,
+        padding=args.padding,
+        overlap=args.overlap,
+        skip_nodata=not args.no_window_skip,
+        land_threshold=args.skip_land_thresh,
+        land_padding=args.skip_land_padding,
+        margin=args.skip_margin,
+    )
+    # Windows of upcoming scenes are read and normalized in background processes.
+    dataset = ScenePrefetcher(
         image_folder=args.image_folder,
         scene_ids=scene_ids,
         channels=channels,
         transforms=transforms,
+        window_size=args.window_size,
+        padding=args.padding,
+        row_offset=args.row_offset,
+        col_offset=args.col_offset,
+        num_workers=args.prefetch_workers,
+        memory_budget=args.prefetch_memory*1024*1024,
+        planner=planner,
     )
 
     model_cls = xview3.models.models[model_name]
@@ -125,128 +90,101 @@ def main(args, config):
     model.to(device)
     model.eval()
 
-    df_out = []
+    if device.type == 'cpu':
+        # Run each batch with an intra-op thread pool across the host's cores.
+        torch.set_num_threads(args.cpu_threads or os.cpu_count())
+        print('using {} cpu threads'.format(torch.get_num_threads()))
+
+    df_out = DetectionBuffer(DETECTION_SCHEMA)
+    start_time = time.time()
+    num_scenes = 0
+    num_windows = 0
+    num_skipped = 0
+    # Seconds the main loop spends waiting for crops, running the model, and decoding outputs.
+    stage_times = {'crops': 0.0, 'model': 0.0, 'decode': 0.0}
+
+    # Crops for the next batch are sliced and copied to the device in a
+    # background thread while the model runs on the current batch.
+    stage_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def stage_batch(im, windows):
+        crops = []
+        for row_offset, col_offset in windows:
+            crop = im[:, row_offset:row_offset+args.window_size, col_offset:col_offset+args.window_size]
+
+            if args.fliplr:
+                crop = torch.flip(crop, dims=[2])
+            if args.flipud:
+                crop = torch.flip(crop, dims=[1])
+
+            crops.append(crop.to(device))
+        return crops
 
     with torch.no_grad():
         for scene_id, im in tqdm(dataset):
             if im.shape[1] < args.window_size or im.shape[2] < args.window_size:
                 raise Exception('image for scene {} is smaller than window size'.format(scene_id))
 
-            # Loop over windows.
-            row_offsets = [0] + list(range(
-                args.window_size-2*args.padding - args.row_offset,
-                im.shape[1]-args.window_size,
-                args.window_size-2*args.padding,
-            )) + [im.shape[1]-args.window_size]
-            col_offsets = [0] + list(range(
-                args.window_size-2*args.padding - args.col_offset,
-                im.shape[2]-args.window_size,
-                args.window_size-2*args.padding,
-            )) + [im.shape[2]-args.window_size]
-
-            for row_offset in row_offsets:
-                print(scene_id, row_offset, '/', row_offsets[-1])
-                for col_offset in col_offsets:
-                    crop = im[:, row_offset:row_offset+args.window_size, col_offset:col_offset+args.window_size]
-
-                    if args.fliplr:
-                        crop = torch.flip(crop, dims=[2])
-                    if args.flipud:
-                        crop = torch.flip(crop, dims=[1])
-
-                    crop = crop.to(device)
-                    output = model([crop])[0]
-                    output = {k: v.to("cpu") for k, v in output.items()}
+            scene_start_time = time.time()
+            scene_stage_times = dict(stage_times)
 
+            # Loop over windows.
+            windows, scene_skipped = planner.plan(im.mask, im.shape, args.row_offset, args.col_offset)
+            num_windows += len(windows)
+            num_skipped += scene_skipped
+            batches = [windows[i:i+args.batch_size] for i in range(0, len(windows), args.batch_size)]
+
+            if batches:
+                next_crops = stage_executor.submit(stage_batch, im, batches[0])
+            for batch_idx, batch in enumerate(batches):
+                print(scene_id, batch[0][0], '/', im.shape[1]-args.window_size)
+                stage_start_time = time.time()
+                crops = next_crops.result()
+                stage_times['crops'] += time.time() - stage_start_time
+                if batch_idx+1 < len(batches):
+                    next_crops = stage_executor.submit(stage_batch, im, batches[batch_idx+1])
+
+                stage_start_time = time.time()
+                outputs = model(crops)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                stage_times['model'] += time.time() - stage_start_time
+
+                stage_start_time = time.time()
+                for (row_offset, col_offset), output in zip(batch, outputs):
                     # Only keep output detections that are within bounds based
                     # on window size and padding.
-                    keep_bounds = [
-                        args.padding,
-                        args.padding,
-                        args.window_size - args.padding,
-                        args.window_size - args.padding,
-                    ]
-                    if row_offset == 0:
-                        keep_bounds[0] = 0
-                    if col_offset == 0:
-                        keep_bounds[1] = 0
-                    if row_offset >= im.shape[1] - args.window_size:
-                        keep_bounds[2] = args.window_size
-                    if col_offset >= im.shape[2] - args.window_size:
-                        keep_bounds[3] = args.window_size
-
-                    keep_bounds[0] -= args.overlap
-                    keep_bounds[1] -= args.overlap
-                    keep_bounds[2] += args.overlap
-                    keep_bounds[3] += args.overlap
-
-                    for idx, box in enumerate(output["boxes"]):
-                        # Determine the predicted point, in transformed image coordinates.
-                        if clip_boxes:
-                            # Boxes on edges of image might not be the right size.
-                            if box[0] < bbox_size:
-                                pred_col = int(box[2] - bbox_size)
-                            elif box[2] >= crop.shape[2]-bbox_size:
-                                pred_col = int(box[0] + bbox_size)
-                            else:
-                                pred_col = int(np.mean([box[0], box[2]]))
-
-                            if box[1] < bbox_size:
-                                pred_row = int(box[3] - bbox_size)
-                            elif box[3] >= crop.shape[1]-bbox_size:
-                                pred_row = int(box[1] + bbox_size)
-                            else:
-                                pred_row = int(np.mean([box[1], box[3]]))
-                        else:
-                            pred_row = int(np.mean([box[1], box[3]]))
-                            pred_col = int(np.mean([box[0], box[2]]))
-
-                        # Undo any transformations.
-                        if args.fliplr:
-                            pred_col = crop.shape[2] - pred_col
-                        if args.flipud:
-                            pred_row = crop.shape[1] - pred_row
-
-                        # Compare against keep_bounds, which is pre-transformation.
-                        if pred_row < keep_bounds[0] or pred_row >= keep_bounds[2]:
-                            continue
-                        if pred_col < keep_bounds[1] or pred_col >= keep_bounds[3]:
-                            continue
-
-                        label = output["labels"][idx].item()
-                        is_fishing = label == FISHING
-                        is_vessel = label in [FISHING, NONFISHING]
-                        if "lengths" in output:
-                            length = output["lengths"][idx].item()
-                        else:
-                            length = 0
-                        score = output["scores"][idx].item()
-
-                        scene_pred_row = row_offset + pred_row
-                        scene_pred_col = col_offset + pred_col
-
-                        df_out.append([
-                            scene_pred_row,
-                            scene_pred_col,
-                            scene_id,
-                            is_vessel,
-                            is_fishing,
-                            length,
-                            score,
-                        ])
-
-    df_out = pd.DataFrame(
-        data=df_out,
-        columns=(
-            "detect_scene_row",
-            "detect_scene_column",
-            "scene_id",
-            "is_vessel",
-            "is_fishing",
-            "vessel_length_m",
-            "score",
-        ),
-    )
+                    keep_bounds = get_keep_bounds(row_offset, col_offset, im.shape, args.window_size, args.padding, args.overlap)
+
+                    df_out.append(decode_detections(
+                        output,
+                        crop_size=(args.window_size, args.window_size),
+                        scene_id=scene_id,
+                        row_offset=row_offset,
+                        col_offset=col_offset,
+                        clip_boxes=clip_boxes,
+                        bbox_size=bbox_size,
+                        fliplr=args.fliplr,
+                        flipud=args.flipud,
+                        keep_bounds=keep_bounds,
+                    ))
+                stage_times['decode'] += time.time() - stage_start_time
+
+            im.close()
+            num_scenes += 1
+            elapsed = time.time() - scene_start_time
+            print('{}: {} windows ({} skipped) in {:.1f} sec ({:.2f} windows/sec); {}'.format(
+                scene_id, len(windows), scene_skipped, elapsed, len(windows)/elapsed,
+                format_stage_times({k: v - scene_stage_times[k] for k, v in stage_times.items()}, elapsed),
+            ))
+
+    stage_executor.shutdown()
+    elapsed = time.time() - start_time
+    print('{} scenes in {:.1f} sec ({:.2f} scenes/hour) with batch size {}'.format(num_scenes, elapsed, num_scenes*3600/elapsed, args.batch_size))
+    print('ran {} windows, skipped {} nodata/land windows'.format(num_windows, num_skipped))
+    print('stages: {}; prefetch: {}'.format(format_stage_times(stage_times, elapsed), dataset.report(elapsed)))
+
+    df_out = df_out.to_dataframe()
     df_out.to_csv(args.output, index=False)
     print(f"{len(df_out)} detections found")
 
@@ -264,10 +202,17 @@ if __name__ == "__main__":
     parser.add_argument("--weights", help="Path to trained model weights")
     parser.add_argument("--output", help="Path in which to output inference CSVs")
     parser.add_argument("--config_path", help="Path to training configuration")
-    parser.add_argument("--batch_size", type=int, help="Inference batch size", default=1)
+    parser.add_argument("--batch_size", type=int, help="Inference batch size (number of windows per forward pass)", default=1)
+    parser.add_argument("--cpu_threads", type=int, help="Intra-op threads when running on CPU (default all cores)", default=0)
     parser.add_argument("--padding", type=int, help="Padding between sliding window", default=128)
     parser.add_argument("--window_size", type=int, help="Inference sliding window size", default=1024)
     parser.add_argument("--overlap", type=int, help="Overlap allowed for predictions between windows", default=0)
+    parser.add_argument("--prefetch_workers", type=int, help="Background processes reading upcoming scenes (0 to read on demand)", default=2)
+    parser.add_argument("--prefetch_memory", type=int, help="Memory budget in MB for prefetched windows", default=4096)
+    parser.add_argument("--no_window_skip", action="store_true", help="Run windows that only cover nodata")
+    parser.add_argument("--skip_margin", type=int, help="Pixels around a window's kept region that must be nodata/land to skip it", default=32)
+    parser.add_argument("--skip_land_thresh", type=int, help="Skip windows that bathymetry pruning with this threshold would clear (default off)", default=None)
+    parser.add_argument("--skip_land_padding", type=int, help="Bathymetry padding of that pruning (min over padding)", default=0)
 
     # augmentations
     parser.add_argument("--fliplr", type=bool, help="Left-right flip (augmentation)", default=False)
@@ -14,6 +14,8 @@ from tqdm import tqdm
 
 sys.path.insert(1, '/home/xview3/src') # use an appropriate path if not in the docker volume
 
+from xview3.infer.decode import decode_detections
+from xview3.infer.detections import DetectionBuffer, DETECTION_SCHEMA, SCORE_SCHEMA
 from xview3.processing.constants import FISHING, NONFISHING, PIX_TO_M
 from xview3.processing.dataloader import SARDataset
 import xview3.models
@@ -31,7 +33,7 @@ def run_eval(model, loader, device, chips_path, clip_boxes=False, bbox_size=5, h
 
         return chip_offsets[scene_id][chip_idx]
 
-    df_out = []
+    df_out = DetectionBuffer(DETECTION_SCHEMA + SCORE_SCHEMA)
 
     with torch.no_grad():
         for images, targets in tqdm(loader):
@@ -40,8 +42,6 @@ def run_eval(model, loader, device, chips_path, clip_boxes=False, bbox_size=5, h
             with torch.cuda.amp.autocast(enabled=half):
                 outputs = model(images)
 
-            outputs = [{k: v.to("cpu") for k, v in output.items()} for output in outputs]
-
             for img_idx, output in enumerate(outputs):
                 image = images[img_idx]
                 target = targets[img_idx]
@@ -49,72 +49,18 @@ def run_eval(model, loader, device, chips_path, clip_boxes=False, bbox_size=5, h
                 chip_idx = target['chip_id']
                 col_offset, row_offset = get_chip_offset(scene_id, chip_idx)
 
-                for box_idx, box in enumerate(output["boxes"]):
-                    if clip_boxes:
-                        # Boxes on edges of image might not be the right size.
-                        if box[0] < bbox_size:
-                            pred_col = int(box[2] - bbox_size)
-                        elif box[2] >= image.shape[2]-bbox_size:
-                            pred_col = int(box[0] + bbox_size)
-                        else:
-                            pred_col = int(np.mean([box[0], box[2]]))
-
-                        if box[1] < bbox_size:
-                            pred_row = int(box[3] - bbox_size)
-                        elif box[3] >= image.shape[1]-bbox_size:
-                            pred_row = int(box[1] + bbox_size)
-                        else:
-                            pred_row = int(np.mean([box[1], box[3]]))
-                    else:
-                        pred_row = int(np.mean([box[1], box[3]]))
-                        pred_col = int(np.mean([box[0], box[2]]))
-
-                    label = output["labels"][box_idx].item()
-                    is_fishing = label == FISHING
-                    is_vessel = label in [FISHING, NONFISHING]
-                    if "lengths" in output:
-                        length = output["lengths"][box_idx].item()
-                    else:
-                        length = 0
-                    if "fishing_scores" in output:
-                        fishing_score = output["fishing_scores"][box_idx].item()
-                    else:
-                        fishing_score = 0
-                    if "vessel_scores" in output:
-                        vessel_score = output["vessel_scores"][box_idx].item()
-                    else:
-                        vessel_score = 0
-                    score = output["scores"][box_idx].item()
-
-                    scene_pred_row = row_offset + pred_row
-                    scene_pred_col = col_offset + pred_col
-
-                    df_out.append([
-                        scene_pred_row,
-                        scene_pred_col,
-                        scene_id,
-                        is_vessel,
-                        is_fishing,
-                        length,
-                        score,
-                        fishing_score,
-                        vessel_score,
-                    ])
-
-    df_out = pd.DataFrame(
-        data=df_out,
-        columns=(
-            "detect_scene_row",
-            "detect_scene_column",
-            "scene_id",
-            "is_vessel",
-            "is_fishing",
-            "vessel_length_m",
-            "score",
-            "fishing_score",
-            "vessel_score",
-        ),
-    )
+                df_out.append(decode_detections(
+                    output,
+                    crop_size=(image.shape[1], image.shape[2]),
+                    scene_id=scene_id,
+                    row_offset=row_offset,
+                    col_offset=col_offset,
+                    clip_boxes=clip_boxes,
+                    bbox_size=bbox_size,
+                    score_columns=True,
+                ))
+
+    df_out = df_out.to_dataframe()
     return df_out
 
 
@@ -0,0 +1,230 @@
+import queue
+import time
+import traceback
+
+import torch
+import torch.multiprocessing
+
+from xview3.infer.scene_reader import SceneReader
+from xview3.infer.window_plan import WindowPlanner
+
+
+def format_stage_times(stage_times, elapsed):
+    """
+    Format a dict of seconds per stage, with each stage's share of elapsed.
+    """
+    return ', '.join(
+        '{} {:.1f} sec ({:.0f}%)'.format(k, v, 100*v/max(elapsed, 1e-6))
+        for k, v in stage_times.items()
+    )
+
+
+def run_worker(output, finished, image_folder, scene_ids, channels, transforms, planner, row_offset, col_offset):
+    """
+    Read the sliding windows of each scene, in order, into the output queue.
+
+    Puts ('start', scene_id, shape, mask), then ('window', (row_offset, col_offset), crop)
+    for each window that the planner keeps, then ('end', scene_id, read_seconds) for each scene,
+    or ('error', scene_id, traceback) if reading fails.
+    Windows are shared tensors, which can only be received while this process
+    is alive, so it waits for the finished event before exiting.
+    """
+    for scene_id in scene_ids:
+        try:
+            start_time = time.time()
+            reader = SceneReader(image_folder, scene_id, channels, transforms=transforms)
+            mask = planner.get_mask(reader)
+            output.put(('start', scene_id, reader.shape, mask))
+            read_time = time.time() - start_time
+
+            window_size = planner.window_size
+            windows, _ = planner.plan(mask, reader.shape, row_offset, col_offset)
+            for cur_row_offset, cur_col_offset in windows:
+                start_time = time.time()
+                crop = reader[:, cur_row_offset:cur_row_offset+window_size, cur_col_offset:cur_col_offset+window_size]
+                read_time += time.time() - start_time
+                # Blocks while this worker's share of the memory budget is in use.
+                output.put(('window', (cur_row_offset, cur_col_offset), crop))
+            reader.close()
+        except Exception:
+            output.put(('error', scene_id, traceback.format_exc()))
+            break
+        output.put(('end', scene_id, read_time))
+    finished.wait()
+
+
+class PrefetchedScene(object):
+    """
+    A scene whose sliding windows are being read by a prefetch worker.
+
+    Slicing works like SceneReader. Windows requested in the order they were
+    prefetched are taken from the queue; any other slice is read directly
+    with a SceneReader of its own.
+    """
+
+    def __init__(self, prefetcher, scene_id, shape, mask, output):
+        self.prefetcher = prefetcher
+        self.scene_id = scene_id
+        self.shape = shape
+        self.mask = mask
+        self.output = output
+        self.window_size = prefetcher.window_size
+        self.reader = None
+        self.next_window = None
+        self.done = False
+
+    def get(self):
+        start_time = time.time()
+        item = self.prefetcher.get(self.output)
+        self.prefetcher.stage_times['wait'] += time.time() - start_time
+        if item[0] == 'end':
+            self.prefetcher.stage_times['read'] += item[2]
+            self.done = True
+            return None
+        return item
+
+    def peek(self):
+        if self.next_window is None and not self.done:
+            self.next_window = self.get()
+        return self.next_window
+
+    def __getitem__(self, key):
+        channel_key, row_key, col_key = key
+        item = self.peek()
+        if item is not None and row_key.step is None and col_key.step is None:
+            _, (row_offset, col_offset), crop = item
+            if (row_key.start, row_key.stop, col_key.start, col_key.stop) == (row_offset, row_offset+self.window_size, col_offset, col_offset+self.window_size):
+                self.next_window = None
+                return crop[channel_key]
+
+        start_time = time.time()
+        if self.reader is None:
+            self.reader = self.prefetcher.open_reader(self.scene_id)
+        crop = self.reader[key]
+        self.prefetcher.stage_times['direct_read'] += time.time() - start_time
+        return crop
+
+    def close(self):
+        # Skip windows that were not used, so the worker moves on to its next scene.
+        while not self.done:
+            self.next_window = None
+            self.peek()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+class ScenePrefetcher(object):
+    """
+    Iterates over (scene_id, scene) like SceneDataset, while background worker
+    processes read and transform the sliding windows of upcoming scenes.
+
+    Scenes are assigned round-robin to num_workers processes, so up to
+    num_workers scenes are read ahead of the one being processed. Each worker
+    queues at most memory_budget/num_workers bytes of windows.
+    With num_workers=0, scenes are SceneReaders read on demand.
+
+    Only the windows chosen by planner (a WindowPlanner, by default one that
+    keeps every window) are prefetched. Each scene's mask attribute is the
+    SceneMask from planner.get_mask, to plan the same windows in the main process.
+
+    Each scene must be closed before the next one is requested.
+    stage_times accumulates seconds spent in the main process waiting for
+    windows (wait) and reading slices that were not prefetched (direct_read),
+    and seconds the workers spent reading (read).
+    """
+
+    def __init__(self, image_folder, scene_ids, channels, transforms, window_size, padding, row_offset=0, col_offset=0, num_workers=2, memory_budget=4*1024*1024*1024, planner=None):
+        self.image_folder = image_folder
+        self.scene_ids = scene_ids
+        self.channels = channels
+        self.transforms = transforms
+        self.window_size = window_size
+        if planner is None:
+            planner = WindowPlanner(window_size, padding, skip_nodata=False)
+        self.planner = planner
+        self.num_workers = min(num_workers, len(scene_ids))
+        self.stage_times = {'read': 0.0, 'wait': 0.0, 'direct_read': 0.0}
+        self.outputs = []
+        self.processes = []
+
+        if self.num_workers == 0:
+            return
+
+        window_bytes = len(channels)*window_size*window_size*4
+        max_windows = max(1, memory_budget // (self.num_workers*window_bytes))
+        print('prefetching scenes with {} workers, up to {} windows each'.format(self.num_workers, max_windows))
+
+        # Spawn so the workers do not inherit CUDA state from the inference process.
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.finished = ctx.Event()
+        for worker_idx in range(self.num_workers):
+            output = ctx.Queue(maxsize=max_windows)
+            process = ctx.Process(
+                target=run_worker,
+                args=(output, self.finished, image_folder, scene_ids[worker_idx::self.num_workers], channels, transforms, planner, row_offset, col_offset),
+                daemon=True,
+            )
+            process.start()
+            self.outputs.append(output)
+            self.processes.append(process)
+
+    def __len__(self):
+        return len(self.scene_ids)
+
+    def open_reader(self, scene_id):
+        return SceneReader(self.image_folder, scene_id, self.channels, transforms=self.transforms)
+
+    def get(self, output):
+        while True:
+            try:
+                item = output.get(timeout=60)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    raise Exception('prefetch workers exited')
+                continue
+            if item[0] == 'error':
+                raise Exception('prefetching scene {} failed:\n{}'.format(item[1], item[2]))
+            return item
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for scene_id in self.scene_ids:
+                start_time = time.time()
+                reader = self.open_reader(scene_id)
+                reader.mask = self.planner.get_mask(reader)
+                self.stage_times['direct_read'] += time.time() - start_time
+                yield scene_id, reader
+            return
+
+        for idx, scene_id in enumerate(self.scene_ids):
+            output = self.outputs[idx % self.num_workers]
+            start_time = time.time()
+            _, cur_scene_id, shape, mask = self.get(output)
+            self.stage_times['wait'] += time.time() - start_time
+            assert cur_scene_id == scene_id
+            scene = PrefetchedScene(self, scene_id, shape, mask, output)
+            yield scene_id, scene
+            scene.close()
+
+        self.finished.set()
+        for process in self.processes:
+            process.join()
+
+    def close(self):
+        if self.processes:
+            self.finished.set()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    def report(self, elapsed):
+        """
+        Format the stage times, given the elapsed time of the run.
+        """
+        return 'read {:.1f} sec in background, waited {:.1f} sec for windows ({:.0f}%), direct reads {:.1f} sec'.format(
+            self.stage_times['read'],
+            self.stage_times['wait'],
+            100*self.stage_times['wait']/max(elapsed, 1e-6),
+            self.stage_times['direct_read'],
+        )
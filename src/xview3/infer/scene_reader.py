@@ -0,0 +1,238 @@
+import collections
+import os
+
+import numpy as np
+import rasterio
+import rasterio.windows
+import torch
+import torchvision
+
+import xview3.transforms
+from xview3.transforms.normalize import TableNormalize
+
+
+# Map from channel names to filenames.
+channel_map = {
+    'vv': 'VV_dB.tif',
+    'vh': 'VH_dB.tif',
+    'bathymetry': 'bathymetry.tif',
+    'wind_speed': 'owiWindSpeed.tif',
+    'wind_quality': 'owiWindQuality.tif',
+    'wind_direction': 'owiWindDirection.tif',
+}
+
+
+def get_resample_indices(out_start, out_end, in_size, out_size):
+    """
+    Get source indices and weights for bilinear resampling (align_corners=False)
+    of output positions [out_start, out_end), when resizing from in_size to out_size.
+    This gives the same result as resizing the whole axis when upsampling.
+
+    Returns:
+        (lo, hi, weight) where output = (1-weight)*input[lo] + weight*input[hi]
+    """
+    scale = in_size / out_size
+    src = (np.arange(out_start, out_end, dtype=np.float64) + 0.5) * scale - 0.5
+    src = np.clip(src, 0, None)
+    lo = np.minimum(np.floor(src).astype(np.int64), in_size-1)
+    hi = np.minimum(lo+1, in_size-1)
+    weight = torch.tensor(src - lo, dtype=torch.float64)
+    return torch.tensor(lo), torch.tensor(hi), weight
+
+
+def is_per_pixel(transforms):
+    """
+    Whether transforms map each pixel independently and deterministically, so
+    applying them to each window gives the same result as to the whole scene.
+    This holds for TableNormalize, except for its random wind_direction fill.
+    """
+    if transforms is None:
+        return True
+    if isinstance(transforms, xview3.transforms.Compose):
+        return all(is_per_pixel(transform) for transform in transforms.transforms)
+    if isinstance(transforms, TableNormalize):
+        return not any(params.get('wind_direction') for _, params in transforms.table)
+    return False
+
+
+class SceneReader(object):
+    """
+    Reads windows of a scene's channels on demand, instead of loading the whole scene.
+
+    Indexing works like on the stacked (channels, rows, cols) scene tensor,
+    e.g. reader[:, row_start:row_end, col_start:col_end], and reads only that
+    window of each channel with rasterio. Channels whose size differs from the
+    first channel are resampled to its size (bilinear, like resizing the whole
+    channel); these are low resolution, so they are read once and then
+    upsampled per window.
+    Transforms, if set, are applied to each window after reading if they are
+    per-pixel (see is_per_pixel). Other transforms, like MinMaxNormalize, need
+    the whole scene, so then the whole scene is read and transformed once, on
+    first access, and windows are sliced from it.
+    """
+
+    def __init__(self, image_folder, scene_id, channels, transforms=None):
+        self.scene_path = os.path.join(image_folder, scene_id)
+        self.scene_id = scene_id
+        self.channels = channels
+        self.transforms = transforms
+        self.datasets = {}
+        # Whole low-resolution channels, and channels resized to the scene size
+        # when they can't be resampled per window.
+        self.low_res = {}
+        self.resized = {}
+        self.per_window = is_per_pixel(transforms)
+        self.scene = None
+        # SceneMask of windows to skip, set by ScenePrefetcher.
+        self.mask = None
+
+        first = self.open(channels[0]) # nb this precludes vv/vh being first channel
+        self.height = first.height
+        self.width = first.width
+        self.shape = (len(channels), self.height, self.width)
+
+    def open(self, channel):
+        if channel not in self.datasets:
+            path = os.path.join(self.scene_path, channel_map[channel])
+            print(self.scene_id, 'open', path)
+            self.datasets[channel] = rasterio.open(path)
+        return self.datasets[channel]
+
+    def close(self):
+        for dataset in self.datasets.values():
+            dataset.close()
+        self.datasets = {}
+        self.scene = None
+
+    def read_full(self, channel):
+        return torch.tensor(self.open(channel).read(1), dtype=torch.float32)
+
+    def read_channel(self, channel, row_start, row_end, col_start, col_end):
+        """
+        Read one channel in the window, resampled to the size of the first channel.
+        """
+        dataset = self.open(channel)
+        if dataset.height == self.height and dataset.width == self.width:
+            window = rasterio.windows.Window(col_start, row_start, col_end-col_start, row_end-row_start)
+            return torch.tensor(dataset.read(1, window=window), dtype=torch.float32)
+
+        if dataset.height > self.height or dataset.width > self.width:
+            # Downsampling uses a wider (antialiased) filter, so resize the whole channel once.
+            if channel not in self.resized:
+                self.resized[channel] = torchvision.transforms.functional.resize(img=self.read_full(channel).unsqueeze(0), size=(self.height, self.width))[0, :, :]
+            return self.resized[channel][row_start:row_end, col_start:col_end]
+
+        if channel not in self.low_res:
+            self.low_res[channel] = self.read_full(channel).to(torch.float64)
+        # Interpolate in float64 and round to float32 once.
+        cur = self.low_res[channel]
+        lo, hi, weight = get_resample_indices(row_start, row_end, dataset.height, self.height)
+        cur = cur[lo, :] * (1-weight[:, None]) + cur[hi, :] * weight[:, None]
+        lo, hi, weight = get_resample_indices(col_start, col_end, dataset.width, self.width)
+        cur = cur[:, lo] * (1-weight[None, :]) + cur[:, hi] * weight[None, :]
+        return cur.to(torch.float32)
+
+    def read(self, row_start, row_end, col_start, col_end):
+        """
+        Read all channels in the window, and apply transforms.
+
+        Returns:
+            (channels, row_end-row_start, col_end-col_start) float32 tensor
+        """
+        im_channels = []
+        for channel in self.channels:
+            if channel == "vv_over_vh":
+                vvovervh = self.read_channel("vv", row_start, row_end, col_start, col_end) / self.read_channel("vh", row_start, row_end, col_start, col_end)
+                im_channels.append(torch.nan_to_num(vvovervh, nan=0, posinf=0, neginf=0))
+            else:
+                im_channels.append(self.read_channel(channel, row_start, row_end, col_start, col_end))
+
+        im = torch.stack(im_channels, dim=0)
+        if self.transforms is not None:
+            im, _ = self.transforms(im, None)
+        return im
+
+    def __getitem__(self, key):
+        # Resolve slices like a tensor of the scene would, including negative and out of range bounds.
+        if not self.per_window:
+            if self.scene is None:
+                self.scene = self.read(0, self.height, 0, self.width)
+            return self.scene[key]
+
+        channel_key, row_key, col_key = key
+        row_start, row_end, _ = row_key.indices(self.height)
+        col_start, col_end, _ = col_key.indices(self.width)
+        im = self.read(row_start, max(row_start, row_end), col_start, max(col_start, col_end))
+        return im[channel_key]
+
+
+class TileCache(object):
+    """
+    Reads small crops of a scene (a SceneReader or PrefetchedScene) through
+    a cache of tiles, so that nearby crops don't each read from disk.
+
+    Tiles start every tile_size pixels and extend margin pixels further, so
+    any crop of at most margin pixels fits in one tile. Crops that are larger,
+    or not entirely inside the scene, are read from the scene directly, which
+    keeps the scene's slicing semantics for them. The max_tiles most recently
+    used tiles are kept.
+    """
+
+    def __init__(self, scene, tile_size=1024, margin=128, max_tiles=16):
+        self.scene = scene
+        self.shape = scene.shape
+        self.tile_size = tile_size
+        self.margin = margin
+        self.max_tiles = max_tiles
+        self.tiles = collections.OrderedDict()
+
+    def get_tile(self, tile_row, tile_col):
+        k = (tile_row, tile_col)
+        if k in self.tiles:
+            self.tiles.move_to_end(k)
+            return self.tiles[k]
+        row_start = tile_row*self.tile_size
+        col_start = tile_col*self.tile_size
+        tile = self.scene[:, row_start:row_start+self.tile_size+self.margin, col_start:col_start+self.tile_size+self.margin]
+        self.tiles[k] = tile
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def __getitem__(self, key):
+        channel_key, row_key, col_key = key
+        row_start, row_end = int(row_key.start), int(row_key.stop)
+        col_start, col_end = int(col_key.start), int(col_key.stop)
+        inside = row_start >= 0 and col_start >= 0 and row_end <= self.shape[1] and col_end <= self.shape[2]
+        small = row_end - row_start <= self.margin and col_end - col_start <= self.margin
+        if row_key.step is not None or col_key.step is not None or not inside or not small:
+            return self.scene[key]
+
+        tile_row = row_start // self.tile_size
+        tile_col = col_start // self.tile_size
+        tile = self.get_tile(tile_row, tile_col)
+        row_offset = tile_row*self.tile_size
+        col_offset = tile_col*self.tile_size
+        return tile[channel_key, row_start-row_offset:row_end-row_offset, col_start-col_offset:col_end-col_offset]
+
+
+def iter_crops(scene, rows, cols, crop_size, chunk_size=1024):
+    """
+    Yield the crop_size crops of scene centered at each (row, col), i.e.
+    scene[:, row-crop_size//2:row+crop_size//2, col-crop_size//2:col+crop_size//2],
+    in order. Crops are read chunk_size at a time, sorted by location within
+    each chunk, through a TileCache.
+    """
+    tiles = TileCache(scene, margin=crop_size)
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    for chunk_start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[chunk_start:chunk_start+chunk_size]
+        chunk_cols = cols[chunk_start:chunk_start+chunk_size]
+        order = np.lexsort((chunk_cols // tiles.tile_size, chunk_rows // tiles.tile_size))
+        crops = [None]*len(chunk_rows)
+        for i in order:
+            row, col = int(chunk_rows[i]), int(chunk_cols[i])
+            crops[i] = tiles[:, row-crop_size//2:row+crop_size//2, col-crop_size//2:col+crop_size//2]
+        for crop in crops:
+            yield crop
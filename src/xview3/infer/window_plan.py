@@ -0,0 +1,157 @@
+import numpy as np
+import scipy.ndimage
+
+from xview3.infer.decode import get_keep_bounds, get_window_offsets
+from xview3.processing.constants import NODATA_VH_DB
+
+
+class SceneMask(object):
+    """
+    Coarse masks of where a scene can have detections that survive pruning.
+
+    valid is a (ceil(rows/cell_size), ceil(cols/cell_size)) array that is True for
+    cells with at least one pixel that is not nodata, or None to treat every
+    pixel as valid. land is True for pixels of the 50x-downsampled bathymetry
+    raster where bathymetry pruning would drop a detection, or None.
+    """
+
+    def __init__(self, valid, cell_size, land=None, land_cell_size=50):
+        self.valid = valid
+        self.cell_size = cell_size
+        self.land = land
+        self.land_cell_size = land_cell_size
+
+    def has_ocean(self, row_start, row_end, col_start, col_end):
+        """
+        Returns whether scene pixels [row_start, row_end) x [col_start, col_end)
+        may contain valid pixels that are not land.
+        """
+        if self.valid is not None:
+            cs = self.cell_size
+            if not self.valid[row_start//cs:(row_end-1)//cs+1, col_start//cs:(col_end-1)//cs+1].any():
+                return False
+        if self.land is not None:
+            cs = self.land_cell_size
+            # Like bathymetry pruning, detections past the raster use its last row/column.
+            rows = np.clip(np.arange(row_start//cs, (row_end-1)//cs+1), 0, self.land.shape[0]-1)
+            cols = np.clip(np.arange(col_start//cs, (col_end-1)//cs+1), 0, self.land.shape[1]-1)
+            if self.land[rows[:, None], cols[None, :]].all():
+                return False
+        return True
+
+
+def get_valid_cells(dataset, cell_size, strip_cells=16):
+    """
+    Read a channel in strips of rows, and reduce it to cells of cell_size x cell_size
+    pixels that are True if any pixel in the cell is not nodata.
+    """
+    height, width = dataset.height, dataset.width
+    num_rows = (height + cell_size - 1) // cell_size
+    num_cols = (width + cell_size - 1) // cell_size
+    valid = np.zeros((num_rows, num_cols), dtype=bool)
+    strip_size = strip_cells*cell_size
+    for row_start in range(0, height, strip_size):
+        row_end = min(row_start+strip_size, height)
+        window = ((row_start, row_end), (0, width))
+        strip = dataset.read(1, window=window) != NODATA_VH_DB
+        # Pad to whole cells with invalid pixels.
+        cur_rows = (row_end - row_start + cell_size - 1) // cell_size
+        padded = np.zeros((cur_rows*cell_size, num_cols*cell_size), dtype=bool)
+        padded[0:strip.shape[0], 0:strip.shape[1]] = strip
+        cells = padded.reshape(cur_rows, cell_size, num_cols, cell_size).any(axis=(1, 3))
+        valid[row_start//cell_size:row_start//cell_size+cur_rows, :] = cells
+    return valid
+
+
+def get_land_cells(bathymetry, threshold, padding=0):
+    """
+    Get the pixels of the bathymetry raster where bathymetry_pruning (with min over
+    padding) would drop a detection, i.e. bathymetry >= threshold around the pixel.
+    """
+    bathymetry = bathymetry.astype(np.float64)
+    if padding == 0:
+        return bathymetry >= threshold
+    height, width = bathymetry.shape
+    if height <= 2*padding or width <= 2*padding:
+        return np.zeros(bathymetry.shape, dtype=bool)
+    # Windows are shifted inward near the edges, see sample_raster_windows.
+    filtered = scipy.ndimage.minimum_filter(bathymetry, size=2*padding+1)
+    rows = np.clip(np.arange(height), padding, height-padding-1)
+    cols = np.clip(np.arange(width), padding, width-padding-1)
+    return filtered[rows[:, None], cols[None, :]] >= threshold
+
+
+class WindowPlanner(object):
+    """
+    Chooses which sliding windows of a scene to run the detector on.
+
+    Windows are skipped if the part of the scene they keep detections for
+    (see get_keep_bounds), padded by margin pixels, contains only nodata, or
+    only land where bathymetry pruning with land_threshold and land_padding
+    would drop every detection anyway. Nodata is found in the first of the
+    vh/vv channels, and land from bathymetry.tif.
+
+    With skip_nodata False and land_threshold None, no windows are skipped.
+    """
+
+    def __init__(self, window_size, padding, overlap=0, skip_nodata=True, land_threshold=None, land_padding=0, margin=32, cell_size=32):
+        self.window_size = window_size
+        self.padding = padding
+        self.overlap = overlap
+        self.skip_nodata = skip_nodata
+        self.land_threshold = land_threshold
+        self.land_padding = land_padding
+        self.margin = margin
+        self.cell_size = cell_size
+
+    def get_mask(self, reader):
+        """
+        Compute the SceneMask of a SceneReader, or None if no windows are skipped.
+        """
+        valid = None
+        if self.skip_nodata:
+            for channel in ['vh', 'vv']:
+                if channel not in reader.channels and 'vv_over_vh' not in reader.channels:
+                    continue
+                dataset = reader.open(channel)
+                if dataset.height != reader.height or dataset.width != reader.width:
+                    continue
+                valid = get_valid_cells(dataset, self.cell_size)
+                break
+
+        land = None
+        if self.land_threshold is not None:
+            land = get_land_cells(reader.open('bathymetry').read(1), self.land_threshold, padding=self.land_padding)
+
+        if valid is None and land is None:
+            return None
+        return SceneMask(valid, self.cell_size, land=land)
+
+    def plan(self, mask, im_shape, row_offset=0, col_offset=0):
+        """
+        Get the sliding windows to run on a scene.
+
+        Args:
+            mask (SceneMask): mask from get_mask, or None to keep every window
+            im_shape (tuple): shape of the (channels, rows, cols) scene image
+            row_offset, col_offset (int): shift of the window grid (augmentation)
+
+        Returns:
+            (windows, num_skipped) where windows is a list of (row_offset, col_offset)
+        """
+        row_offsets, col_offsets = get_window_offsets(im_shape, self.window_size, self.padding, row_offset, col_offset)
+        windows = []
+        num_skipped = 0
+        for cur_row_offset in row_offsets:
+            for cur_col_offset in col_offsets:
+                if mask is not None:
+                    keep_bounds = get_keep_bounds(cur_row_offset, cur_col_offset, im_shape, self.window_size, self.padding, self.overlap)
+                    row_start = max(cur_row_offset + keep_bounds[0] - self.margin, 0)
+                    col_start = max(cur_col_offset + keep_bounds[1] - self.margin, 0)
+                    row_end = min(cur_row_offset + keep_bounds[2] + self.margin, im_shape[1])
+                    col_end = min(cur_col_offset + keep_bounds[3] + self.margin, im_shape[2])
+                    if row_end <= row_start or col_end <= col_start or not mask.has_ocean(row_start, row_end, col_start, col_end):
+                        num_skipped += 1
+                        continue
+                windows.append((cur_row_offset, cur_col_offset))
+        return windows, num_skipped
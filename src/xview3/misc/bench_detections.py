@@ -0,0 +1,88 @@
+# Benchmark DetectionBuffer attribute updates against the original per-detection pred.loc writes.
+# Uses synthetic detection CSVs where vessel_length_m and score are all-integer columns,
+# like CSVs from detectors without a length head, to check that float outputs are not truncated.
+# Usage: python -m xview3.misc.bench_detections [num_detections]
+
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from xview3.infer.detections import DetectionBuffer, ATTRIBUTE_SCHEMA, get_attribute_updates
+
+num_detections = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+batch_size = 32
+
+def make_csv(num_detections, seed=0):
+    rng = np.random.default_rng(seed)
+    pred = pd.DataFrame({
+        'detect_scene_row': rng.integers(0, 20000, size=num_detections),
+        'detect_scene_column': rng.integers(0, 20000, size=num_detections),
+        'scene_id': rng.choice(['a', 'b'], size=num_detections),
+        'is_vessel': rng.uniform(size=num_detections) < 0.5,
+        'is_fishing': rng.uniform(size=num_detections) < 0.5,
+        'vessel_length_m': np.zeros((num_detections,), dtype=np.int64),
+        'score': rng.integers(0, 2, size=num_detections),
+    })
+    # Round-trip through a CSV so dtypes are inferred like in inference.
+    return pd.read_csv(io.StringIO(pred.to_csv(index=False)))
+
+def make_outputs(n, rng):
+    def probs():
+        p = torch.tensor(rng.uniform(size=(n, 1)), dtype=torch.float32)
+        return torch.cat([p, 1-p], dim=1)
+    length = torch.tensor(rng.uniform(0, 300, size=(n,)), dtype=torch.float32)
+    return [length, probs(), probs(), probs(), probs(), probs()]
+
+def update_loop(df, outputs, mode):
+    elim_inds = []
+    for x, t in enumerate(outputs):
+        pred_length, pred_confidence, pred_correct, pred_source, pred_fishing, pred_vessel = t
+        for i in range(len(pred_length)):
+            index = x*batch_size + i
+            if pred_confidence[i, :].argmax() == 0 and mode == 'full':
+                elim_inds.append(index)
+                continue
+            df.loc[index, 'vessel_length_m'] = pred_length[i].item()
+            if mode in ['full', 'attribute']:
+                df.loc[index, 'fishing_score'] = pred_fishing[i, 1].item()
+                df.loc[index, 'vessel_score'] = pred_vessel[i, 1].item()
+                df.loc[index, 'low_score'] = pred_confidence[i, 0].item()
+                df.loc[index, 'is_fishing'] = (pred_fishing[i, 1] > 0.5).item() & (pred_vessel[i, 1] > 0.5).item()
+                df.loc[index, 'is_vessel'] = (pred_vessel[i, 1] > 0.5).item()
+                df.loc[index, 'correct_score'] = pred_correct[i, 1].item()
+            if mode == 'full':
+                df.loc[index, 'score'] = pred_correct[i, 1].item()
+    return df.drop(elim_inds)
+
+def update_buffer(df, outputs, mode):
+    detections = DetectionBuffer.from_dataframe(df)
+    if mode in ['full', 'attribute'] and len(df) > 0:
+        for name, dtype, fill in ATTRIBUTE_SCHEMA:
+            detections.add_column(name, dtype, fill)
+    keep = np.ones((len(df),), dtype=bool)
+    for x, t in enumerate(outputs):
+        rows = np.arange(x*batch_size, x*batch_size+len(t[0]))
+        low, block = get_attribute_updates(t, mode)
+        keep[rows[low]] = False
+        detections.update(rows[~low], block)
+    return detections.to_dataframe(keep=keep)
+
+df = make_csv(num_detections)
+rng = np.random.default_rng(1)
+outputs = [make_outputs(min(batch_size, num_detections-x), rng) for x in range(0, num_detections, batch_size)]
+
+for mode in ['length', 'attribute', 'full']:
+    start_time = time.time()
+    expected = update_loop(df.copy(), outputs, mode)
+    loop_time = time.time() - start_time
+    start_time = time.time()
+    actual = update_buffer(df, outputs, mode)
+    buffer_time = time.time() - start_time
+    print('{} detections, mode {}: loop {:.3f} sec, buffer {:.3f} sec'.format(num_detections, mode, loop_time, buffer_time))
+    if expected.to_csv(index=False) != actual.to_csv(index=False):
+        raise Exception('buffer output does not match loop output in mode {}'.format(mode))
+print('outputs match')
@@ -0,0 +1,107 @@
+# Benchmark cropping batches on the device (DeviceTransforms) against cropping each sample in SARDataset
+# (TrainTransforms), and check both give the same images and targets, including with ClipBoxes.
+# The crop windows drawn by the batched crop are replayed in the loader, so only crops (e.g. Crop800)
+# are supported in DeviceTransforms.
+# Usage: python -m xview3.misc.bench_device_transforms [training config] [num_samples] [batch_size]
+
+import configparser
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+
+from xview3.processing.dataloader import SARDataset
+import xview3.transforms
+from xview3.transforms.augment import Crop
+from xview3.transforms.batch import BatchCrop, BatchCompose
+
+config_path = sys.argv[1]
+num_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+config = configparser.ConfigParser()
+config.read(config_path)
+
+channels = config.get("data", "Channels").strip().split(",")
+bbox_size = config.getint("data", "BboxSize", fallback=5)
+clip_boxes = config.getboolean("data", "ClipBoxes", fallback=False)
+transform_names = config.get("data", "Transforms").split(",")
+crop_names = [name.strip() for name in config.get("data", "DeviceTransforms", fallback="Crop800").split(",") if name.strip()]
+for name in crop_names:
+    if not name.startswith('Crop'):
+        raise Exception('only crops can be checked, got {}'.format(name))
+info = {
+    'channels': channels,
+    'bbox_size': bbox_size,
+}
+
+# (left, top) of each crop drawn by the batched crops, replayed in the same order by the loader crops.
+windows = []
+
+class RecordBatchCrop(BatchCrop):
+    def get_windows(self, images):
+        left, top = super(RecordBatchCrop, self).get_windows(images)
+        windows.extend(zip(left.tolist(), top.tolist()))
+        return left, top
+
+class ReplayCrop(Crop):
+    def get_window(self, x_valid, y_valid, height, width):
+        left, top = windows.pop(0)
+        target_size = height - self.amount
+        return left, top, left+target_size, top+target_size
+
+def get_dataset(transforms):
+    return SARDataset(
+        chips_path=config.get("data", "ChipsPath"),
+        scene_path=config.get("data", "TrainScenePath"),
+        transforms=transforms,
+        channels=channels,
+        skip_low_confidence=config.getboolean("data", "SkipLowConfidence", fallback=False),
+        use_box_labels=config.getboolean("data", "UseBoxLabels", fallback=False),
+        bbox_size=bbox_size,
+        clip_boxes=clip_boxes,
+        span=config.getint("data", "Span", fallback=1),
+        chip_list=config.get("data", "ChipList", fallback=None),
+    )
+
+base_transforms = xview3.transforms.get_transforms(transform_names, info)
+base_transforms = base_transforms.transforms if base_transforms is not None else []
+device_dataset = get_dataset(xview3.transforms.Compose(base_transforms))
+device_transforms = BatchCompose([RecordBatchCrop(info, int(name[4:])) for name in crop_names], clip_boxes=clip_boxes)
+loader_dataset = get_dataset(xview3.transforms.Compose(base_transforms + [ReplayCrop(info, int(name[4:])) for name in crop_names]))
+num_samples = min(num_samples, len(device_dataset))
+
+def seed():
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+seed()
+start_time = time.time()
+device_outputs = []
+for batch_start in range(0, num_samples, batch_size):
+    samples = [device_dataset[idx] for idx in range(batch_start, min(batch_start+batch_size, num_samples))]
+    images, targets = device_transforms([image for image, _ in samples], [target for _, target in samples])
+    device_outputs.extend(zip(images, targets))
+device_time = time.time() - start_time
+
+seed()
+start_time = time.time()
+loader_outputs = [loader_dataset[idx] for idx in range(num_samples)]
+loader_time = time.time() - start_time
+
+print('{} samples: device {:.3f} sec, loader {:.3f} sec'.format(num_samples, device_time, loader_time))
+
+for (img1, target1), (img2, target2) in zip(loader_outputs, device_outputs):
+    if not torch.equal(img1, img2):
+        raise Exception('images do not match')
+    for k, v in target1.items():
+        if isinstance(v, torch.Tensor):
+            match = v.shape == target2[k].shape and np.array_equal(v.numpy(), target2[k].numpy(), equal_nan=v.is_floating_point())
+        else:
+            match = v == target2[k]
+        if not match:
+            raise Exception('target {} does not match'.format(k))
+print('outputs match')
@@ -0,0 +1,85 @@
+# Benchmark SARDataset sample loading with the precomputed per-chip label index
+# against the original per-sample pandas filtering and row-by-row target construction, and, with Span=2 and a Crop in
+# TrainTransforms, reading only the crop window against reading the whole image.
+# Checks that all give the same images and targets.
+# Usage: python -m xview3.misc.bench_loader [training config] [num_samples]
+
+import configparser
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+
+from xview3.processing.dataloader import SARDataset
+import xview3.transforms
+
+config_path = sys.argv[1]
+num_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+config = configparser.ConfigParser()
+config.read(config_path)
+
+channels = config.get("data", "Channels").strip().split(",")
+class_map = config.get("data", "ClassMap", fallback=None)
+if class_map is not None:
+    class_map = [int(cls) for cls in class_map.split(',')]
+bbox_size = config.getint("data", "BboxSize", fallback=5)
+transform_names = config.get("data", "Transforms").split(",")
+train_transform_names = config.get("data", "TrainTransforms", fallback="").split(",")
+transforms = xview3.transforms.get_transforms(transform_names + train_transform_names, {
+    'channels': channels,
+    'bbox_size': bbox_size,
+})
+
+dataset = SARDataset(
+    chips_path=config.get("data", "ChipsPath"),
+    scene_path=config.get("data", "TrainScenePath"),
+    transforms=transforms,
+    channels=channels,
+    skip_low_confidence=config.getboolean("data", "SkipLowConfidence", fallback=False),
+    class_map=class_map,
+    use_box_labels=config.getboolean("data", "UseBoxLabels", fallback=False),
+    bbox_size=bbox_size,
+    clip_boxes=config.getboolean("data", "ClipBoxes", fallback=False),
+    span=config.getint("data", "Span", fallback=1),
+    custom_annotation_path=config.get("data", "CustomAnnotationPath", fallback=None),
+    chip_list=config.get("data", "ChipList", fallback=None),
+)
+num_samples = min(num_samples, len(dataset))
+
+def load_samples():
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    samples = []
+    start_time = time.time()
+    for idx in range(num_samples):
+        samples.append(dataset[idx])
+    return samples, time.time() - start_time
+
+crop_transforms = dataset.crop_transforms
+modes = [('iterrows', False, None), ('label index', True, None)]
+if crop_transforms is not None:
+    modes.append(('lazy crop', True, crop_transforms))
+
+outputs = {}
+for name, use_label_index, cur_crop_transforms in modes:
+    dataset.use_label_index = use_label_index
+    dataset.crop_transforms = cur_crop_transforms
+    outputs[name], elapsed = load_samples()
+    print('{}: {} samples in {:.3f} sec ({:.1f} samples/sec)'.format(name, num_samples, elapsed, num_samples/elapsed))
+
+for name, _, _ in modes[1:]:
+    for (img1, target1), (img2, target2) in zip(outputs['iterrows'], outputs[name]):
+        if not torch.equal(img1, img2):
+            raise Exception('{} images do not match'.format(name))
+        for k, v in target1.items():
+            if isinstance(v, torch.Tensor):
+                match = v.shape == target2[k].shape and np.array_equal(v.numpy(), target2[k].numpy(), equal_nan=v.is_floating_point())
+            else:
+                match = v == target2[k]
+            if not match:
+                raise Exception('{} target {} does not match'.format(name, k))
+print('outputs match')
@@ -0,0 +1,55 @@
+# Benchmark the vectorized NMS in eval.prune against the original per-row implementation.
+# Uses synthetic scenes with clustered points, tied scores and score=1 points.
+# The original implementation is only run (and compared against) on the smaller check size since it is slow.
+# Usage: python -m xview3.misc.bench_nms [check_points] [bench_points,...]
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from xview3.eval.prune import nms, nms_loop
+
+check_points = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+bench_points = [int(n) for n in sys.argv[2].split(',')] if len(sys.argv) > 2 else [100000, 1000000]
+
+def make_pred(num_points, seed=0):
+    rng = np.random.default_rng(seed)
+    scene_size = int(np.sqrt(num_points)*60)
+    # Half the points are around cluster centers, like repeated detections of one vessel.
+    num_clusters = num_points//4
+    centers = rng.integers(0, scene_size, size=(num_clusters, 2))
+    cluster_points = centers[rng.integers(0, num_clusters, size=num_points//2)] + rng.integers(-8, 9, size=(num_points//2, 2))
+    other_points = rng.integers(0, scene_size, size=(num_points - num_points//2, 2))
+    points = np.concatenate([cluster_points, other_points], axis=0)
+    # Round scores so that ties are common.
+    scores = np.round(rng.uniform(0, 1, size=num_points), 2)
+    scores[rng.uniform(size=num_points) < 0.02] = 1
+    pred = pd.DataFrame({
+        'detect_scene_row': points[:, 0],
+        'detect_scene_column': points[:, 1],
+        'scene_id': rng.choice(['a', 'b'], size=num_points),
+        'score': scores,
+    })
+    # Shuffle the index so tie-breaking does not follow frame order.
+    pred.index = rng.permutation(num_points)
+    return pred
+
+pred = make_pred(check_points)
+start_time = time.time()
+expected = nms_loop(pred.copy(), distance_thresh=10)
+loop_time = time.time() - start_time
+start_time = time.time()
+actual = nms(pred.copy(), distance_thresh=10)
+vectorized_time = time.time() - start_time
+print('{} points: loop {:.3f} sec, vectorized {:.3f} sec'.format(check_points, loop_time, vectorized_time))
+if not expected.equals(actual):
+    raise Exception('vectorized output does not match loop output')
+print('outputs match')
+
+for num_points in bench_points:
+    pred = make_pred(num_points)
+    start_time = time.time()
+    nms(pred, distance_thresh=10)
+    print('{} points: vectorized {:.3f} sec'.format(num_points, time.time() - start_time))
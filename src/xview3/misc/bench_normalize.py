@@ -0,0 +1,59 @@
+# Benchmark the fused normalization transforms against the original per-channel implementations,
+# and check both give the same output, on random 1600x1600 chips with invalid pixels and NaNs.
+# Usage: python -m xview3.misc.bench_normalize [num_samples] [channels]
+
+import sys
+import time
+
+import numpy as np
+import torch
+
+from xview3.transforms.normalize import DefaultNormalize, CustomNormalize, CustomNormalize2, CustomNormalize3
+from xview3.transforms.normalize import DefaultNormalizeLoop, CustomNormalizeLoop, CustomNormalize2Loop, CustomNormalize3Loop
+
+num_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+channels = sys.argv[2].split(',') if len(sys.argv) > 2 else ['vh', 'vv', 'bathymetry', 'wind_speed', 'wind_direction', 'overlap']
+
+def make_image(seed):
+    rng = np.random.default_rng(seed)
+    image = rng.normal(0, 1, size=(len(channels), 1600, 1600)).astype(np.float32)
+    for ch, channel in enumerate(channels):
+        if channel in ['vh', 'vv', 'vh_other']:
+            image[ch] = image[ch]*20 - 20
+        elif channel == 'bathymetry':
+            image[ch] = image[ch]*3000 - 2000
+        elif channel == 'wind_speed':
+            image[ch] = image[ch]*50 + 20
+        elif channel == 'wind_direction':
+            image[ch] = image[ch]*200 + 180
+    # Invalid pixels and NaNs.
+    image[:, rng.uniform(size=(1600, 1600)) < 0.05] = -32768
+    image[:, rng.uniform(size=(1600, 1600)) < 0.001] = np.nan
+    return torch.tensor(image)
+
+images = [make_image(seed) for seed in range(num_samples)]
+info = {'channels': channels}
+
+for fused_cls, loop_cls in [
+    (DefaultNormalize, DefaultNormalizeLoop),
+    (CustomNormalize, CustomNormalizeLoop),
+    (CustomNormalize2, CustomNormalize2Loop),
+    (CustomNormalize3, CustomNormalize3Loop),
+]:
+    outputs = {}
+    for name, transform in [('loop', loop_cls(info)), ('fused', fused_cls(info))]:
+        np.random.seed(0)
+        outputs[name] = []
+        elapsed = 0
+        for image in images:
+            image = image.clone()
+            start_time = time.time()
+            image, _ = transform(image, None)
+            elapsed += time.time() - start_time
+            outputs[name].append(image)
+        print('{} {}: {:.1f} ms/sample'.format(fused_cls.__name__, name, 1000*elapsed/num_samples))
+
+    for image1, image2 in zip(outputs['loop'], outputs['fused']):
+        if not np.array_equal(image1.numpy(), image2.numpy(), equal_nan=True):
+            raise Exception('{} output does not match'.format(fused_cls.__name__))
+    print('{}: outputs match'.format(fused_cls.__name__))
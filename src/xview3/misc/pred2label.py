@@ -1,10 +1,12 @@
 # Add missing columns to convert prediction CSV to a label CSV.
 
-import json
+import numpy as np
 import os.path
 import pandas as pd
 import sys
 
+from xview3.utils.chip_index import load_chip_index
+
 in_path = sys.argv[1]
 chips_path = sys.argv[2]
 out_path = sys.argv[3]
@@ -15,46 +17,28 @@ pred = pd.read_csv(in_path)
 
 pred.insert(len(pred.columns), 'confidence', ['HIGH']*len(pred))
 pred.insert(len(pred.columns), 'source', ['manual']*len(pred))
-pred.insert(len(pred.columns), 'vessel_class', [0]*len(pred))
+pred.insert(len(pred.columns), 'vessel_class', np.select(
+    [pred.is_fishing == True, pred.is_vessel == True],
+    [1, 2],
+    default=3,
+))
 pred.insert(len(pred.columns), 'rows', [0]*len(pred))
 pred.insert(len(pred.columns), 'columns', [0]*len(pred))
 pred.insert(len(pred.columns), 'chip_index', [0]*len(pred))
 
-chip_offsets = {}
-def get_offsets(scene_id):
-    if scene_id not in chip_offsets:
-        with open(os.path.join(chips_path, scene_id, 'coords.json'), 'r') as f:
-            chip_offsets[scene_id] = json.load(f)['offsets']
-
-    return chip_offsets[scene_id]
-
-for index, label in pred.iterrows():
-    if index%1000 == 0:
-        print(index, len(pred))
-
-    if label.is_fishing == True:
-        pred.loc[index, 'vessel_class'] = 1
-    elif label.is_vessel == True:
-        pred.loc[index, 'vessel_class'] = 2
-    else:
-        pred.loc[index, 'vessel_class'] = 3
-
-    scene_id = label.scene_id
-    scene_row, scene_col = int(label.detect_scene_row), int(label.detect_scene_column)
-
-    offsets = get_offsets(scene_id)
-
-    # Determine which chip in the scene this point falls in.
-    chip_idx = None
-    for i, (start_col, start_row) in enumerate(offsets):
-        if scene_row >= start_row and scene_row < start_row+chip_size and scene_col >= start_col and scene_col < start_col+chip_size:
-            chip_idx = i
-            break
-    if chip_idx is None:
-        raise Exception('failed to find chip for {}'.format(label))
-
-    pred.loc[index, 'rows'] = scene_row - start_row
-    pred.loc[index, 'columns'] = scene_col - start_col
-    pred.loc[index, 'chip_index'] = chip_idx
+for scene_id, scene_pred in pred.groupby('scene_id', sort=False):
+    lookup = load_chip_index(os.path.join(chips_path, scene_id), chip_size=chip_size)
+    scene_rows = scene_pred.detect_scene_row.values.astype('int64')
+    scene_cols = scene_pred.detect_scene_column.values.astype('int64')
+
+    # Determine which chip in the scene each point falls in.
+    chip_indices = lookup.find_all(scene_cols, scene_rows)
+    if (chip_indices < 0).any():
+        raise Exception('failed to find chip for {}'.format(scene_pred[chip_indices < 0].iloc[0]))
+    offsets = np.array(lookup.offsets, dtype='int64').reshape(-1, 2)[chip_indices]
+
+    pred.loc[scene_pred.index, 'rows'] = scene_rows - offsets[:, 1]
+    pred.loc[scene_pred.index, 'columns'] = scene_cols - offsets[:, 0]
+    pred.loc[scene_pred.index, 'chip_index'] = chip_indices
 
 pred.to_csv(out_path, index=False)
@@ -1,7 +1,6 @@
 # Like visualize_label_boxes but extracts images from pre-processed chips so it's much faster.
 
 import csv
-import json
 import multiprocessing
 import numpy
 import os, os.path
@@ -9,7 +8,9 @@ import skimage.io, skimage.transform
 import sys
 import torch
 
+from xview3.processing.chip_store import load_chip
 from xview3.transforms import CustomNormalize3
+from xview3.utils.chip_index import load_chip_index
 
 csv_path = sys.argv[1]
 chip_path = sys.argv[2]
@@ -30,26 +31,22 @@ for i, label in enumerate(labels):
     label['index'] = i
 
 # Annotate each label with its chip index.
-chip_offsets = {}
-def get_offsets(scene_id):
-    if scene_id not in chip_offsets:
-        with open(os.path.join(chip_path, scene_id, 'coords.json'), 'r') as f:
-            chip_offsets[scene_id] = json.load(f)['offsets']
-    return chip_offsets[scene_id]
+chip_lookup = {}
+def get_chip_lookup(scene_id):
+    if scene_id not in chip_lookup:
+        chip_lookup[scene_id] = load_chip_index(os.path.join(chip_path, scene_id), chip_size=chip_size)
+    return chip_lookup[scene_id]
 
 for label in labels:
     scene_id = label['scene_id']
     row, col = int(label['detect_scene_row']), int(label['detect_scene_column'])
-    offsets = get_offsets(scene_id)
+    lookup = get_chip_lookup(scene_id)
 
     # Determine which chip in the scene this point falls in.
-    chip_idx = None
-    for i, (start_col, start_row) in enumerate(offsets):
-        if row >= start_row and row < start_row+chip_size and col >= start_col and col < start_col+chip_size:
-            chip_idx = i
-            break
+    chip_idx = lookup.find(col, row)
     if chip_idx is None:
         raise Exception('failed to find chip for {}'.format(label))
+    start_col, start_row = lookup.offsets[chip_idx]
     label['chip_index'] = chip_idx
     label['chip_row'] = start_row
     label['chip_col'] = start_col
@@ -70,9 +67,9 @@ def f(t):
     scene_id, chip_index, cur_labels = t
 
     dir = os.path.join(chip_path, scene_id)
-    vh_im = numpy.load(os.path.join(dir, 'vh/{}_vh.npy'.format(chip_index)))
-    vv_im = numpy.load(os.path.join(dir, 'vv/{}_vv.npy'.format(chip_index)))
-    bathymetry = numpy.load(os.path.join(dir, 'bathymetry/{}_bathymetry.npy'.format(chip_index)))
+    vh_im = load_chip(dir, 'vh', chip_index)
+    vv_im = load_chip(dir, 'vv', chip_index)
+    bathymetry = load_chip(dir, 'bathymetry', chip_index)
     img = numpy.stack([vh_im, vv_im, bathymetry], axis=0)
     img = torch.tensor(img, dtype=torch.float32)
     img, _ = transform(img, None)
@@ -6,7 +6,9 @@ import sys
 from tqdm import tqdm
 import torch
 
+from xview3.infer.detections import DetectionBuffer, ATTRIBUTE_SCHEMA, get_attribute_updates
 from xview3.postprocess.v2.model_simple import Model
+from xview3.processing.chip_store import load_chip
 from xview3.transforms import CustomNormalize3
 
 model_path = sys.argv[1]
@@ -60,9 +62,10 @@ class Dataset(object):
     def __len__(self):
         return len(self.chips)
 
-    def load_or_zeros(self, path):
-        if os.path.exists(path):
-            return numpy.load(path)
+    def load_or_zeros(self, scene_dir, fl, chip_idx):
+        chip = load_chip(scene_dir, fl, chip_idx)
+        if chip is not None:
+            return chip
         else:
             return -32768*numpy.ones((chip_size, chip_size), dtype=numpy.float32)
 
@@ -101,9 +104,9 @@ class Dataset(object):
                 if chip_idx is None:
                     continue
 
-                vh_im = self.load_or_zeros(os.path.join(scene_dir, 'vh/{}_vh.npy'.format(chip_idx)))
-                vv_im = self.load_or_zeros(os.path.join(scene_dir, 'vv/{}_vv.npy'.format(chip_idx)))
-                bathymetry = self.load_or_zeros(os.path.join(scene_dir, 'bathymetry/{}_bathymetry.npy'.format(chip_idx)))
+                vh_im = self.load_or_zeros(scene_dir, 'vh', chip_idx)
+                vv_im = self.load_or_zeros(scene_dir, 'vv', chip_idx)
+                bathymetry = self.load_or_zeros(scene_dir, 'bathymetry', chip_idx)
                 cur_img = numpy.stack([vh_im, vv_im, bathymetry], axis=0)
                 cur_img = torch.as_tensor(cur_img)
                 img[:, (1+row_offset)*chip_size:(2+row_offset)*chip_size, (1+col_offset)*chip_size:(2+col_offset)*chip_size] = cur_img
@@ -133,7 +136,11 @@ device = torch.device("cuda")
 model.to(device)
 
 df = pd.read_csv(csv_path)
-elim_inds = []
+detections = DetectionBuffer.from_dataframe(df)
+if mode in ['full', 'attribute'] and len(df) > 0:
+    for name, dtype, fill in ATTRIBUTE_SCHEMA:
+        detections.add_column(name, dtype, fill)
+keep = numpy.ones((len(df),), dtype=bool)
 
 with torch.no_grad():
     model.eval()
@@ -141,28 +148,12 @@ with torch.no_grad():
         images = images.to(device)
         t = model(images)
         t = [x.cpu() for x in t]
-        pred_length, pred_confidence, pred_correct, pred_source, pred_fishing, pred_vessel = t
 
-        for i, index in enumerate(indexes):
-            index = index.item()
+        # Prune confidence=LOW (in full mode), and update the rest.
+        indexes = indexes.numpy()
+        low, block = get_attribute_updates(t, mode)
+        keep[indexes[low]] = False
+        detections.update(indexes[~low], block)
 
-            # Prune confidence=LOW.
-            if pred_confidence[i, :].argmax() == 0 and mode == 'full':
-                elim_inds.append(index)
-                continue
-
-            df.loc[index, 'vessel_length_m'] = pred_length[i].item()
-
-            if mode in ['full', 'attribute']:
-                df.loc[index, 'fishing_score'] = pred_fishing[i, 1].item()
-                df.loc[index, 'vessel_score'] = pred_vessel[i, 1].item()
-                df.loc[index, 'low_score'] = pred_confidence[i, 0].item()
-                df.loc[index, 'is_fishing'] = (pred_fishing[i, 1] > 0.5).item() & (pred_vessel[i, 1] > 0.5).item()
-                df.loc[index, 'is_vessel'] = (pred_vessel[i, 1] > 0.5).item()
-                df.loc[index, 'correct_score'] = pred_correct[i, 1].item()
-
-            if mode == 'full':
-                df.loc[index, 'score'] = pred_correct[i, 1].item()
-
-df = df.drop(elim_inds)
+df = detections.to_dataframe(keep=keep)
 df.to_csv(out_path, index=False)
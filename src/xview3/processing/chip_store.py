@@ -0,0 +1,304 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from xview3.utils.chip_index import group_by_chip
+
+# A chip store keeps all chips of a scene in one memory-mapped float16 array,
+# instead of one {i}_{fl}.npy file per chip per channel under chips_path/scene_id/fl/.
+# Files written under chips_path/scene_id/:
+#   chips.npy: float16 array of shape (n_chips, n_channels, chip_size, chip_size)
+#   chips_valid.npy: bool array of shape (n_chips, n_channels), False where the chip had no image data
+#   chips_profile.npy: float16 array of shape (n_chips, n_channels, 2, chip_size), the per-row and
+#     per-column maximum of each chip, so a crop window can be chosen without reading the chip
+#   chips.json: channel names and chip offsets; written last, so a store is only used once complete
+STORE_CHIPS = "chips.npy"
+STORE_VALID = "chips_valid.npy"
+STORE_PROFILE = "chips_profile.npy"
+STORE_META = "chips.json"
+
+
+class ChipStore(object):
+    """
+    Read-only view of a scene's chip store.
+    Chips are returned as slices of the memory map, so nothing is read from
+    disk until the chip is actually used.
+    """
+
+    def __init__(self, scene_path):
+        self.scene_path = scene_path
+        with open(os.path.join(scene_path, STORE_META), "r") as f:
+            meta = json.load(f)
+        self.channels = meta["channels"]
+        self.offsets = [tuple(offset) for offset in meta["offsets"]]
+        self.channel_index = {fl: i for i, fl in enumerate(self.channels)}
+        self.chips = np.load(os.path.join(scene_path, STORE_CHIPS), mmap_mode="r")
+        self.valid = np.load(os.path.join(scene_path, STORE_VALID))
+        # Stores written before profiles were added don't have them.
+        self.profiles = None
+        profile_path = os.path.join(scene_path, STORE_PROFILE)
+        if os.path.exists(profile_path):
+            self.profiles = np.load(profile_path, mmap_mode="r")
+
+    def has_channel(self, fl):
+        return fl in self.channel_index
+
+    def has_chip(self, chip_index, fl):
+        chip_index = int(chip_index)
+        if chip_index < 0 or chip_index >= len(self.valid):
+            return False
+        return bool(self.valid[chip_index, self.channel_index[fl]])
+
+    def get_chip(self, chip_index, fl):
+        """
+        Returns the chip as a float16 memory-mapped view, or None if the
+        chip had no image data.
+        """
+        if not self.has_chip(chip_index, fl):
+            return None
+        return self.chips[int(chip_index), self.channel_index[fl]]
+
+    def get_profile(self, chip_index, fl):
+        """
+        Returns the (row_max, col_max) float16 arrays of the chip, or None if
+        the chip had no image data or the store has no profiles.
+        """
+        if self.profiles is None or not self.has_chip(chip_index, fl):
+            return None
+        profile = self.profiles[int(chip_index), self.channel_index[fl]]
+        return profile[0], profile[1]
+
+    def get_chip_indices(self, fl):
+        return set(np.nonzero(self.valid[:, self.channel_index[fl]])[0].tolist())
+
+
+class ChipStoreWriter(object):
+    """
+    Writes a new chip store for a scene, replacing any existing one.
+    """
+
+    def __init__(self, scene_path, channels, offsets, chip_size):
+        self.scene_path = scene_path
+        self.channels = list(channels)
+        self.offsets = [list(offset) for offset in offsets]
+        self.channel_index = {fl: i for i, fl in enumerate(self.channels)}
+
+        os.makedirs(scene_path, exist_ok=True)
+        # Invalidate any existing store until this one is closed.
+        meta_path = os.path.join(scene_path, STORE_META)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        # Chips that are never written (no image data) stay as holes in the
+        # file on filesystems that support sparse files.
+        self.chips = np.lib.format.open_memmap(
+            os.path.join(scene_path, STORE_CHIPS),
+            mode="w+",
+            dtype=np.float16,
+            shape=(len(self.offsets), len(self.channels), chip_size, chip_size),
+        )
+        self.valid = np.zeros((len(self.offsets), len(self.channels)), dtype=bool)
+        self.profiles = np.lib.format.open_memmap(
+            os.path.join(scene_path, STORE_PROFILE),
+            mode="w+",
+            dtype=np.float16,
+            shape=(len(self.offsets), len(self.channels), 2, chip_size),
+        )
+
+    def write(self, chip_index, fl, chip):
+        chip = np.asarray(chip, dtype=np.float16)
+        self.chips[chip_index, self.channel_index[fl]] = chip
+        self.valid[chip_index, self.channel_index[fl]] = True
+        self.profiles[chip_index, self.channel_index[fl], 0] = chip.max(axis=1)
+        self.profiles[chip_index, self.channel_index[fl], 1] = chip.max(axis=0)
+
+    def close(self):
+        self.chips.flush()
+        del self.chips
+        self.profiles.flush()
+        del self.profiles
+        np.save(os.path.join(self.scene_path, STORE_VALID), self.valid)
+        with open(os.path.join(self.scene_path, STORE_META), "w") as f:
+            json.dump({"channels": self.channels, "offsets": self.offsets}, f)
+
+
+# Chip stores by scene path, least recently used first. Each holds an open
+# memory map, and the cache is kept in every DataLoader worker, so it is capped.
+STORE_CACHE_SIZE = 64
+store_cache = collections.OrderedDict()
+
+def get_store(scene_path):
+    """
+    Returns the ChipStore for a scene directory, or None if the scene only
+    has per-chip .npy files. Stores are kept for the STORE_CACHE_SIZE most
+    recently used scenes.
+    """
+    if scene_path in store_cache:
+        store_cache.move_to_end(scene_path)
+        return store_cache[scene_path]
+
+    if os.path.exists(os.path.join(scene_path, STORE_META)):
+        store = ChipStore(scene_path)
+    else:
+        store = None
+
+    store_cache[scene_path] = store
+    while len(store_cache) > STORE_CACHE_SIZE:
+        store_cache.popitem(last=False)
+    return store
+
+
+def get_chip_indices(scene_path, fl):
+    """
+    Returns the set of chip indices with image data for a channel.
+    """
+    store = get_store(scene_path)
+    if store is not None and store.has_channel(fl):
+        return store.get_chip_indices(fl)
+    return set([
+        int(fname.split('_')[0])
+        for fname in os.listdir(os.path.join(scene_path, fl))
+        if fname.endswith('.npy')
+    ])
+
+
+def load_chip(scene_path, fl, chip_index, mmap=False):
+    """
+    Load one chip for a channel, from the chip store if the scene has one
+    and otherwise from the per-chip .npy file.
+    Chips from the store are always memory-mapped; set mmap to also
+    memory-map per-chip .npy files, e.g. when only a few pixels are needed.
+    Returns None if the chip had no image data.
+    """
+    store = get_store(scene_path)
+    if store is not None and store.has_channel(fl):
+        return store.get_chip(chip_index, fl)
+    pth = os.path.join(scene_path, fl, "{}_{}.npy".format(int(chip_index), fl))
+    if not os.path.exists(pth):
+        return None
+    return np.load(pth, mmap_mode="r" if mmap else None)
+
+
+def load_chip_profile(scene_path, fl, chip_index):
+    """
+    Get the per-row and per-column maximum of a chip, as float32 arrays.
+    These are read from the chip store if it has profiles, and otherwise
+    computed from the whole chip.
+    Returns None if the chip had no image data.
+    """
+    store = get_store(scene_path)
+    if store is not None and store.has_channel(fl):
+        profile = store.get_profile(chip_index, fl)
+        if profile is not None:
+            return np.asarray(profile[0], dtype=np.float32), np.asarray(profile[1], dtype=np.float32)
+    chip = load_chip(scene_path, fl, chip_index)
+    if chip is None:
+        return None
+    chip = np.asarray(chip, dtype=np.float32)
+    return chip.max(axis=1), chip.max(axis=0)
+
+
+def gather_chip_pixels(scene_path, fl, chip_lookup, cols, rows):
+    """
+    Read a channel at many scene pixels, loading each chip once.
+    Points are resolved to chips with chip_lookup.find_all, and each chip's
+    pixels are read with one gather from its memory map.
+
+    Args:
+        scene_path (str): chips_path/scene_id
+        fl (str): channel
+        chip_lookup (ChipIndex): chip index of the scene
+        cols, rows (np.ndarray): scene pixel coordinates
+
+    Yields:
+        (positions, values) for each chip with image data, where positions
+        index into cols/rows and values are the chip pixels, in the chip dtype
+    """
+    cols = np.asarray(cols, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    chip_indices = chip_lookup.find_all(cols, rows)
+    for chip_index, positions in group_by_chip(chip_indices):
+        im = load_chip(scene_path, fl, chip_index, mmap=True)
+        if im is None:
+            continue
+        chip_col, chip_row = chip_lookup.offsets[chip_index]
+        yield positions, np.asarray(im[rows[positions] - chip_row, cols[positions] - chip_col])
+
+
+def migrate_scene(info):
+    """
+    Convert a scene's per-chip .npy directories into a chip store.
+    """
+    chips_path, scene_id, remove_npy = info
+    scene_path = os.path.join(chips_path, scene_id)
+
+    with open(os.path.join(scene_path, "coords.json"), "r") as f:
+        offsets = json.load(f)["offsets"]
+
+    # Channels are the subdirectories holding {i}_{fl}.npy files.
+    channels = []
+    channel_chips = {}
+    chip_size = None
+    for fl in sorted(os.listdir(scene_path)):
+        fl_path = os.path.join(scene_path, fl)
+        if not os.path.isdir(fl_path):
+            continue
+        fnames = [fname for fname in os.listdir(fl_path) if fname.endswith("_{}.npy".format(fl))]
+        if not fnames:
+            continue
+        channels.append(fl)
+        channel_chips[fl] = sorted([int(fname.split("_")[0]) for fname in fnames])
+        if chip_size is None:
+            chip_size = np.load(os.path.join(fl_path, fnames[0]), mmap_mode="r").shape[0]
+
+    if not channels:
+        print("{}: no chip directories found, skipping".format(scene_id))
+        return 0
+
+    writer = ChipStoreWriter(scene_path, channels, offsets, chip_size)
+    count = 0
+    for fl in channels:
+        for chip_index in channel_chips[fl]:
+            writer.write(chip_index, fl, np.load(os.path.join(scene_path, fl, "{}_{}.npy".format(chip_index, fl))))
+            count += 1
+    writer.close()
+
+    if remove_npy:
+        for fl in channels:
+            fl_path = os.path.join(scene_path, fl)
+            for fname in os.listdir(fl_path):
+                if fname.endswith("_{}.npy".format(fl)):
+                    os.remove(os.path.join(fl_path, fname))
+            if not os.listdir(fl_path):
+                os.rmdir(fl_path)
+
+    print("{}: migrated {} chips across channels {}".format(scene_id, count, ",".join(channels)))
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert per-chip .npy directories into per-scene chip stores."
+    )
+    parser.add_argument("--chips_path", help="Path to the xView3 chips")
+    parser.add_argument("--scene_ids", help="Comma separated list of scene IDs (default all)", default=None)
+    parser.add_argument("--workers", type=int, help="Number of scenes to convert in parallel", default=4)
+    parser.add_argument("--remove_npy", action="store_true", help="Delete the per-chip .npy files after conversion")
+    args = parser.parse_args()
+
+    if args.scene_ids:
+        scene_ids = args.scene_ids.split(",")
+    else:
+        scene_ids = [
+            scene_id for scene_id in os.listdir(args.chips_path)
+            if os.path.exists(os.path.join(args.chips_path, scene_id, "coords.json"))
+        ]
+
+    p = multiprocessing.Pool(args.workers)
+    counts = p.map(migrate_scene, [(args.chips_path, scene_id, args.remove_npy) for scene_id in scene_ids])
+    p.close()
+    print("migrated {} chips in {} scenes".format(sum(counts), len(scene_ids)))
@@ -1,3 +1,4 @@
+import collections
 import glob
 import json
 import os
@@ -10,21 +11,35 @@ import torch
 from rasterio.enums import Resampling
 
 from xview3.processing.constants import BACKGROUND, FISHING, NONFISHING, NONVESSEL
+from xview3.processing.chip_store import get_chip_indices, load_chip, load_chip_profile
+from xview3.utils.chip_index import load_chip_index
+import xview3.transforms
+from xview3.transforms.augment import Crop, crop_targets, clip_targets
+from xview3.transforms.normalize import TableNormalize
 import xview3.utils
 
 PRECHIPPED_CHANNELS = ["vh","vv","bathymetry","wind_speed","wind_direction","wind_quality","mask","vh_other","google"]
 
+# Per-detection fields needed to build training targets, see SARDataset.build_label_index.
+LABEL_DTYPE = np.dtype([
+    ("columns", np.float64),
+    ("rows", np.float64),
+    ("width", np.float64),
+    ("height", np.float64),
+    ("length", np.float64),
+    ("score", np.float64),
+    ("label", np.int64),
+    ("confidence", np.int64),
+    ("fishing", np.int64),
+    ("vessel", np.int64),
+])
+
 def get_valid_chips(channels, scene_path):
     scene_disk_chips = None
     for fl in channels:
         if fl not in PRECHIPPED_CHANNELS:
             continue
-        fl_path = os.path.join(scene_path, fl)
-        fl_chips = set([
-            int(fname.split('_')[0])
-            for fname in os.listdir(fl_path)
-            if fname.endswith('.npy')
-        ])
+        fl_chips = get_chip_indices(scene_path, fl)
         if scene_disk_chips is None:
             scene_disk_chips = fl_chips
         else:
@@ -34,7 +49,7 @@ def get_valid_chips(channels, scene_path):
 
 def is_near_shore(info):
     chips_path, scene_id, chip_index = info
-    bathymetry = np.load(os.path.join(chips_path, scene_id, 'bathymetry', '{}_bathymetry.npy'.format(chip_index)))
+    bathymetry = load_chip(os.path.join(chips_path, scene_id), 'bathymetry', chip_index)
     if np.count_nonzero(bathymetry < 0) < 200*800:
         return False
     if np.count_nonzero(bathymetry > 0) < 200*800:
@@ -61,33 +76,93 @@ def get_latlon_channel(chips_path, scene_id, chip_index, dim, fl):
         return lons
 
 
-histogram_cache = {}
-def get_histogram_channel(chips_path, scene_id, chip_row, chip_col):
-    if scene_id not in histogram_cache:
-        histogram_cache[scene_id] = pd.read_csv(os.path.join(chips_path, scene_id, 'histogram.csv'))
-
-    df = histogram_cache[scene_id]
-    df = df[
-        (df.detect_scene_row >= chip_row)
-        & (df.detect_scene_row < chip_row+800)
-        & (df.detect_scene_column >= chip_col)
-        & (df.detect_scene_column < chip_col+800)
-    ]
-    histogram = np.zeros((800, 800), dtype='float32')
-    for _, label in df.iterrows():
-        row = label.detect_scene_row - chip_row
-        col = label.detect_scene_column - chip_col
-        histogram[row, col] += 1
+# Scene-level caches are kept in every DataLoader worker, so they are capped
+# and evict the least recently used scene.
+HISTOGRAM_CACHE_SIZE = 32
+OVERLAP_CACHE_SIZE = 256
+
+def lru_get(cache, key, load, max_size):
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    value = load()
+    cache[key] = value
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+    return value
+
+class SceneHistogram(object):
+    """
+    Points from a scene's histogram.csv, grouped by the 800x800 grid cell
+    they fall in so a chip's histogram can be rasterized without scanning the
+    whole scene.
+    """
 
+    def __init__(self, df):
+        self.rows = df.detect_scene_row.to_numpy(dtype=np.int64)
+        self.cols = df.detect_scene_column.to_numpy(dtype=np.int64)
+
+        cell_rows = self.rows // 800
+        cell_cols = self.cols // 800
+        order = np.lexsort((cell_cols, cell_rows))
+        cell_rows = cell_rows[order]
+        cell_cols = cell_cols[order]
+        # Pixel index within the cell, so a cell rasterizes with one bincount.
+        self.pixels = ((self.rows % 800)*800 + self.cols % 800)[order]
+
+        self.cells = {}
+        if len(order) > 0:
+            starts = np.flatnonzero(np.concatenate([
+                [True],
+                (cell_rows[1:] != cell_rows[:-1]) | (cell_cols[1:] != cell_cols[:-1]),
+            ]))
+            ends = np.append(starts[1:], len(order))
+            for start, end in zip(starts, ends):
+                self.cells[(int(cell_rows[start]), int(cell_cols[start]))] = (start, end)
+
+    def get_counts(self, chip_row, chip_col):
+        """
+        Returns the number of points at each pixel of the 800x800 chip at (chip_row, chip_col).
+        """
+        if chip_row % 800 == 0 and chip_col % 800 == 0:
+            cell = self.cells.get((chip_row//800, chip_col//800))
+            if cell is None:
+                return np.zeros((800, 800), dtype='float32')
+            pixels = self.pixels[cell[0]:cell[1]]
+        else:
+            mask = (
+                (self.rows >= chip_row)
+                & (self.rows < chip_row+800)
+                & (self.cols >= chip_col)
+                & (self.cols < chip_col+800)
+            )
+            pixels = (self.rows[mask] - chip_row)*800 + (self.cols[mask] - chip_col)
+        return np.bincount(pixels, minlength=800*800).reshape(800, 800).astype('float32')
+
+histogram_cache = collections.OrderedDict()
+def get_histogram_channel(chips_path, scene_id, chip_row, chip_col):
+    scene_histogram = lru_get(
+        histogram_cache,
+        (chips_path, scene_id),
+        lambda: SceneHistogram(pd.read_csv(os.path.join(chips_path, scene_id, 'histogram.csv'))),
+        HISTOGRAM_CACHE_SIZE,
+    )
+    histogram = scene_histogram.get_counts(chip_row, chip_col)
     return histogram/100
 
-overlap_cache = {}
-def get_overlap_channel(chips_path, scene_id, chip_index):
-    if scene_id not in overlap_cache:
-        with open(os.path.join(chips_path, scene_id, 'histogram.json'), 'r') as f:
-            overlap_cache[scene_id] = json.load(f)
+def load_overlap_counts(chips_path, scene_id):
+    with open(os.path.join(chips_path, scene_id, 'histogram.json'), 'r') as f:
+        return json.load(f)
 
-    count = overlap_cache[scene_id][chip_index]
+overlap_cache = collections.OrderedDict()
+def get_overlap_channel(chips_path, scene_id, chip_index):
+    counts = lru_get(
+        overlap_cache,
+        (chips_path, scene_id),
+        lambda: load_overlap_counts(chips_path, scene_id),
+        OVERLAP_CACHE_SIZE,
+    )
+    count = counts[chip_index]
     im = count*np.ones((800, 800), dtype='float32')
     return im/500
 
@@ -118,6 +193,29 @@ def get_region_id(chips_path, scene_id):
                     region_id_cache[line] = i
     return region_id_cache[scene_id]/4
 
+# Per-chip profiles of the first channel kept by each SARDataset, see get_chip_profile.
+PROFILE_CACHE_SIZE = 4096
+
+def split_crop_transforms(transforms):
+    """
+    Split a Compose into (pre_crop, crop, post_crop) around its Crop transform,
+    so that the crop window can be chosen before the image is read.
+    Only applies if every transform before the Crop is a TableNormalize,
+    which is per-pixel and so can be applied after cropping instead.
+
+    Returns:
+        (pre_crop list, Crop, post_crop list), or None if not applicable
+    """
+    if not isinstance(transforms, xview3.transforms.Compose):
+        return None
+    for i, transform in enumerate(transforms.transforms):
+        if isinstance(transform, Crop):
+            pre_crop = transforms.transforms[:i]
+            if not all(isinstance(t, TableNormalize) for t in pre_crop):
+                return None
+            return pre_crop, transform, transforms.transforms[i+1:]
+    return None
+
 class SARDataset(object):
     """
     Pytorch dataset for working with Sentinel-1 data
@@ -151,6 +249,9 @@ class SARDataset(object):
         histogram_hide_prob=None,
         chip_list=None,
         i2=False,
+        # With span=2 and a Crop transform, choose the crop window before reading
+        # the chips, and only read the parts of chips within the window.
+        lazy_crop=True,
     ):
 
         self.bbox_size = bbox_size
@@ -170,6 +271,11 @@ class SARDataset(object):
         self.i2 = i2
         self.i2_option_cache = {}
 
+        self.crop_transforms = None
+        if lazy_crop and span == 2 and not i2 and channels[0] in PRECHIPPED_CHANNELS and channels[0] != 'wind_direction':
+            self.crop_transforms = split_crop_transforms(transforms)
+        self.profile_cache = collections.OrderedDict()
+
         if custom_annotation_path:
             self.annotation_path = custom_annotation_path
         else:
@@ -273,11 +379,17 @@ class SARDataset(object):
 
         print('loading chip offsets')
         self.chip_offsets = {}
+        self.chip_lookup = {}
         for scene_id, _ in self.chip_indices:
             if scene_id in self.chip_offsets:
                 continue
-            with open(os.path.join(self.chips_path, scene_id, 'coords.json'), 'r') as f:
-                self.chip_offsets[scene_id] = [(col, row) for col, row in json.load(f)['offsets']]
+            self.load_chip_offsets(scene_id)
+
+        self.use_label_index = True
+        self.label_index = None
+        if self.pixel_detections is not None:
+            print('building label index')
+            self.label_index = self.build_label_index()
 
         print(f"Number of Unique Chips: {len(self.chip_indices)}")
         print("Initialization complete")
@@ -298,7 +410,14 @@ class SARDataset(object):
 
         histogram_hide = self.histogram_hide_prob is not None and random.random() < self.histogram_hide_prob
 
-        data = np.ones((len(self.channels), 800*self.span, 800*self.span), dtype=np.float32)
+        if self.crop_transforms is not None:
+            # Pick the crop window now, and only read the chip regions within it.
+            window = self.get_crop_window(scene_id, chip_row, chip_col)
+        else:
+            window = (0, 0, 800*self.span, 800*self.span)
+        left, top, right, bottom = window
+
+        data = np.ones((len(self.channels), bottom-top, right-left), dtype=np.float32)
         for channel_idx, fl in enumerate(self.channels):
             if fl in ['histogram', 'overlap', 'histogram2', 'lon', 'lat']:
                 data[channel_idx, :, :] = -0.5
@@ -309,42 +428,21 @@ class SARDataset(object):
 
         for off_row in range(0, 800*self.span, 800):
             for off_col in range(0, 800*self.span, 800):
+                # Part of this chip within the window.
+                row_start, row_end = max(top, off_row), min(bottom, off_row+800)
+                col_start, col_end = max(left, off_col), min(right, off_col+800)
+                if row_start >= row_end or col_start >= col_end:
+                    continue
+
                 # Determine the chip index for this chip.
                 # Skip chips that are outside the image bounds (leave as -32768).
-                chip_k = (chip_col+off_col, chip_row+off_row)
-                if chip_k not in self.chip_offsets[scene_id]:
+                cur_chip_index = self.chip_lookup[scene_id].get(chip_col+off_col, chip_row+off_row)
+                if cur_chip_index is None:
                     continue
 
-                cur_chip_index = self.chip_offsets[scene_id].index(chip_k)
-
-                for channel_idx, fl in enumerate(self.channels):
-                    if fl in PRECHIPPED_CHANNELS:
-                        pth = f"{self.chips_path}/{scene_id}/{fl}/{int(cur_chip_index)}_{fl}.npy"
-                        if not os.path.exists(pth):
-                            continue
-                        data[channel_idx, off_row:off_row+800, off_col:off_col+800] = np.load(pth)
-                    elif fl == "vv_over_vh":
-                        vv_pth = f"{self.chips_path}/{scene_id}/vv/{int(cur_chip_index)}_vv.npy"
-                        vh_pth = f"{self.chips_path}/{scene_id}/vh/{int(cur_chip_index)}_vh.npy"
-                        vvovervh = np.load(vv_pth) / np.load(vh_pth)
-                        data[channel_idx, off_row:off_row+800, off_col:off_col+800] = np.nan_to_num(vvovervh, nan=0, posinf=0, neginf=0)
-                    elif fl == 'lat' or fl == 'lon':
-                        data[channel_idx, off_row:off_row+800, off_col:off_col+800] = get_latlon_channel(self.chips_path, scene_id, cur_chip_index, 800, fl)
-                    elif fl in ['histogram', 'overlap', 'histogram2']:
-                        if histogram_hide:
-                            continue
-
-                        if fl == 'histogram':
-                            data[channel_idx, off_row:off_row+800, off_col:off_col+800] = get_histogram_channel(self.chips_path, scene_id, chip_row+off_row, chip_col+off_col)
-                        elif fl == 'overlap':
-                            data[channel_idx, off_row:off_row+800, off_col:off_col+800] = get_overlap_channel(self.chips_path, scene_id, cur_chip_index)
-                        elif fl == 'histogram2':
-                            data[channel_idx, off_row:off_row+800, off_col:off_col+800] = get_histogram2_channel(self.chips_path, scene_id, cur_chip_index, chip_row+off_row, chip_col+off_col)
-                    elif fl == 'regionid':
-                        # already set above
-                        pass
-                    else:
-                        print(f"Unknown channel {fl}, cannot parse")
+                src = (slice(row_start-off_row, row_end-off_row), slice(col_start-off_col, col_end-off_col))
+                dst = (slice(row_start-top, row_end-top), slice(col_start-left, col_end-left))
+                self.read_chip(data, scene_id, cur_chip_index, chip_row+off_row, chip_col+off_col, src, dst, histogram_hide)
 
         if self.i2:
             i2_im = self.get_i2(scene_id, chip_index)
@@ -366,69 +464,38 @@ class SARDataset(object):
 
             for off_row in range(0, 800*self.span, 800):
                 for off_col in range(0, 800*self.span, 800):
-                    chip_k = (chip_col+off_col, chip_row+off_row)
-                    if chip_k not in self.chip_offsets[scene_id]:
+                    cur_chip_index = self.chip_lookup[scene_id].get(chip_col+off_col, chip_row+off_row)
+                    if cur_chip_index is None:
                         continue
 
-                    cur_chip_index = self.chip_offsets[scene_id].index(chip_k)
-
-                    detects = self.pixel_detections[
-                        (self.pixel_detections["scene_id"] == scene_id)
-                        & (self.pixel_detections["chip_index"] == cur_chip_index)
-                        & (self.pixel_detections["vessel_class"] != BACKGROUND)
-                    ]
-
-                    for _, detect in detects.iterrows():
-                        if self.use_box_labels:
-                            width = detect.right - detect.left
-                            height = detect.bottom - detect.top
-                            xmin = off_col + detect.columns - width/2
-                            xmax = off_col + detect.columns + width/2
-                            ymin = off_row + detect.rows - height/2
-                            ymax = off_row + detect.rows + height/2
-                        else:
-                            xmin = off_col + detect.columns - self.bbox_size
-                            xmax = off_col + detect.columns + self.bbox_size
-                            ymin = off_row + detect.rows - self.bbox_size
-                            ymax = off_row + detect.rows + self.bbox_size
-
-                        centers.append([off_col + detect.columns, off_row + detect.rows])
-                        boxes.append([xmin, ymin, xmax, ymax])
-                        length_labels.append(detect.vessel_length_m)
-                        score_labels.append(detect.score)
-
-                        if detect.is_fishing == True:
-                            class_labels.append(FISHING)
-                        elif detect.is_vessel == True:
-                            class_labels.append(NONFISHING)
-                        else:
-                            class_labels.append(NONVESSEL)
-
-                        if detect.confidence == 'HIGH':
-                            confidence_labels.append(2)
-                        elif detect.confidence == 'MEDIUM':
-                            confidence_labels.append(1)
-                        elif detect.confidence == 'LOW':
-                            confidence_labels.append(0)
-                        else:
-                            confidence_labels.append(-1)
-
-                        if detect.is_vessel == True and detect.is_fishing == True:
-                            fishing_labels.append(1)
-                        elif detect.is_vessel == True and detect.is_fishing == False:
-                            fishing_labels.append(0)
-                        else:
-                            fishing_labels.append(-1)
-
-                        if detect.is_vessel == True:
-                            vessel_labels.append(1)
-                        elif detect.is_vessel == False:
-                            vessel_labels.append(0)
-                        else:
-                            vessel_labels.append(-1)
-
-            if self.class_map:
-                class_labels = [self.class_map[cls-1] for cls in class_labels]
+                    if self.use_label_index:
+                        chip_targets = self.get_chip_targets(self.label_index.get((scene_id, cur_chip_index)), off_col, off_row)
+                    else:
+                        chip_targets = self.get_chip_targets_loop(scene_id, cur_chip_index, off_col, off_row)
+                    if chip_targets is None:
+                        continue
+
+                    centers.append(chip_targets["centers"])
+                    boxes.append(chip_targets["boxes"])
+                    length_labels.append(chip_targets["length"])
+                    score_labels.append(chip_targets["score"])
+                    class_labels.append(chip_targets["label"])
+                    confidence_labels.append(chip_targets["confidence"])
+                    fishing_labels.append(chip_targets["fishing"])
+                    vessel_labels.append(chip_targets["vessel"])
+
+            if len(boxes) > 0:
+                centers = np.concatenate(centers)
+                boxes = np.concatenate(boxes)
+                class_labels = np.concatenate(class_labels)
+                length_labels = np.concatenate(length_labels)
+                confidence_labels = np.concatenate(confidence_labels)
+                fishing_labels = np.concatenate(fishing_labels)
+                vessel_labels = np.concatenate(vessel_labels)
+                score_labels = np.concatenate(score_labels)
+
+                if self.class_map:
+                    class_labels = np.array(self.class_map, dtype=np.int64)[class_labels-1]
 
             if len(boxes) == 0:
                 centers = torch.zeros((0, 2), dtype=torch.float32)
@@ -476,25 +543,311 @@ class SARDataset(object):
         target["iscrowd"] = torch.zeros((len(boxes),), dtype=torch.int64)
         target["confidence"] = confidence_labels
 
-        if self.transforms is not None:
+        if self.crop_transforms is not None:
+            pre_crop, _, post_crop = self.crop_transforms
+            crop_targets(target, left, top, right, bottom)
+            for transform in pre_crop + post_crop:
+                img, target = transform(img, target)
+        elif self.transforms is not None:
             img, target = self.transforms(img, target)
 
         if self.clip_boxes:
             # Clip to image.
-            target['boxes'] = torch.stack([
-                torch.clip(target['boxes'][:, 0], min=0, max=img.shape[2]),
-                torch.clip(target['boxes'][:, 1], min=0, max=img.shape[1]),
-                torch.clip(target['boxes'][:, 2], min=0, max=img.shape[2]),
-                torch.clip(target['boxes'][:, 3], min=0, max=img.shape[1]),
-            ], dim=1)
+            clip_targets(target, img.shape[1], img.shape[2])
 
         return img, target
 
+    def read_chip(self, data, scene_id, chip_index, chip_row, chip_col, src, dst, histogram_hide):
+        """
+        Read the src (rows, cols) slices of one chip's channels into the dst
+        slices of data. Pre-chipped channels are memory-mapped, so only the
+        rows within src are read from disk.
+
+        Args:
+            data (np.ndarray): (channels, rows, cols) image being loaded
+            chip_index (int): index of the chip in the scene
+            chip_row, chip_col (int): offset of the chip in the scene
+            src, dst (tuple): (row slice, col slice) in the chip and in data
+            histogram_hide (bool): leave the histogram channels unset
+        """
+        scene_path = os.path.join(self.chips_path, scene_id)
+        for channel_idx, fl in enumerate(self.channels):
+            dst_channel = (channel_idx,) + dst
+            if fl in PRECHIPPED_CHANNELS:
+                chip = load_chip(scene_path, fl, chip_index, mmap=True)
+                if chip is None:
+                    continue
+                data[dst_channel] = chip[src]
+            elif fl == "vv_over_vh":
+                vvovervh = load_chip(scene_path, 'vv', chip_index, mmap=True)[src] / load_chip(scene_path, 'vh', chip_index, mmap=True)[src]
+                data[dst_channel] = np.nan_to_num(vvovervh, nan=0, posinf=0, neginf=0)
+            elif fl == 'lat' or fl == 'lon':
+                data[dst_channel] = get_latlon_channel(self.chips_path, scene_id, chip_index, 800, fl)[src]
+            elif fl in ['histogram', 'overlap', 'histogram2']:
+                if histogram_hide:
+                    continue
+
+                if fl == 'histogram':
+                    data[dst_channel] = get_histogram_channel(self.chips_path, scene_id, chip_row, chip_col)[src]
+                elif fl == 'overlap':
+                    data[dst_channel] = get_overlap_channel(self.chips_path, scene_id, chip_index)[src]
+                elif fl == 'histogram2':
+                    data[dst_channel] = get_histogram2_channel(self.chips_path, scene_id, chip_index, chip_row, chip_col)[src]
+            elif fl == 'regionid':
+                # already set above
+                pass
+            else:
+                print(f"Unknown channel {fl}, cannot parse")
+
+    def get_chip_profile(self, scene_id, chip_index):
+        """
+        Get the per-row and per-column maximum of the first channel of a chip
+        after the pre-crop normalization, which is what Crop uses to choose
+        its window. Chips without data (chip_index None) are filled with -32768.
+
+        When the pre-crop normalization of the first channel is monotonic
+        (see TableNormalize.is_monotonic), the maximum of the normalized chip
+        is the normalized raw maximum, so the raw profiles that the chip store
+        keeps from chipping time are used and the chip is not read. Otherwise,
+        and for per-chip .npy files or older stores, the whole chip is read.
+        Profiles are also cached.
+
+        Returns:
+            (row_max, col_max) float32 tensors
+        """
+        def load():
+            scene_path = os.path.join(self.chips_path, scene_id)
+            fl = self.channels[0]
+            # Normalization may use np.random, so keep the draws for the actual image the same.
+            rng_state = np.random.get_state()
+            if chip_index is None:
+                profile = None
+            elif all(transform.is_monotonic(0) for transform in self.crop_transforms[0]):
+                profile = load_chip_profile(scene_path, fl, chip_index)
+            else:
+                chip = load_chip(scene_path, fl, chip_index)
+                profile = None
+                if chip is not None:
+                    im = torch.as_tensor(np.asarray(chip, dtype=np.float32))
+                    for transform in self.crop_transforms[0]:
+                        transform.normalize_channel(im, 0)
+                    np.random.set_state(rng_state)
+                    return im.amax(dim=1), im.amax(dim=0)
+
+            if profile is None:
+                # No data, so the profile of a chip filled with -32768.
+                row_max = torch.full((800,), -32768, dtype=torch.float32)
+                col_max = torch.full((800,), -32768, dtype=torch.float32)
+            else:
+                row_max = torch.as_tensor(profile[0])
+                col_max = torch.as_tensor(profile[1])
+            for transform in self.crop_transforms[0]:
+                transform.normalize_channel(row_max, 0)
+                transform.normalize_channel(col_max, 0)
+            np.random.set_state(rng_state)
+            return row_max, col_max
+
+        return lru_get(self.profile_cache, (scene_id, chip_index), load, PROFILE_CACHE_SIZE)
+
+    def get_crop_window(self, scene_id, chip_row, chip_col):
+        """
+        Choose the crop window for a span=2 image with top-left at (chip_row, chip_col),
+        with the same distribution as applying the Crop transform to the full image.
+
+        Returns:
+            (left, top, right, bottom) in image coordinates
+        """
+        size = 800*self.span
+        row_max = torch.full((size,), -math.inf)
+        col_max = torch.full((size,), -math.inf)
+        for off_row in range(0, size, 800):
+            for off_col in range(0, size, 800):
+                cur_chip_index = self.chip_lookup[scene_id].get(chip_col+off_col, chip_row+off_row)
+                chip_row_max, chip_col_max = self.get_chip_profile(scene_id, cur_chip_index)
+                row_max[off_row:off_row+800] = torch.maximum(row_max[off_row:off_row+800], chip_row_max)
+                col_max[off_col:off_col+800] = torch.maximum(col_max[off_col:off_col+800], chip_col_max)
+        crop = self.crop_transforms[1]
+        left, top, right, bottom = crop.get_window(row_max, col_max, size, size)
+        return int(left), int(top), int(right), int(bottom)
+
+    def load_chip_offsets(self, scene_id):
+        """
+        Load the chip offsets of a scene from coords.json, along with a ChipIndex
+        to look up chips by offset.
+        """
+        chip_lookup = load_chip_index(os.path.join(self.chips_path, scene_id))
+        self.chip_offsets[scene_id] = chip_lookup.offsets
+        self.chip_lookup[scene_id] = chip_lookup
+
+    def build_label_index(self):
+        """
+        Build a map from (scene_id, chip_index) to a LABEL_DTYPE array of the
+        non-background detections in that chip, in pixel_detections order.
+        This way __getitem__ builds targets with array slicing instead of
+        filtering pixel_detections for every sample.
+        """
+        detects = self.pixel_detections[
+            (self.pixel_detections["vessel_class"] != BACKGROUND)
+            & self.pixel_detections["chip_index"].notna()
+        ]
+        labels = self.get_label_array(detects)
+
+        label_index = {}
+        groups = detects.groupby([detects["scene_id"], detects["chip_index"].astype(int)], sort=False).indices
+        for (scene_id, chip_index), inds in groups.items():
+            label_index[(scene_id, int(chip_index))] = labels[inds]
+        return label_index
+
+    def get_label_array(self, detects):
+        """
+        Convert a dataframe of detections to a LABEL_DTYPE array.
+        """
+        is_vessel = detects["is_vessel"] == True
+        not_vessel = detects["is_vessel"] == False
+        is_fishing = detects["is_fishing"] == True
+        not_fishing = detects["is_fishing"] == False
+
+        labels = np.zeros(len(detects), dtype=LABEL_DTYPE)
+        labels["columns"] = detects["columns"].to_numpy(dtype=np.float64)
+        labels["rows"] = detects["rows"].to_numpy(dtype=np.float64)
+        if self.use_box_labels:
+            labels["width"] = (detects["right"] - detects["left"]).to_numpy(dtype=np.float64)
+            labels["height"] = (detects["bottom"] - detects["top"]).to_numpy(dtype=np.float64)
+        labels["length"] = detects["vessel_length_m"].to_numpy(dtype=np.float64)
+        labels["score"] = detects["score"].to_numpy(dtype=np.float64)
+        labels["label"] = np.select([is_fishing, is_vessel], [FISHING, NONFISHING], default=NONVESSEL)
+        labels["confidence"] = np.select(
+            [detects["confidence"] == "HIGH", detects["confidence"] == "MEDIUM", detects["confidence"] == "LOW"],
+            [2, 1, 0],
+            default=-1,
+        )
+        labels["fishing"] = np.select([is_vessel & is_fishing, is_vessel & not_fishing], [1, 0], default=-1)
+        labels["vessel"] = np.select([is_vessel, not_vessel], [1, 0], default=-1)
+        return labels
+
+    def get_chip_targets(self, labels, off_col, off_row):
+        """
+        Get target arrays for a chip's LABEL_DTYPE labels, with the chip at
+        (off_col, off_row) in the sample, or None if there are no labels.
+
+        Returns:
+            dict of centers (n, 2), boxes (n, 4) and n-length arrays for
+            length, score, label, confidence, fishing and vessel
+        """
+        if labels is None or len(labels) == 0:
+            return None
+
+        if self.use_box_labels:
+            half_width = labels["width"]/2
+            half_height = labels["height"]/2
+        else:
+            half_width = self.bbox_size
+            half_height = self.bbox_size
+
+        return {
+            "centers": np.stack([off_col + labels["columns"], off_row + labels["rows"]], axis=1),
+            "boxes": np.stack([
+                off_col + labels["columns"] - half_width,
+                off_row + labels["rows"] - half_height,
+                off_col + labels["columns"] + half_width,
+                off_row + labels["rows"] + half_height,
+            ], axis=1),
+            "length": labels["length"],
+            "score": labels["score"],
+            "label": labels["label"],
+            "confidence": labels["confidence"],
+            "fishing": labels["fishing"],
+            "vessel": labels["vessel"],
+        }
+
+    def get_chip_targets_loop(self, scene_id, chip_index, off_col, off_row):
+        """
+        Like get_chip_targets, but filters pixel_detections and builds the
+        targets row by row. This was the original per-sample implementation,
+        kept for benchmarking.
+        """
+        detects = self.pixel_detections[
+            (self.pixel_detections["scene_id"] == scene_id)
+            & (self.pixel_detections["chip_index"] == chip_index)
+            & (self.pixel_detections["vessel_class"] != BACKGROUND)
+        ]
+
+        centers = []
+        boxes = []
+        class_labels = []
+        length_labels = []
+        confidence_labels = []
+        fishing_labels = []
+        vessel_labels = []
+        score_labels = []
+
+        for _, detect in detects.iterrows():
+            if self.use_box_labels:
+                width = detect.right - detect.left
+                height = detect.bottom - detect.top
+                xmin = off_col + detect.columns - width/2
+                xmax = off_col + detect.columns + width/2
+                ymin = off_row + detect.rows - height/2
+                ymax = off_row + detect.rows + height/2
+            else:
+                xmin = off_col + detect.columns - self.bbox_size
+                xmax = off_col + detect.columns + self.bbox_size
+                ymin = off_row + detect.rows - self.bbox_size
+                ymax = off_row + detect.rows + self.bbox_size
+
+            centers.append([off_col + detect.columns, off_row + detect.rows])
+            boxes.append([xmin, ymin, xmax, ymax])
+            length_labels.append(detect.vessel_length_m)
+            score_labels.append(detect.score)
+
+            if detect.is_fishing == True:
+                class_labels.append(FISHING)
+            elif detect.is_vessel == True:
+                class_labels.append(NONFISHING)
+            else:
+                class_labels.append(NONVESSEL)
+
+            if detect.confidence == 'HIGH':
+                confidence_labels.append(2)
+            elif detect.confidence == 'MEDIUM':
+                confidence_labels.append(1)
+            elif detect.confidence == 'LOW':
+                confidence_labels.append(0)
+            else:
+                confidence_labels.append(-1)
+
+            if detect.is_vessel == True and detect.is_fishing == True:
+                fishing_labels.append(1)
+            elif detect.is_vessel == True and detect.is_fishing == False:
+                fishing_labels.append(0)
+            else:
+                fishing_labels.append(-1)
+
+            if detect.is_vessel == True:
+                vessel_labels.append(1)
+            elif detect.is_vessel == False:
+                vessel_labels.append(0)
+            else:
+                vessel_labels.append(-1)
+
+        if len(boxes) == 0:
+            return None
+        return {
+            "centers": np.array(centers, dtype=np.float64),
+            "boxes": np.array(boxes, dtype=np.float64),
+            "length": np.array(length_labels, dtype=np.float64),
+            "score": np.array(score_labels, dtype=np.float64),
+            "label": np.array(class_labels, dtype=np.int64),
+            "confidence": np.array(confidence_labels, dtype=np.int64),
+            "fishing": np.array(fishing_labels, dtype=np.int64),
+            "vessel": np.array(vessel_labels, dtype=np.int64),
+        }
+
     def get_chip_number(self, scene_id):
         """
         Get number of chips using first channel
         """
-        return len(glob.glob(f"{self.chips_path}/{scene_id}/{self.channels[0]}/*.npy"))
+        return len(get_chip_indices(os.path.join(self.chips_path, scene_id), self.channels[0]))
 
     def add_background_chips(self):
         """
@@ -704,8 +1057,7 @@ class SARDataset(object):
         options = [(scene_id, self.chip_offsets[scene_id][chip_index][0], self.chip_offsets[scene_id][chip_index][1])] # DELETE ME
         for option_idx, (other_scene_id, col_offset, row_offset) in enumerate(options):
             if other_scene_id not in self.chip_offsets:
-                with open(os.path.join(self.chips_path, other_scene_id, 'coords.json'), 'r') as f:
-                    self.chip_offsets[other_scene_id] = [(col, row) for col, row in json.load(f)['offsets']]
+                self.load_chip_offsets(other_scene_id)
 
             #col_offset += random.randint(-32, 32)
             #row_offset += random.randint(-32, 32)
@@ -713,11 +1065,10 @@ class SARDataset(object):
                 cur_col = 800*(col_offset//800+i)
                 cur_row = 800*(row_offset//800+j)
 
-                if (cur_col, cur_row) not in self.chip_offsets[other_scene_id]:
+                other_chip_index = self.chip_lookup[other_scene_id].get(cur_col, cur_row)
+                if other_chip_index is None:
                     continue
 
-                other_chip_index = self.chip_offsets[other_scene_id].index((cur_col, cur_row))
-
                 col_overlap = 800 - abs(col_offset - cur_col)
                 row_overlap = 800 - abs(row_offset - cur_row)
                 src_col_offset = max(col_offset - cur_col, 0)
@@ -725,13 +1076,11 @@ class SARDataset(object):
                 dst_col_offset = max(cur_col - col_offset, 0)
                 dst_row_offset = max(cur_row - row_offset, 0)
 
-                vh_path = os.path.join(self.chips_path, other_scene_id, 'vh/{}_vh.npy'.format(other_chip_index))
-                vv_path = os.path.join(self.chips_path, other_scene_id, 'vv/{}_vv.npy'.format(other_chip_index))
-                if not os.path.exists(vh_path) or not os.path.exists(vv_path):
+                vh = load_chip(os.path.join(self.chips_path, other_scene_id), 'vh', other_chip_index)
+                vv = load_chip(os.path.join(self.chips_path, other_scene_id), 'vv', other_chip_index)
+                if vh is None or vv is None:
                     continue
 
-                vh = np.load(vh_path)
-                vv = np.load(vv_path)
                 vh = np.clip(vh+50, 0, 70)/70
                 vv = np.clip(vv+50, 0, 70)/70
                 im[3*option_idx+0, dst_row_offset:dst_row_offset+row_overlap, dst_col_offset:dst_col_offset+col_overlap] = vh[src_row_offset:src_row_offset+row_overlap, src_col_offset:src_col_offset+col_overlap]
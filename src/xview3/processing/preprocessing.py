@@ -1,5 +1,6 @@
 import glob
 import json
+import multiprocessing
 import os
 import time
 import configparser
@@ -13,65 +14,66 @@ import pandas as pd
 import math
 import rasterio
 from rasterio.enums import Resampling
+from rasterio.windows import Window
 
 from xview3.processing.constants import BACKGROUND, FISHING, NONFISHING, NONVESSEL
+import xview3.processing.chip_store as chip_store
 
-def pad(vh, rows, cols,overlap):
+def get_chip_grid(height, width, chip_size):
     """
-    Pad an image to make it divisible by some block_size.
-    Pad on the right and bottom edges so annotations are still usable.
+    Obtain (col, row) chip origins covering a height x width raster.
+    The raster is treated as if padded on the right and bottom edges to
+    be a multiple of chip_size; chips are ordered row by row.
     """
-    r, c = vh.shape
-    to_rows = math.ceil(r / rows) * rows + overlap * 2
-    to_cols = math.ceil(c / cols) * cols + overlap * 2
-    pad_rows = to_rows - r - overlap
-    pad_cols = to_cols - c - overlap
-    vh_pad = np.pad(
-        vh, pad_width=((overlap, pad_rows), (overlap, pad_cols)), mode="constant", constant_values=0
-    )
-    return vh_pad, pad_rows, pad_cols
+    nrows = math.ceil(height / chip_size)
+    ncols = math.ceil(width / chip_size)
+    return [(x*chip_size, y*chip_size) for y in range(nrows) for x in range(ncols)]
 
 
-def chip_sar_img(input_img, sz, overlap):
+def read_chip(src, chip_row, chip_col, chip_size, overlap, shape):
     """
-    Takes a raster from xView3 as input and outputs
-    a set of chips and the coordinate grid for a
-    given chip size
+    Read one chip (plus overlap on each side) through a rasterio window.
+
+    Pixels outside the raster are filled with 0, so the left/top overlap
+    and the right/bottom padding never have to be materialized for the
+    whole scene. If src does not match shape (the first channel's size),
+    the window is resampled with Resampling.bilinear so that chips from
+    different channels stay co-registered.
 
     Args:
-        input_img (numpy.array): Input image in np.array form
-        sz (int): Size of chip (will be sz x sz x # of channlls)
+        src: open rasterio dataset
+        chip_row, chip_col (int): chip origin from get_chip_grid
+        chip_size (int): chip size without overlap
+        overlap (int): overlap on each side of the chip
+        shape (tuple): (rows, cols) of the first channel
 
     Returns:
-        images: set of image chips
-        images_grid: grid coordinates for each chip
+        chip (numpy.array): (chip_size + 2*overlap) square chip
     """
-    # The input_img is presumed to already be padded
-    images,nrows,ncols = view_as_blocks(input_img, (sz, sz), overlap)
-    images_grid = (nrows,ncols)
-    
-    return images, images_grid
+    step = chip_size + 2 * overlap
+    chip = np.zeros((step, step), dtype=src.dtypes[0])
 
+    # Window in unpadded raster coordinates, clipped to the raster.
+    row_off, col_off = chip_row - overlap, chip_col - overlap
+    r1, r2 = max(row_off, 0), min(row_off + step, shape[0])
+    c1, c2 = max(col_off, 0), min(col_off + step, shape[1])
+    if r2 <= r1 or c2 <= c1:
+        return chip
 
-def view_as_blocks(arr, block_size, overlap):
-    """
-    Break up an image into blocks and return array.
-    """
-    m, n = arr.shape
-    # assume square
-    chip_size,_ = block_size
-    stride = chip_size
-    step = chip_size + 2 * overlap
+    if (src.height, src.width) == tuple(shape):
+        data = src.read(1, window=Window(c1, r1, c2 - c1, r2 - r1))
+    else:
+        scale_row = src.height / shape[0]
+        scale_col = src.width / shape[1]
+        data = src.read(
+            1,
+            window=Window(c1 * scale_col, r1 * scale_row, (c2 - c1) * scale_col, (r2 - r1) * scale_row),
+            out_shape=(r2 - r1, c2 - c1),
+            resampling=Resampling.bilinear,
+        )
 
-    nrows, ncols = (m - 2*overlap) // chip_size, (n - 2*overlap) // chip_size
-    splitted = []
-    for i in range(nrows):
-        for j in range(ncols):
-            h_start = j*stride
-            v_start = i*stride
-            cropped = arr[v_start:v_start+step, h_start:h_start+step]
-            splitted.append(cropped)
-    return splitted,nrows,ncols
+    chip[r1-row_off:r2-row_off, c1-col_off:c2-col_off] = data
+    return chip
 
 
 def find_nearest(lon, lat, x, y):
@@ -84,15 +86,91 @@ def find_nearest(lon, lat, x, y):
     return np.where((X == X.min()) & (Y == Y.min()))
 
 
-def get_grid_coords(padded_img, chips, grids, overlap):
+def get_chip_detections_loop(scene_detects, grid_coords, chip_size, overlap_width):
     """
-    Obtain grid coordinates for chip origins from padded images
+    Convert scene-level detections to chip-level annotations one chip at a time.
+    This is the original implementation, kept for benchmarking against
+    get_chip_detections.
     """
-    chip_size = chips[0].shape[0] - 2*overlap 
-    grid_coords_y = np.linspace(0, padded_img.shape[0] - chip_size - overlap*2, grids[0])
-    grid_coords_x = np.linspace(0, padded_img.shape[1] - chip_size - overlap*2, grids[1])
-    grid_coords = [(int(x), int(y)) for y in grid_coords_y for x in grid_coords_x]
-    return grid_coords
+    chip_detections = pd.DataFrame()
+    for chip in enumerate(grid_coords):
+        c1,c2,r1,r2 = chip[1][0],chip[1][0]+chip_size+overlap_width*2, chip[1][1], chip[1][1]+chip_size+overlap_width*2
+        this_chip_detections = scene_detects[(scene_detects["scene_rows"]>= r1) & (scene_detects["scene_rows"]<= r2) & 
+                                             (scene_detects["scene_cols"]>= c1) & (scene_detects["scene_cols"]<= c2)]
+        for index, det in this_chip_detections.iterrows():
+            det["rows"] = det["scene_rows"] - r1
+            det["columns"] = det["scene_cols"] - c1
+            det["chip_index"] = chip[0]
+            chip_detections = chip_detections.append(det,ignore_index=True)
+    return chip_detections
+
+
+def get_chip_detections(scene_detects, grid_coords, chip_size, overlap_width):
+    """
+    Convert scene-level detections to chip-level annotations in one pass.
+
+    The chip grid is regular, so the chips containing a detection are found
+    with integer division instead of masking the whole scene once per chip.
+    Chip bounds are inclusive on both ends (as in get_chip_detections_loop),
+    so detections on a chip border or inside the overlap are assigned to
+    every chip that contains them. Rows are ordered by chip index, and then
+    by their order in scene_detects, to match the original output.
+
+    Args:
+        scene_detects (pd.DataFrame): detections for one scene, with
+            scene_rows and scene_cols in padded scene coordinates
+        grid_coords (list): (col, row) origin of each chip, from get_grid_coords
+        chip_size (int): chip size without overlap
+        overlap_width (int): overlap on each side of the chip
+
+    Returns:
+        chip_detections (pd.DataFrame): scene_detects rows with rows, columns
+            and chip_index columns added
+    """
+    step = chip_size + 2 * overlap_width
+    grid_cols = np.array(sorted(set(col for col, _ in grid_coords)), dtype=np.int64)
+    grid_rows = np.array(sorted(set(row for _, row in grid_coords)), dtype=np.int64)
+    nrows, ncols = len(grid_rows), len(grid_cols)
+
+    scene_rows = scene_detects["scene_rows"].to_numpy()
+    scene_cols = scene_detects["scene_cols"].to_numpy()
+
+    # First candidate chip row/column for each detection; a detection can
+    # fall in up to max_span chips along each axis.
+    first_row = -((step - scene_rows) // chip_size)
+    first_col = -((step - scene_cols) // chip_size)
+    max_span = step // chip_size + 1
+
+    det_inds, chip_rows, chip_cols = [], [], []
+    for i in range(max_span):
+        for j in range(max_span):
+            r = first_row + i
+            c = first_col + j
+            valid = (r >= 0) & (r < nrows) & (c >= 0) & (c < ncols)
+            det_inds.append(np.nonzero(valid)[0])
+            chip_rows.append(r[valid])
+            chip_cols.append(c[valid])
+    det_inds = np.concatenate(det_inds)
+    chip_rows = np.concatenate(chip_rows).astype(np.int64)
+    chip_cols = np.concatenate(chip_cols).astype(np.int64)
+
+    r1 = grid_rows[chip_rows]
+    c1 = grid_cols[chip_cols]
+    keep = (
+        (scene_rows[det_inds] >= r1) & (scene_rows[det_inds] <= r1 + step)
+        & (scene_cols[det_inds] >= c1) & (scene_cols[det_inds] <= c1 + step)
+    )
+    det_inds, r1, c1 = det_inds[keep], r1[keep], c1[keep]
+    chip_index = chip_rows[keep] * ncols + chip_cols[keep]
+
+    order = np.lexsort((det_inds, chip_index))
+    det_inds, r1, c1, chip_index = det_inds[order], r1[order], c1[order], chip_index[order]
+
+    chip_detections = scene_detects.iloc[det_inds].reset_index(drop=True)
+    chip_detections["rows"] = scene_rows[det_inds] - r1
+    chip_detections["columns"] = scene_cols[det_inds] - c1
+    chip_detections["chip_index"] = chip_index
+    return chip_detections
 
 
 def process_scene(
@@ -105,15 +183,26 @@ def process_scene(
     overwrite_preproc,
     root,
     index,
+    vectorized=True,
+    use_chip_store=False,
 ):
     """
     Preprocess scene by loading images, chipping them,
     saving chips and grid coordinates, converting scene-level to
     chip-level detections, and returning a dataframe with
     information required for training.
+
+    The returned dataframe holds the rows to add to chip_annotations.csv,
+    or is None if the scene was not re-chipped. Writing the CSV is left to
+    the caller so that scenes can be processed in parallel.
+
+    If use_chip_store is set, chips are written to a single per-scene chip
+    store (see xview3.processing.chip_store) rather than one .npy file per
+    chip per channel.
     """
 
     pixel_detections = pd.DataFrame()
+    annotations = None
     no_image_data_count = 0
 
     # If detections file exists, load chip-level annotations for the scene;
@@ -149,54 +238,56 @@ def process_scene(
     files["wind_quality"] = Path(files["vh"]).parent / "owiWindQuality.tif"
     files["mask"] = Path(files["vh"]).parent / "owiMask.tif"
 
-    imgs, chips, grids = {}, {}, {}
+    # Chips are read one window at a time, so memory depends on the chip
+    # size rather than the scene size. All channels are chipped on the grid
+    # of the first channel.
+    scene_shape = None
+
+    # For each channel, if it is already chipped, do not re-chip.
+    # A chip store holds every channel, so it is either reused or rewritten
+    # as a whole.
+    scene_path = os.path.join(chips_path, scene_id)
+    store_writer = None
+    if use_chip_store:
+        store = chip_store.get_store(scene_path)
+        if store is not None and (not overwrite_preproc) and all(store.has_channel(fl) for fl in channels):
+            existing_channels = set(channels)
+        else:
+            existing_channels = set()
+    else:
+        existing_channels = set([
+            fl for fl in channels
+            if os.path.exists(Path(chips_path) / scene_id / fl) and (not overwrite_preproc)
+        ])
 
-    # For each channel, if it is already chipped, do not re-chip
     for fl in channels:
         temp_folder = Path(chips_path) / scene_id / fl
-        if os.path.exists(temp_folder) and (not overwrite_preproc):
+        if fl in existing_channels:
             print(f"Using existing preprocessed {fl} data for scene {scene_id}")
             continue
-        else:
+        elif not use_chip_store:
             os.makedirs(temp_folder, exist_ok=True)
-        src = rasterio.open(files[fl])
-        imgs[fl] = src.read(1)
-
-        # If not same size as first channel, resample before chipping
-        # to ensure chips from different channels are co-registered
-        if not imgs[fl].shape == imgs[channels[0]].shape:
-            imgs[fl] = src.read(
-                out_shape=(
-                    imgs[channels[0]].shape[0],
-                    imgs[channels[0]].shape[1],
-                ),
-                resampling=Resampling.bilinear,
-            ).squeeze()
-        try:
-            assert imgs[fl].shape == imgs[channels[0]].shape
-        except AssertionError as e:
-            print(f"imgs[fl].shape = {imgs[fl].shape}")
-            print(f"imgs[channels[0]].shape = {imgs[channels[0]].shape}")
-            raise AssertionError()
-
-        # Pad the raster to be a multiple of the chip size
-        padded_img, _, _ = pad(imgs[fl], chip_size, chip_size, overlap_width)
-
-        # Get image chips and grids
-        chips[fl], grids[fl] = chip_sar_img(padded_img, chip_size, overlap_width)
+
+        if scene_shape is None:
+            with rasterio.open(files[channels[0]]) as src:
+                scene_shape = (src.height, src.width)
+            grid_coords = get_chip_grid(scene_shape[0], scene_shape[1], chip_size)
+            if use_chip_store:
+                store_writer = chip_store.ChipStoreWriter(scene_path, channels, grid_coords, chip_size + 2*overlap_width)
 
         # Saving chips
-        for i in range(len(chips[fl])):
-            chip = chips[fl][i]
-            if np.max(np.max(chip)) == -32768:
-                no_image_data_count += 1
-                continue
-            np.save(f"{temp_folder}/{i}_{fl}.npy", chip.astype(np.float16))
+        with rasterio.open(files[fl]) as src:
+            for i, (chip_col, chip_row) in enumerate(grid_coords):
+                chip = read_chip(src, chip_row, chip_col, chip_size, overlap_width, scene_shape)
+                if np.max(chip) == -32768:
+                    no_image_data_count += 1
+                    continue
+                if store_writer is not None:
+                    store_writer.write(i, fl, chip.astype(np.float16))
+                else:
+                    np.save(f"{temp_folder}/{i}_{fl}.npy", chip.astype(np.float16))
 
         if fl == channels[0]:
-            # Getting grid coordinates
-            grid_coords = get_grid_coords(padded_img, chips[fl], grids[fl], overlap_width)
-
             # Saving offsets for each chip; these offsets are alsp needed to convert
             # chip-level predictions to scene-level predictions at
             # inference time
@@ -216,35 +307,21 @@ def process_scene(
                 )
 
                 # Convert scene-level detection coordinates to chip-level annotations
+                if vectorized:
+                    chip_detections = get_chip_detections(scene_detects, grid_coords, chip_size, overlap_width)
+                else:
+                    chip_detections = get_chip_detections_loop(scene_detects, grid_coords, chip_size, overlap_width)
+                pixel_detections = pd.concat([pixel_detections, chip_detections], ignore_index=True)
 
-                for chip in enumerate(grid_coords):
-                    c1,c2,r1,r2 = chip[1][0],chip[1][0]+chip_size+overlap_width*2, chip[1][1], chip[1][1]+chip_size+overlap_width*2
-                    this_chip_detections = scene_detects[(scene_detects["scene_rows"]>= r1) & (scene_detects["scene_rows"]<= r2) & 
-                                                         (scene_detects["scene_cols"]>= c1) & (scene_detects["scene_cols"]<= c2)]
-                    for index, det in this_chip_detections.iterrows():
-                        det["rows"] = det["scene_rows"] - r1
-                        det["columns"] = det["scene_cols"] - c1
-                        det["chip_index"] = chip[0]
-                        pixel_detections = pixel_detections.append(det,ignore_index=True)
-                    
                 intcols = ['vessel_class','scene_rows','scene_cols','rows','columns','chip_index','detect_scene_row','detect_scene_column']
 
                 pixel_detections['is_vessel'] = pixel_detections['is_vessel'].replace({0:False, 1:True, np.nan:np.nan})
                 pixel_detections['is_fishing'] = pixel_detections['is_fishing'].replace({0:False, 1:True, np.nan:np.nan})
                 pixel_detections.loc[:, intcols] = pixel_detections.loc[:, intcols].astype(int)
+                annotations = pixel_detections
 
-                if not os.path.exists(f"{chips_path}/chip_annotations.csv"):
-                    pixel_detections.to_csv(
-                        f"{chips_path}/chip_annotations.csv",
-                        mode="w",
-                        header=True,
-                    )
-                else:
-                    pixel_detections.to_csv(
-                        f"{chips_path}/chip_annotations.csv",
-                        mode="a",
-                        header=False,
-                    )
+    if store_writer is not None:
+        store_writer.close()
 
     # Print number of detections per scene; make sure it aligns with
     # number expected
@@ -265,7 +342,14 @@ def process_scene(
     
     print(f"{no_image_data_count} chips across {len(channels)} image channels had no image data and were not saved \n")
 
-    return pixel_detections
+    return annotations
+
+def process_scene_task(info):
+    """
+    Helper for running process_scene in a multiprocessing.Pool.
+    """
+    args, kwargs = info
+    return process_scene(*args, **kwargs)
 
 def main(config):
     image_folder = config.get("locations", "ImageFolder")
@@ -280,6 +364,8 @@ def main(config):
     channels = config.get("chip_params", "Channels").strip().split(",")
     chip_size = config.getint("chip_params", "ChipSize")
     overlap_width = config.getint("chip_params", "OverlapWidth")
+    vectorized = config.getboolean("chip_params", "VectorizedAnnotations", fallback=True)
+    use_chip_store = config.getboolean("chip_params", "ChipStore", fallback=False)
 
     if not use_scene_list:
         scenes = [
@@ -315,19 +401,62 @@ def main(config):
         os.remove(f"{chips_path}/chip_annotations.csv")
 
 
-    start = time.time()
+    # Only send each worker the detections for its own scene.
+    if detections is not None:
+        scene_detections = {scene_id: df for scene_id, df in detections.groupby("scene_id")}
+        empty_detections = detections.iloc[0:0]
+
+    tasks = []
     for jj, scene_id in enumerate(scenes):
-        print(f"Processing scene {jj} of {len(scenes)}...")
-        tmp=process_scene(
-                scene_id,
-                detections,
-                channels,
-                chip_size,
-                overlap_width,
-                chips_path,
-                overwrite_preproc,
-                image_folder,
-                jj,
+        if detections is not None:
+            cur_detections = scene_detections.get(scene_id, empty_detections)
+        else:
+            cur_detections = None
+        tasks.append(((
+            scene_id,
+            cur_detections,
+            channels,
+            chip_size,
+            overlap_width,
+            chips_path,
+            overwrite_preproc,
+            image_folder,
+            jj,
+        ), {'vectorized': vectorized, 'use_chip_store': use_chip_store}))
+
+    start = time.time()
+    all_annotations = []
+    if num_preproc_workers > 1 and len(tasks) > 1:
+        # Each worker holds at most one scene in memory, and is replaced after
+        # every scene so that memory from large rasters is returned to the OS.
+        # imap returns results in scene order, so the CSV matches a serial run.
+        p = multiprocessing.Pool(min(num_preproc_workers, len(tasks)), maxtasksperchild=1)
+        for jj, annotations in enumerate(p.imap(process_scene_task, tasks)):
+            print(f"Finished scene {jj+1} of {len(scenes)}")
+            if annotations is not None:
+                all_annotations.append(annotations)
+        p.close()
+        p.join()
+    else:
+        for jj, task in enumerate(tasks):
+            print(f"Processing scene {jj} of {len(scenes)}...")
+            annotations = process_scene_task(task)
+            if annotations is not None:
+                all_annotations.append(annotations)
+
+    # Write all chip-level annotations at once from the parent process.
+    if all_annotations:
+        if not os.path.exists(f"{chips_path}/chip_annotations.csv"):
+            pd.concat(all_annotations).to_csv(
+                f"{chips_path}/chip_annotations.csv",
+                mode="w",
+                header=True,
+            )
+        else:
+            pd.concat(all_annotations).to_csv(
+                f"{chips_path}/chip_annotations.csv",
+                mode="a",
+                header=False,
             )
 
     el = time.time() - start
@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+
+import torch
+import torch.utils.tensorboard
+
+import xview3.eval.metric
+import xview3.eval.prune
+
+# Score thresholds tried on each validation pass.
+THRESHOLDS = [0.02, 0.05, 0.07, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95]
+
+def evaluate_predictions(pred, gt, gt_incl_low, shore_root):
+    """
+    Prune and score validation predictions from inference_chip.run_eval.
+
+    First scores without near-shore over THRESHOLDS, then adds near-shore on
+    the threshold with highest loc_fscore (if shore_root exists).
+
+    Args:
+        pred (pd.DataFrame): raw predictions
+        gt (pd.DataFrame): HIGH and MEDIUM confidence validation labels
+        gt_incl_low (pd.DataFrame): all validation labels, for dropping predictions matched to LOW labels
+        shore_root (str): path to shoreline contour files
+
+    Returns:
+        val_scores dict, with at least loc_fscore and loc_fscore_shore
+    """
+    if len(pred) == 0:
+        print('got zero predictions, skipping evaluation')
+        return {'loc_fscore': 0.0, 'loc_fscore_shore': 0.0}
+
+    pred = xview3.eval.prune.nms(pred, distance_thresh=10)
+    pred = pred.reset_index(drop=True)
+    pred = xview3.eval.metric.drop_low_confidence_preds(pred, gt_incl_low, costly_dist=True)
+
+    table, _ = xview3.eval.metric.score_thresholds(pred, gt, None, THRESHOLDS, distance_tolerance=200, quiet=True, costly_dist=True)
+    val_scores = table.to_dict('records')[table['loc_fscore'].idxmax()]
+    best_threshold = val_scores.pop('threshold')
+
+    if os.path.exists(shore_root):
+        cur_pred = pred[pred.score >= best_threshold].reset_index(drop=True)
+        val_scores, _ = xview3.eval.metric.score(cur_pred, gt, shore_root=shore_root, distance_tolerance=200, quiet=True, costly_dist=True, with_meta=False)
+
+    return val_scores
+
+def log_scores(summary_writer, val_scores, summary_epoch):
+    for k, v in val_scores.items():
+        summary_writer.add_scalar(k, v, summary_epoch)
+
+def run_worker(requests, results, gt, gt_incl_low, shore_root, log_dir):
+    summary_writer = torch.utils.tensorboard.SummaryWriter(log_dir)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        summary_epoch, pred = request
+        start_time = time.time()
+        try:
+            val_scores = evaluate_predictions(pred, gt, gt_incl_low, shore_root)
+        except Exception:
+            results.put((summary_epoch, None, traceback.format_exc()))
+            continue
+        log_scores(summary_writer, val_scores, summary_epoch)
+        summary_writer.flush()
+        results.put((summary_epoch, val_scores, time.time() - start_time))
+    summary_writer.close()
+
+class EvalWorker(object):
+    """
+    Runs evaluate_predictions and TensorBoard logging of the validation
+    scores in a background process, so that training continues while
+    predictions are pruned and scored.
+
+    The model state at each submission is kept on the CPU until its scores
+    arrive, so the caller can save it as the best checkpoint then.
+    At most max_pending evaluations are in flight; submit waits for the
+    oldest one beyond that.
+    """
+
+    def __init__(self, gt, gt_incl_low, shore_root, log_dir, max_pending=2):
+        self.max_pending = max_pending
+        self.pending = {}
+        # Spawn so the worker does not inherit CUDA state from the training process.
+        ctx = multiprocessing.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=run_worker,
+            args=(self.requests, self.results, gt, gt_incl_low, shore_root, log_dir),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, summary_epoch, pred, state_dict):
+        """
+        Queue predictions from one validation pass.
+
+        Returns:
+            results that had to be waited for (see poll), since only max_pending
+            evaluations can be in flight
+        """
+        finished = []
+        while len(self.pending) >= self.max_pending:
+            finished.extend(self.poll(block=True))
+        self.pending[summary_epoch] = {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+        self.requests.put((summary_epoch, pred))
+        return finished
+
+    def poll(self, block=False):
+        """
+        Collect finished evaluations.
+
+        Args:
+            block (bool): wait for at least one evaluation if any are pending
+
+        Returns:
+            list of (summary_epoch, val_scores, eval_seconds, state_dict)
+        """
+        finished = []
+        while self.pending:
+            try:
+                summary_epoch, val_scores, info = self.results.get(block=block and not finished, timeout=60)
+            except queue.Empty:
+                if block and not finished:
+                    if not self.process.is_alive():
+                        raise Exception('evaluation worker exited with code {}'.format(self.process.exitcode))
+                    continue
+                break
+            if val_scores is None:
+                raise Exception('evaluation of summary_epoch {} failed:\n{}'.format(summary_epoch, info))
+            finished.append((summary_epoch, val_scores, info, self.pending.pop(summary_epoch)))
+        return finished
+
+    def close(self):
+        """
+        Wait for all pending evaluations and stop the worker.
+
+        Returns:
+            the remaining results, like poll
+        """
+        finished = []
+        while self.pending:
+            finished.extend(self.poll(block=True))
+        self.requests.put(None)
+        self.process.join()
+        return finished
@@ -21,8 +21,7 @@ import xview3.training.ema
 import xview3.models
 import xview3.transforms
 import xview3.infer.inference_chip
-import xview3.eval.prune
-import xview3.eval.metric
+import xview3.training.eval_worker
 
 def main(config):
     # data params
@@ -36,6 +35,8 @@ def main(config):
     class_map = config.get("data", "ClassMap", fallback=None)
     transform_names = config.get("data", "Transforms").split(",")
     train_transform_names = config.get("data", "TrainTransforms", fallback="").split(",")
+    # Augmentations to apply to each batch on the device instead of in the loader workers, e.g. Crop800,FlipLR,FlipUD.
+    device_transform_names = config.get("data", "DeviceTransforms", fallback="").split(",")
     background_frac = config.getfloat("data", "BackgroundFrac", fallback=None)
     use_box_labels = config.getboolean("data", "UseBoxLabels", fallback=False)
     bbox_size = config.getint("data", "BboxSize", fallback=5)
@@ -53,6 +54,7 @@ def main(config):
     histogram_hide_prob = config.getfloat("data", "HistogramHideProb", fallback=None)
     chip_list = config.get("data", "ChipList", fallback=None)
     i2 = config.getboolean("data", "I2", fallback=False)
+    lazy_crop = config.getboolean("data", "LazyCrop", fallback=True)
 
     if class_map is not None:
         class_map = [int(cls) for cls in class_map.split(',')]
@@ -74,6 +76,7 @@ def main(config):
     freeze_weights = config.get("training", "FreezeWeights", fallback=None)
     freeze_examples = config.getint("training", "FreezeExamples", fallback=None)
     ema_factor = config.getfloat("training", "EMA", fallback=None)
+    async_eval = config.getboolean("training", "AsyncEval", fallback=True)
 
     transform_info = {
         'channels': channels,
@@ -81,6 +84,7 @@ def main(config):
     }
     transforms = xview3.transforms.get_transforms(transform_names, transform_info)
     train_transforms = xview3.transforms.get_transforms(transform_names + train_transform_names, transform_info)
+    device_transforms = xview3.transforms.get_batch_transforms(device_transform_names, transform_info, clip_boxes=clip_boxes)
 
     # same place, temp for testing
     train_data = SARDataset(
@@ -102,6 +106,7 @@ def main(config):
         histogram_hide_prob=histogram_hide_prob,
         chip_list=chip_list,
         i2=i2,
+        lazy_crop=lazy_crop,
     )
 
     val_data = SARDataset(
@@ -163,6 +168,8 @@ def main(config):
     # instantiate model with a number of classes
     model_cls = xview3.models.models[model_name]
     image_size = train_data[0][0].shape[1]
+    if device_transforms is not None:
+        image_size = device_transforms.output_size(image_size)
     print('image_size={}'.format(image_size))
     model = model_cls(
         num_classes=4,
@@ -247,6 +254,23 @@ def main(config):
     gt = gt[gt.confidence.isin(["HIGH", "MEDIUM"])]
     gt = gt.reset_index(drop=True)
 
+    # Pruning, scoring and logging of validation predictions run in a background
+    # process if async_eval, and best.pth is saved when the scores arrive.
+    # eval_lost_time is the training time spent on evaluation.
+    eval_lost_time = 0.0
+    if async_eval:
+        eval_worker = xview3.training.eval_worker.EvalWorker(gt, gt_incl_low, shore_root, os.path.join(save_path, 'logs'))
+    else:
+        eval_worker = None
+
+    def handle_eval_result(summary_epoch, val_scores, eval_seconds, state_dict):
+        nonlocal best_score
+        val_score = val_scores['loc_fscore'] + val_scores['loc_fscore_shore']/5
+        print('summary_epoch {}: val={} eval_elapsed={}'.format(summary_epoch, val_scores, int(eval_seconds)))
+        if val_score > best_score:
+            torch.save(state_dict, os.path.join(save_path, 'best.pth'))
+            best_score = val_score
+
     if freeze_weights:
         for name, param in model.named_parameters():
             if not name.startswith(freeze_weights):
@@ -265,6 +289,10 @@ def main(config):
         for images, targets in train_loader:
             cur_iterations += 1
 
+            if eval_worker is not None:
+                for result in eval_worker.poll():
+                    handle_eval_result(*result)
+
             #print((time.time()-t00)/cur_iterations)
 
             if freeze_examples and cur_iterations >= freeze_examples // batch_size:
@@ -281,6 +309,9 @@ def main(config):
                 for t in targets
             ]
 
+            if device_transforms is not None:
+                images, targets = device_transforms(images, targets)
+
             if random_resize is not None:
                 resize_factor = random.uniform(-random_resize, random_resize)
                 orig_size = images[0].shape[1]
@@ -364,45 +395,38 @@ def main(config):
                 )
                 model.train()
 
-                if len(pred) > 0:
-                    # Only keep top 4*len(gt) scoring points since otherwise NMS could be too slow.
-                    pred = pred.nlargest(4*len(gt_incl_low), columns='score')
-                    pred = xview3.eval.prune.nms(pred, distance_thresh=10)
-                    pred = pred.reset_index(drop=True)
-                    pred = xview3.eval.metric.drop_low_confidence_preds(pred, gt_incl_low, costly_dist=True)
-
-                    # First test without near-shore. Then add near-shore on the threshold with highest loc_fscore.
-                    val_scores = None
-                    best_threshold = None
-                    for threshold in [0.02, 0.05, 0.07, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95]:
-                        cur_pred = pred[pred.score >= threshold].reset_index(drop=True)
-                        scores, _ = xview3.eval.metric.score(cur_pred, gt, shore_root=None, distance_tolerance=200, quiet=True, costly_dist=True)
-                        if val_scores is None or scores['loc_fscore'] > val_scores['loc_fscore']:
-                            val_scores = scores
-                            best_threshold = threshold
-
-                    if os.path.exists(shore_root):
-                        cur_pred = pred[pred.score >= best_threshold].reset_index(drop=True)
-                        val_scores, _ = xview3.eval.metric.score(cur_pred, gt, shore_root=shore_root, distance_tolerance=200, quiet=True, costly_dist=True)
+                # Model saving.
+                if ema_factor:
+                    state_dict = model.shadow.state_dict()
                 else:
-                    print('got zero predictions, skipping evaluation')
-                    val_scores = {'loc_fscore': 0.0, 'loc_fscore_shore': 0.0}
-
-                val_score = val_scores['loc_fscore'] + val_scores['loc_fscore_shore']/5
+                    state_dict = model.state_dict()
 
                 summary_writer.add_scalar('train_loss', train_loss, summary_epoch)
-                for k, v in val_scores.items():
-                    summary_writer.add_scalar(k, v, summary_epoch)
 
-                print('summary_epoch {}: train_loss={} val={} elapsed={},{} lr={}'.format(
+                if eval_worker is not None:
+                    for result in eval_worker.submit(summary_epoch, pred, state_dict):
+                        handle_eval_result(*result)
+                    val_scores = 'pending'
+                else:
+                    val_scores = xview3.training.eval_worker.evaluate_predictions(pred, gt, gt_incl_low, shore_root)
+                    xview3.training.eval_worker.log_scores(summary_writer, val_scores, summary_epoch)
+
+                eval_lost_time += time.time() - eval_time
+
+                print('summary_epoch {}: train_loss={} val={} elapsed={},{} eval_lost={} ({:.1f}%) lr={}'.format(
                     summary_epoch,
                     train_loss,
                     val_scores,
                     int(eval_time-summary_prev_time),
                     int(time.time()-eval_time),
+                    int(eval_lost_time),
+                    100*eval_lost_time/(time.time()-t00),
                     optimizer.param_groups[0]['lr'],
                 ))
 
+                if eval_worker is None:
+                    handle_eval_result(summary_epoch, val_scores, time.time()-eval_time, state_dict)
+
                 del train_losses[:]
                 summary_epoch += 1
                 summary_prev_time = time.time()
@@ -411,22 +435,24 @@ def main(config):
                 if warmup_lr_scheduler is None:
                     lr_scheduler.step(train_loss)
 
-                # Model saving.
-                if ema_factor:
-                    state_dict = model.shadow.state_dict()
-                else:
-                    state_dict = model.state_dict()
-
                 torch.save(state_dict, os.path.join(save_path, 'last.pth'))
 
-                if val_score > best_score:
-                    torch.save(state_dict, os.path.join(save_path, 'best.pth'))
-                    best_score = val_score
-
                 if summary_epoch%summary_save_freq == 0:
                     checkpoint_path = os.path.join(save_path, f"trained_model_{summary_epoch}_epochs.pth")
                     torch.save(state_dict, checkpoint_path)
 
+    if eval_worker is not None:
+        wait_time = time.time()
+        for result in eval_worker.close():
+            handle_eval_result(*result)
+        eval_lost_time += time.time() - wait_time
+
+    print('training done in {} sec, of which {} sec ({:.1f}%) was spent on evaluation'.format(
+        int(time.time()-t00),
+        int(eval_lost_time),
+        100*eval_lost_time/(time.time()-t00),
+    ))
+
 if __name__ == "__main__":
     config_path = sys.argv[1]
     config = configparser.ConfigParser()
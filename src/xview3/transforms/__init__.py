@@ -1,5 +1,6 @@
 from xview3.transforms.augment import FlipLR, Crop32, Crop224, Crop800, Crop1200, Rotate, Noise, Jitter, Jitter2, FlipUD, Bucket
 from xview3.transforms.normalize import DefaultNormalize, CustomNormalize, CustomNormalize2, CustomNormalize3, MinMaxNormalize
+from xview3.transforms.batch import get_batch_transforms
 
 class Compose(object):
     def __init__(self, transforms):
@@ -10,15 +10,19 @@ class FlipLR(object):
     def __call__(self, image, targets):
         if random.random() < 0.5:
             image = torch.flip(image, dims=[2])
-            targets['centers'][:, 0] = image.shape[2] - targets['centers'][:, 0]
-            targets['boxes'] = torch.stack([
-                image.shape[2] - targets['boxes'][:, 2],
-                targets['boxes'][:, 1],
-                image.shape[2] - targets['boxes'][:, 0],
-                targets['boxes'][:, 3],
-            ], dim=1)
+            flip_targets_lr(targets, image.shape[2])
         return image, targets
 
+def flip_targets_lr(targets, width):
+    targets['centers'][:, 0] = width - targets['centers'][:, 0]
+    targets['boxes'] = torch.stack([
+        width - targets['boxes'][:, 2],
+        targets['boxes'][:, 1],
+        width - targets['boxes'][:, 0],
+        targets['boxes'][:, 3],
+    ], dim=1)
+    return targets
+
 class FlipUD(object):
     def __init__(self, info):
         pass
@@ -26,70 +30,98 @@ class FlipUD(object):
     def __call__(self, image, targets):
         if random.random() < 0.5:
             image = torch.flip(image, dims=[1])
-            targets['centers'][:, 1] = image.shape[1] - targets['centers'][:, 1]
-            targets['boxes'] = torch.stack([
-                targets['boxes'][:, 0],
-                image.shape[1] - targets['boxes'][:, 3],
-                targets['boxes'][:, 2],
-                image.shape[1] - targets['boxes'][:, 1],
-            ], dim=1)
+            flip_targets_ud(targets, image.shape[1])
         return image, targets
 
+def flip_targets_ud(targets, height):
+    targets['centers'][:, 1] = height - targets['centers'][:, 1]
+    targets['boxes'] = torch.stack([
+        targets['boxes'][:, 0],
+        height - targets['boxes'][:, 3],
+        targets['boxes'][:, 2],
+        height - targets['boxes'][:, 1],
+    ], dim=1)
+    return targets
+
 class Crop(object):
     def __init__(self, info, amount):
         self.amount = amount
 
-    def __call__(self, image, targets):
-        target_size = image.shape[1] - self.amount
+    def get_window(self, x_valid, y_valid, height, width):
+        '''
+        Choose a random crop window, given the per-row (x_valid) and per-column
+        (y_valid) maximum of the first channel of a (height, width) image.
+        Returns (left, top, right, bottom).
+        '''
+        target_size = height - self.amount
 
-        # Assume vh is first channel.
-        x_valid = image[0, :, :].amax(axis=1)
-        y_valid = image[0, :, :].amax(axis=0)
         if len(x_valid) > 0 and len(y_valid) > 0:
             sx = torch.nonzero(x_valid)[0]
             ex = torch.nonzero(x_valid)[-1]+1
             sy = torch.nonzero(y_valid)[0]
             ey = torch.nonzero(y_valid)[-1]+1
         else:
-            sx, ex, sy, ey = 0, image.shape[2], 0, image.shape[1]
+            sx, ex, sy, ey = 0, width, 0, height
 
         sx = max(0, sx-target_size)
-        ex = min(image.shape[2], ex+target_size)
+        ex = min(width, ex+target_size)
         sy = max(0, sy-target_size)
-        ey = min(image.shape[1], ey+target_size)
+        ey = min(height, ey+target_size)
 
         left = random.randint(sx, ex-target_size)
         right = left + target_size
         top = random.randint(sy, ey-target_size)
         bottom = top + target_size
-        image = image[:, top:bottom, left:right]
-
-        if len(targets['boxes']) == 0:
-            return image, targets
-
-        valid_indices = (targets['centers'][:, 0] > left) & (targets['centers'][:, 0] < right) & (targets['centers'][:, 1] > top) & (targets['centers'][:, 1] < bottom)
-        targets['centers'] = targets['centers'][valid_indices, :].contiguous()
-        targets['boxes'] = targets['boxes'][valid_indices, :].contiguous()
-        targets['labels'] = targets['labels'][valid_indices].contiguous()
-        targets['length_labels'] = targets['length_labels'][valid_indices].contiguous()
-        targets['confidence_labels'] = targets['confidence_labels'][valid_indices].contiguous()
-        targets['fishing_labels'] = targets['fishing_labels'][valid_indices].contiguous()
-        targets['vessel_labels'] = targets['vessel_labels'][valid_indices].contiguous()
-        targets['score_labels'] = targets['score_labels'][valid_indices].contiguous()
-
-        targets['centers'][:, 0] -= left
-        targets['centers'][:, 1] -= top
-        targets['boxes'][:, 0] -= left
-        targets['boxes'][:, 1] -= top
-        targets['boxes'][:, 2] -= left
-        targets['boxes'][:, 3] -= top
-
-        # Weird special case.
-        if len(targets['boxes']) == 0:
-            targets['labels'] = torch.zeros((1,), dtype=torch.int64)
+        return left, top, right, bottom
 
+    def __call__(self, image, targets):
+        # Assume vh is first channel.
+        x_valid = image[0, :, :].amax(axis=1)
+        y_valid = image[0, :, :].amax(axis=0)
+        left, top, right, bottom = self.get_window(x_valid, y_valid, image.shape[1], image.shape[2])
+        image = image[:, top:bottom, left:right]
+        crop_targets(targets, left, top, right, bottom)
         return image, targets
 
+# Labels of targets, which are pruned along with centers and boxes.
+LABEL_KEYS = ['labels', 'length_labels', 'confidence_labels', 'fishing_labels', 'vessel_labels', 'score_labels']
+
+def select_targets(targets, valid_indices):
+    for k in LABEL_KEYS:
+        targets[k] = targets[k][valid_indices].contiguous()
+    return targets
+
+def crop_targets(targets, left, top, right, bottom):
+    if len(targets['boxes']) == 0:
+        return targets
+
+    valid_indices = (targets['centers'][:, 0] > left) & (targets['centers'][:, 0] < right) & (targets['centers'][:, 1] > top) & (targets['centers'][:, 1] < bottom)
+    targets['centers'] = targets['centers'][valid_indices, :].contiguous()
+    targets['boxes'] = targets['boxes'][valid_indices, :].contiguous()
+    select_targets(targets, valid_indices)
+
+    targets['centers'][:, 0] -= left
+    targets['centers'][:, 1] -= top
+    targets['boxes'][:, 0] -= left
+    targets['boxes'][:, 1] -= top
+    targets['boxes'][:, 2] -= left
+    targets['boxes'][:, 3] -= top
+
+    # Weird special case.
+    if len(targets['boxes']) == 0:
+        targets['labels'] = torch.zeros((1,), dtype=torch.int64, device=targets['boxes'].device)
+
+    return targets
+
+def clip_targets(targets, height, width):
+    targets['boxes'] = torch.stack([
+        torch.clip(targets['boxes'][:, 0], min=0, max=width),
+        torch.clip(targets['boxes'][:, 1], min=0, max=height),
+        torch.clip(targets['boxes'][:, 2], min=0, max=width),
+        torch.clip(targets['boxes'][:, 3], min=0, max=height),
+    ], dim=1)
+    return targets
+
 class Crop32(Crop):
     def __init__(self, info):
         super(Crop32, self).__init__(info, amount=32)
@@ -114,49 +146,47 @@ class Rotate(object):
         angle_deg = random.randint(0, 359)
         angle_rad = angle_deg * math.pi / 180
         image = torchvision.transforms.functional.rotate(image, angle_deg)
-
-        if len(targets['boxes']) == 0:
-            return image, targets
-
-        im_center = (image.shape[2]//2, image.shape[1]//2)
-        # Subtract center.
-        centers = torch.stack([
-            targets['centers'][:, 0] - im_center[0],
-            targets['centers'][:, 1] - im_center[1],
-        ], dim=1)
-        # Rotate around origin.
-        centers = torch.stack([
-            math.sin(angle_rad)*centers[:, 1] + math.cos(angle_rad)*centers[:, 0],
-            math.cos(angle_rad)*centers[:, 1] - math.sin(angle_rad)*centers[:, 0],
-        ], dim=1)
-        # Add back the center.
-        centers = torch.stack([
-            centers[:, 0] + im_center[0],
-            centers[:, 1] + im_center[1],
-        ], dim=1)
-        # Prune ones outside image window.
-        valid_indices = (centers[:, 0] > 0) & (centers[:, 0] < image.shape[2]) & (centers[:, 1] > 0) & (centers[:, 1] < image.shape[1])
-        centers = centers[valid_indices, :].contiguous()
-        targets['centers'] = centers
-        targets['boxes'] = torch.stack([
-            centers[:, 0] - self.bbox_size,
-            centers[:, 1] - self.bbox_size,
-            centers[:, 0] + self.bbox_size,
-            centers[:, 1] + self.bbox_size,
-        ], dim=1)
-        targets['labels'] = targets['labels'][valid_indices].contiguous()
-        targets['length_labels'] = targets['length_labels'][valid_indices].contiguous()
-        targets['confidence_labels'] = targets['confidence_labels'][valid_indices].contiguous()
-        targets['fishing_labels'] = targets['fishing_labels'][valid_indices].contiguous()
-        targets['vessel_labels'] = targets['vessel_labels'][valid_indices].contiguous()
-        targets['score_labels'] = targets['score_labels'][valid_indices].contiguous()
-
-        # Weird special case.
-        if len(targets['boxes']) == 0:
-            targets['labels'] = torch.zeros((1,), dtype=torch.int64)
-
+        rotate_targets(targets, angle_rad, image.shape[2], image.shape[1], self.bbox_size)
         return image, targets
 
+def rotate_targets(targets, angle_rad, width, height, bbox_size):
+    if len(targets['boxes']) == 0:
+        return targets
+
+    im_center = (width//2, height//2)
+    # Subtract center.
+    centers = torch.stack([
+        targets['centers'][:, 0] - im_center[0],
+        targets['centers'][:, 1] - im_center[1],
+    ], dim=1)
+    # Rotate around origin.
+    centers = torch.stack([
+        math.sin(angle_rad)*centers[:, 1] + math.cos(angle_rad)*centers[:, 0],
+        math.cos(angle_rad)*centers[:, 1] - math.sin(angle_rad)*centers[:, 0],
+    ], dim=1)
+    # Add back the center.
+    centers = torch.stack([
+        centers[:, 0] + im_center[0],
+        centers[:, 1] + im_center[1],
+    ], dim=1)
+    # Prune ones outside image window.
+    valid_indices = (centers[:, 0] > 0) & (centers[:, 0] < width) & (centers[:, 1] > 0) & (centers[:, 1] < height)
+    centers = centers[valid_indices, :].contiguous()
+    targets['centers'] = centers
+    targets['boxes'] = torch.stack([
+        centers[:, 0] - bbox_size,
+        centers[:, 1] - bbox_size,
+        centers[:, 0] + bbox_size,
+        centers[:, 1] + bbox_size,
+    ], dim=1)
+    select_targets(targets, valid_indices)
+
+    # Weird special case.
+    if len(targets['boxes']) == 0:
+        targets['labels'] = torch.zeros((1,), dtype=torch.int64, device=targets['boxes'].device)
+
+    return targets
+
 class Noise(object):
     def __init__(self, info):
         pass
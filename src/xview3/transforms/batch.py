@@ -0,0 +1,249 @@
+'''
+Batched versions of the augmentations in augment.py.
+
+They run on a (batch, channels, height, width) tensor, on whatever device it is
+on, so that they can be applied in the training loop after images are moved to
+the GPU instead of per sample in the DataLoader workers.
+Random parameters are drawn independently for each sample, with the same
+distribution as the per-sample transform, and targets (a list of dicts, one per
+sample) are updated with the same helpers.
+'''
+
+import math
+import random
+import torch
+
+from xview3.transforms.augment import flip_targets_lr, flip_targets_ud, crop_targets, rotate_targets, clip_targets
+
+class BatchFlipLR(object):
+    def __init__(self, info):
+        pass
+
+    def __call__(self, images, targets):
+        flip = [random.random() < 0.5 for _ in targets]
+        if not any(flip):
+            return images, targets
+        mask = torch.tensor(flip, device=images.device)
+        images = torch.where(mask[:, None, None, None], torch.flip(images, dims=[3]), images)
+        for target, cur_flip in zip(targets, flip):
+            if cur_flip:
+                flip_targets_lr(target, images.shape[3])
+        return images, targets
+
+class BatchFlipUD(object):
+    def __init__(self, info):
+        pass
+
+    def __call__(self, images, targets):
+        flip = [random.random() < 0.5 for _ in targets]
+        if not any(flip):
+            return images, targets
+        mask = torch.tensor(flip, device=images.device)
+        images = torch.where(mask[:, None, None, None], torch.flip(images, dims=[2]), images)
+        for target, cur_flip in zip(targets, flip):
+            if cur_flip:
+                flip_targets_ud(target, images.shape[2])
+        return images, targets
+
+def get_valid_bounds(valid):
+    '''
+    Returns (start, end) tensors with the first and one past the last True
+    index in each row of the (batch, n) valid mask, or (0, n) if none are True.
+    '''
+    n = valid.shape[1]
+    indices = torch.arange(n, device=valid.device)
+    start = torch.where(valid, indices, n).amin(dim=1)
+    end = torch.where(valid, indices, -1).amax(dim=1) + 1
+    any_valid = valid.any(dim=1)
+    start = torch.where(any_valid, start, 0)
+    end = torch.where(any_valid, end, n)
+    return start, end
+
+class BatchCrop(object):
+    def __init__(self, info, amount):
+        self.amount = amount
+
+    def output_size(self, size):
+        return size - self.amount
+
+    def get_windows(self, images):
+        '''
+        Choose a random crop window for each image of the batch, like Crop.get_window.
+        Returns (left, top) tensors of shape (batch,).
+        '''
+        batch_size, _, height, width = images.shape
+        target_size = height - self.amount
+
+        # Like Crop, the crop is kept near pixels where the first channel is non-zero.
+        vh = images[:, 0, :, :]
+        sx, ex = get_valid_bounds(vh.amax(dim=2) != 0)
+        sx = torch.clip(sx - target_size, min=0)
+        ex = torch.clip(ex + target_size, max=width)
+        sy, ey = get_valid_bounds(vh.amax(dim=1) != 0)
+        sy = torch.clip(sy - target_size, min=0)
+        ey = torch.clip(ey + target_size, max=height)
+
+        # Uniform integer offsets in [start, end-target_size], like random.randint.
+        def randint(start, end):
+            u = torch.rand((batch_size,), device=images.device)
+            return start + torch.floor(u * (end - target_size - start + 1).float()).long()
+        left = randint(sx, ex)
+        top = randint(sy, ey)
+        return left, top
+
+    def __call__(self, images, targets):
+        batch_size, _, height, width = images.shape
+        target_size = height - self.amount
+        left, top = self.get_windows(images)
+
+        # Gather all crops with one indexing op.
+        offsets = torch.arange(target_size, device=images.device)
+        rows = top[:, None] + offsets[None, :]
+        cols = left[:, None] + offsets[None, :]
+        batch_indices = torch.arange(batch_size, device=images.device)
+        images = images[batch_indices[:, None, None], :, rows[:, :, None], cols[:, None, :]]
+        images = images.permute(0, 3, 1, 2).contiguous()
+
+        for target, cur_left, cur_top in zip(targets, left.tolist(), top.tolist()):
+            crop_targets(target, cur_left, cur_top, cur_left+target_size, cur_top+target_size)
+        return images, targets
+
+class BatchCrop32(BatchCrop):
+    def __init__(self, info):
+        super(BatchCrop32, self).__init__(info, 32)
+
+class BatchCrop224(BatchCrop):
+    def __init__(self, info):
+        super(BatchCrop224, self).__init__(info, 224)
+
+class BatchCrop800(BatchCrop):
+    def __init__(self, info):
+        super(BatchCrop800, self).__init__(info, 800)
+
+class BatchCrop1200(BatchCrop):
+    def __init__(self, info):
+        super(BatchCrop1200, self).__init__(info, 1200)
+
+class BatchRotate(object):
+    def __init__(self, info):
+        self.bbox_size = info['bbox_size']
+
+    def __call__(self, images, targets):
+        batch_size, _, height, width = images.shape
+        angles_deg = [random.randint(0, 359) for _ in targets]
+        angles_rad = [angle_deg * math.pi / 180 for angle_deg in angles_deg]
+
+        # Sample each output pixel from the input pixel that rotates onto it,
+        # using nearest interpolation and zero fill like Rotate.
+        # The grid is in [-1, 1] coordinates centered on the image.
+        # This matches torchvision rotate only up to interpolation: a small
+        # fraction of pixels (well under 1e-3 at 800x800, up to a few 1e-3 on
+        # small images), whose rotated position is almost exactly between two
+        # input pixels, take the neighboring pixel instead.
+        angles = torch.tensor(angles_rad, dtype=images.dtype, device=images.device)
+        cos = torch.cos(angles)
+        sin = torch.sin(angles)
+        zeros = torch.zeros_like(angles)
+        theta = torch.stack([
+            torch.stack([cos, -sin*height/width, zeros], dim=1),
+            torch.stack([sin*width/height, cos, zeros], dim=1),
+        ], dim=1)
+        grid = torch.nn.functional.affine_grid(theta, images.shape, align_corners=False)
+        images = torch.nn.functional.grid_sample(images, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+        for target, angle_rad in zip(targets, angles_rad):
+            rotate_targets(target, angle_rad, width, height, self.bbox_size)
+        return images, targets
+
+class BatchNoise(object):
+    def __init__(self, info):
+        pass
+
+    def __call__(self, images, targets):
+        images = images + 0.1*torch.randn_like(images)
+        images = torch.clip(images, min=0, max=1)
+        return images, targets
+
+class BatchJitter(object):
+    def __init__(self, info):
+        self.scale = 0.4
+
+    def __call__(self, images, targets):
+        jitter = self.scale*(torch.rand(images.shape[0:2], device=images.device)-0.5)
+        images = images + jitter[:, :, None, None]
+        images = torch.clip(images, min=0, max=1)
+        return images, targets
+
+class BatchJitter2(BatchJitter):
+    def __init__(self, info):
+        self.scale = 0.1
+
+# Per-sample transform name to its batched version.
+BATCH_TRANSFORMS = {
+    'FlipLR': BatchFlipLR,
+    'FlipUD': BatchFlipUD,
+    'Crop32': BatchCrop32,
+    'Crop224': BatchCrop224,
+    'Crop800': BatchCrop800,
+    'Crop1200': BatchCrop1200,
+    'Rotate': BatchRotate,
+    'Noise': BatchNoise,
+    'Jitter': BatchJitter,
+    'Jitter2': BatchJitter2,
+}
+
+class BatchCompose(object):
+    def __init__(self, transforms, clip_boxes=False):
+        self.transforms = transforms
+        self.clip_boxes = clip_boxes
+
+    def output_size(self, size):
+        '''
+        Returns the image size after these transforms, given the input size.
+        '''
+        for transform in self.transforms:
+            if hasattr(transform, 'output_size'):
+                size = transform.output_size(size)
+        return size
+
+    def __call__(self, images, targets):
+        '''
+        Apply the transforms to a batch.
+
+        Args:
+            images: list of (channels, height, width) tensors with the same shape, or a stacked tensor
+            targets: list of target dicts, which are updated in place
+
+        Returns:
+            (images, targets) where images is a list of tensors
+        '''
+        if isinstance(images, (list, tuple)):
+            images = torch.stack(images, dim=0)
+        for transform in self.transforms:
+            images, targets = transform(images, targets)
+        if self.clip_boxes:
+            # Like SARDataset with clip_boxes, clip to the transformed image,
+            # since the loader only clipped to the image before these transforms.
+            for target in targets:
+                clip_targets(target, images.shape[2], images.shape[3])
+        return list(images.unbind(dim=0)), targets
+
+def get_batch_transforms(names, info, clip_boxes=False):
+    '''
+    Get a BatchCompose of the batched versions of the named per-sample transforms
+    (e.g. Crop800,FlipLR,FlipUD), or None if names is empty.
+    With clip_boxes, boxes are clipped to the image after the transforms.
+    '''
+    transforms = []
+    for name in names:
+        name = name.strip()
+        if not name:
+            continue
+        if name not in BATCH_TRANSFORMS:
+            raise Exception('transform {} has no batched version (supported: {})'.format(name, ','.join(BATCH_TRANSFORMS.keys())))
+        transforms.append(BATCH_TRANSFORMS[name](info))
+
+    if transforms:
+        return BatchCompose(transforms, clip_boxes=clip_boxes)
+    else:
+        return None
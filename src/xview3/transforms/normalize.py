@@ -1,9 +1,168 @@
 import numpy as np
 import torch
 
-class DefaultNormalize(object):
+class TableNormalize(object):
+    '''
+    Fused per-channel normalization.
+
+    Subclasses define get_params, which gives the operations for one channel.
+    These are resolved once into a table for the channels in info['channels'],
+    and each image is then normalized in place, with no temporary images:
+        x = random value where x < 0 or x > 360 (wind_direction only)
+        x = clip(x, clip_min, clip_max)
+        x = invalid_value where the unclipped x <= invalid_thresh
+        x = cbrt(x) if cbrt
+        x = (x + offset) / divisor
+    Steps that would not change a channel are skipped.
+
+    This runs on whatever device the image is on, so it can also be applied
+    to a batch on the GPU after transfer (see normalize).
+    '''
+
+    def __init__(self, info):
+        self.channels = info['channels']
+        self.table = []
+        for ch, channel in enumerate(self.channels):
+            params = self.get_params(channel)
+            if channel == 'wind_direction':
+                params['wind_direction'] = True
+            if params:
+                self.table.append((ch, params))
+
+    def get_params(self, channel):
+        return {}
+
+    def normalize(self, image):
+        '''
+        Normalize a (channels, rows, cols) or (batch, channels, rows, cols) float tensor in place.
+        Off the CPU, cbrt is computed with torch ops, which may differ from np.cbrt in the last bit.
+        For a batch, the wind_direction fill is drawn per image, in the same order as normalizing
+        the images one at a time.
+        '''
+        channel_dim = image.dim() - 3
+        for ch, params in self.table:
+            self.apply(image.select(channel_dim, ch), params)
+        return image
+
+    def normalize_channel(self, cur, ch):
+        '''
+        Normalize a (rows, cols) float tensor in place as channel ch.
+        '''
+        for table_ch, params in self.table:
+            if table_ch == ch:
+                self.apply(cur, params)
+        return cur
+
+    def is_monotonic(self, ch):
+        '''
+        Whether normalizing channel ch never decreases with the input value,
+        so that normalizing the maximum of some pixels gives the maximum of
+        the normalized pixels.
+        '''
+        for table_ch, params in self.table:
+            if table_ch != ch:
+                continue
+            if params.get('wind_direction') or params.get('divisor', 1) < 0:
+                return False
+            if 'invalid_thresh' in params:
+                # Invalid pixels must not end up above the smallest valid value.
+                lowest_valid = params.get('clip_min', params['invalid_thresh'])
+                if params['invalid_value'] > lowest_valid:
+                    return False
+        return True
+
+    def apply(self, cur, params):
+        if params.get('wind_direction'):
+            # Same random draws as the per-channel classes, one per bound per image,
+            # so each image of a (batch, rows, cols) channel gets its own draws.
+            for image in (cur.unbind(0) if cur.dim() == 3 else [cur]):
+                image.masked_fill_(image < 0, np.random.randint(0, 360, size=1).item())
+                image.masked_fill_(image > 360, np.random.randint(0, 360, size=1).item())
+
+        if 'invalid_thresh' in params:
+            invalid = cur <= params['invalid_thresh']
+        if 'clip_min' in params or 'clip_max' in params:
+            cur.clamp_(min=params.get('clip_min'), max=params.get('clip_max'))
+        if 'invalid_thresh' in params:
+            cur.masked_fill_(invalid, params['invalid_value'])
+
+        if params.get('cbrt'):
+            if cur.device.type != 'cpu':
+                cur.copy_(torch.sign(cur) * torch.abs(cur).pow(1/3))
+            else:
+                # np.cbrt directly on the tensor memory, to match the per-channel classes exactly.
+                np.cbrt(cur.numpy(), out=cur.numpy())
+
+        if 'offset' in params:
+            cur.add_(params['offset'])
+        if 'divisor' in params:
+            cur.div_(params['divisor'])
+
+    def __call__(self, image, targets):
+        return self.normalize(image), targets
+
+class DefaultNormalize(TableNormalize):
+    '''
+    Apply the normalization from reference model.
+    '''
+
+    def get_params(self, channel):
+        if channel == "wind_direction":
+            return {'offset': -180}
+        if channel == "wind_speed":
+            return {'clip_min': 0, 'clip_max': 100}
+        if channel in ["vh", "vv", "vh_other"]:
+            return {'clip_min': -50}
+        return {}
+
+class CustomNormalize(TableNormalize):
+    '''
+    Normalization that retains invalid pixel values and incorporates bathymetry.
+    Also makes values close to [-1, 1].
+    '''
+
+    def get_params(self, channel):
+        if channel == "wind_direction":
+            return {'offset': -180, 'divisor': 360}
+        if channel == "wind_speed":
+            return {'clip_min': 0, 'clip_max': 100}
+        if channel in ["vh", "vv", "vh_other"]:
+            return {'clip_min': -50, 'invalid_thresh': -30000, 'invalid_value': -100, 'divisor': 50}
+        if channel == "bathymetry":
+            return {'clip_min': -5000, 'invalid_thresh': -30000, 'invalid_value': -10000, 'divisor': 5000}
+        return {}
+
+class CustomNormalize2(TableNormalize):
+    '''
+    Like CustomNormalize, but doesn't separate out invalid pixels, and output
+    values are in [0, 1].
+    '''
+
+    def get_params(self, channel):
+        if channel == "wind_direction":
+            return {'offset': -180, 'divisor': 360}
+        if channel == "wind_speed":
+            return {'clip_min': 0, 'clip_max': 100, 'divisor': 100}
+        if channel in ["vh", "vv", "vh_other"]:
+            return {'clip_min': -50, 'clip_max': 20, 'offset': 50, 'divisor': 70}
+        if channel == "bathymetry":
+            return {'clip_min': -6000, 'clip_max': 2000, 'offset': 6000, 'divisor': 8000}
+        return {}
+
+class CustomNormalize3(CustomNormalize2):
+    '''
+    Like CustomNormalize2, but use sigmoid for bathymetry.
+    '''
+
+    def get_params(self, channel):
+        if channel == "bathymetry":
+            return {'clip_min': -6000, 'clip_max': 2000, 'cbrt': True, 'offset': 18.2, 'divisor': 31}
+        return super().get_params(channel)
+
+class DefaultNormalizeLoop(object):
     '''
     Apply the normalization from reference model.
+    Original per-channel implementation of DefaultNormalize, kept for benchmarks.
     '''
 
     def __init__(self, info):
@@ -22,10 +181,9 @@ class DefaultNormalize(object):
                 image[ch][image[ch] < -50] = -50
         return image, targets
 
-class CustomNormalize(object):
+class CustomNormalizeLoop(object):
     '''
-    Normalization that retains invalid pixel values and incorporates bathymetry.
-    Also makes values close to [-1, 1].
+    Original per-channel implementation of CustomNormalize, kept for benchmarks.
     '''
 
     def __init__(self, info):
@@ -50,10 +208,9 @@ class CustomNormalize(object):
                 image[ch] = image[ch]/5000
         return image, targets
 
-class CustomNormalize2(object):
+class CustomNormalize2Loop(object):
     '''
-    Like CustomNormalize, but doesn't separate out invalid pixels, and output
-    values are in [0, 1].
+    Original per-channel implementation of CustomNormalize2, kept for benchmarks.
     '''
 
     def __init__(self, info):
@@ -75,9 +232,9 @@ class CustomNormalize2(object):
                 image[ch, :, :] = (torch.clip(image[ch, :, :], min=-6000, max=2000)+6000)/8000
         return image, targets
 
-class CustomNormalize3(object):
+class CustomNormalize3Loop(object):
     '''
-    Like CustomNormalize2, but use sigmoid for bathymetry.
+    Original per-channel implementation of CustomNormalize3, kept for benchmarks.
     '''
 
     def __init__(self, info):
@@ -0,0 +1,91 @@
+import json
+import numpy as np
+import os.path
+
+class ChipIndex(object):
+    '''
+    Maps chip offsets from a scene's coords.json to chip indices.
+    Supports looking up a chip by its (col, row) offset, and finding the chip
+    that contains a scene pixel, both without scanning the offset list.
+    '''
+
+    def __init__(self, offsets, chip_size=800):
+        self.offsets = [(col, row) for col, row in offsets]
+        self.chip_size = chip_size
+        self.index = {}
+        for chip_index, offset in enumerate(self.offsets):
+            # Keep the first chip if an offset is repeated, like list.index.
+            self.index.setdefault(offset, chip_index)
+        # Chips produced by preprocessing are on a grid with spacing chip_size.
+        # Otherwise, find falls back to scanning the offsets.
+        self.aligned = all(col % chip_size == 0 and row % chip_size == 0 for col, row in self.offsets)
+        self.grid = None
+
+    def __contains__(self, offset):
+        return offset in self.index
+
+    # Returns the index of the chip at offset (col, row), or None.
+    def get(self, col, row):
+        return self.index.get((col, row))
+
+    # Yields the indices of chips covering scene pixel (col, row), in chip order.
+    def covering(self, col, row):
+        if self.aligned:
+            chip_index = self.index.get((col - col % self.chip_size, row - row % self.chip_size))
+            if chip_index is not None:
+                yield chip_index
+            return
+        for chip_index, (chip_col, chip_row) in enumerate(self.offsets):
+            if col >= chip_col and col < chip_col+self.chip_size and row >= chip_row and row < chip_row+self.chip_size:
+                yield chip_index
+
+    # Returns the index of the first chip covering scene pixel (col, row), or None.
+    def find(self, col, row):
+        return next(self.covering(col, row), None)
+
+    # Returns a dense array from (row // chip_size, col // chip_size) to chip index, or -1.
+    # Only valid for aligned chips.
+    def get_grid(self):
+        if self.grid is None:
+            cells = np.array(self.offsets, dtype=np.int64).reshape(-1, 2) // self.chip_size
+            self.grid_origin = cells.min(axis=0) if len(cells) > 0 else np.zeros((2,), dtype=np.int64)
+            cells -= self.grid_origin
+            shape = (cells[:, 1].max()+1, cells[:, 0].max()+1) if len(cells) > 0 else (0, 0)
+            self.grid = np.full(shape, -1, dtype=np.int64)
+            # Assign in reverse so the first chip wins for repeated offsets.
+            self.grid[cells[::-1, 1], cells[::-1, 0]] = np.arange(len(cells))[::-1]
+        return self.grid
+
+    # Vectorized find: returns an int64 array with the index of the first chip
+    # covering each scene pixel (cols[i], rows[i]), or -1 where no chip does.
+    def find_all(self, cols, rows):
+        cols = np.asarray(cols, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        if not self.aligned:
+            return np.array([
+                -1 if chip_index is None else chip_index
+                for chip_index in (self.find(col, row) for col, row in zip(cols.tolist(), rows.tolist()))
+            ], dtype=np.int64)
+        grid = self.get_grid()
+        cell_cols = cols // self.chip_size - self.grid_origin[0]
+        cell_rows = rows // self.chip_size - self.grid_origin[1]
+        inside = (cell_cols >= 0) & (cell_cols < grid.shape[1]) & (cell_rows >= 0) & (cell_rows < grid.shape[0])
+        chip_indices = np.full(cols.shape, -1, dtype=np.int64)
+        chip_indices[inside] = grid[cell_rows[inside], cell_cols[inside]]
+        return chip_indices
+
+# Groups positions by chip index, skipping -1.
+# Yields (chip_index, positions) pairs in increasing chip order.
+def group_by_chip(chip_indices):
+    order = np.argsort(chip_indices, kind='stable')
+    sorted_indices = chip_indices[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_indices[1:] != sorted_indices[:-1]])) if len(order) > 0 else []
+    ends = list(starts[1:]) + [len(order)]
+    for start, end in zip(starts, ends):
+        if sorted_indices[start] < 0:
+            continue
+        yield int(sorted_indices[start]), order[start:end]
+
+def load_chip_index(scene_path, chip_size=800):
+    with open(os.path.join(scene_path, 'coords.json'), 'r') as f:
+        return ChipIndex(json.load(f)['offsets'], chip_size=chip_size)
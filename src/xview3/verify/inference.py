@@ -16,6 +16,11 @@ from tqdm import tqdm
 
 sys.path.insert(1, '/home/xview3/src') # use an appropriate path if not in the docker volume
 
+from xview3.infer.decode import decode_detections, get_keep_bounds
+from xview3.infer.detections import DetectionBuffer, DETECTION_SCHEMA, ATTRIBUTE_SCHEMA, get_attribute_updates
+from xview3.infer.prefetch import ScenePrefetcher, format_stage_times
+from xview3.infer.scene_reader import iter_crops
+from xview3.infer.window_plan import WindowPlanner
 from xview3.processing.constants import FISHING, NONFISHING, PIX_TO_M
 from xview3.eval.prune import nms, confidence_pruning
 from xview3.postprocess.v2.model_simple import Model
@@ -25,202 +30,115 @@ import xview3.transforms
 import xview3.eval.ensemble
 
 
-# Map from channel names to filenames.
-channel_map = {
-    'vv': 'VV_dB.tif',
-    'vh': 'VH_dB.tif',
-    'bathymetry': 'bathymetry.tif',
-    'wind_speed': 'owiWindSpeed.tif',
-    'wind_quality': 'owiWindQuality.tif',
-    'wind_direction': 'owiWindDirection.tif',
-}
-
-
 def center(coord):
     return (coord[0] + (coord[2] / 2), coord[1] + (coord[3] / 2))
 
 
-class SceneDataset(object):
-    def __init__(self, image_folder, scene_ids, channels):
-        self.image_folder = image_folder
-        self.scene_ids = scene_ids
-        self.channels = channels
-
-    def __len__(self):
-        return len(self.scene_ids)
-
-    def __getitem__(self, idx):
-        scene_id = self.scene_ids[idx]
-
-        # Load scene channels.
-        # We always load bathymetry so we can eliminate detections on land.
-        def get_channel(channel, shape=None):
-            path = os.path.join(self.image_folder, scene_id, channel_map[channel])
-            print(scene_id, 'read', path)
-            cur = skimage.io.imread(path)
-            cur = torch.tensor(cur, dtype=torch.float32)
-
-            # If not same size as first channel, resample before chipping
-            # to ensure chips from different channels are co-registered
-            if shape is not None and cur.shape != shape:
-                cur = torchvision.transforms.functional.resize(img=cur.unsqueeze(0), size=shape)[0, :, :]
+def run_members(args, clip_boxes, bbox_size, device, models, member_infos, detector_transforms, planner, scene_id, im, stage_times):
+    """
+    Run every model with every test-time augmentation member over the scene.
+
+    Members with the same window offsets share one sliding-window pass: each
+    window is read and transformed once, and its flipped variants for those
+    members go through each model as one batch.
+
+    Args:
+        models (list): detectors, one per weight file
+        member_infos (list): (row_offset, col_offset, fliplr, flipud) of each member
+
+    Returns:
+        list of detection dataframes, for each model and then each member
+    """
+    buffers = [[DetectionBuffer(DETECTION_SCHEMA) for _ in member_infos] for _ in models]
+
+    # Group members by window offsets, in order of their first member.
+    groups = {}
+    for member_idx, (args_row_offset, args_col_offset, _, _) in enumerate(member_infos):
+        groups.setdefault((args_row_offset, args_col_offset), []).append(member_idx)
+
+    for (args_row_offset, args_col_offset), member_indices in groups.items():
+        # Loop over windows.
+        windows, num_skipped = planner.plan(im.mask, im.shape, args_row_offset, args_col_offset)
+        print('{} [ensemble-members {}] running {} windows, skipped {} nodata/land windows'.format(scene_id, member_indices, len(windows), num_skipped))
+
+        pass_start_time = time.time()
+        for window_idx, (row_offset, col_offset) in enumerate(windows):
+            if window_idx == 0 or row_offset != windows[window_idx-1][0]:
+                print('{} [{}/{}] (elapsed={})'.format(scene_id, row_offset, im.shape[1]-args.window_size, time.time()-pass_start_time))
+            stage_start_time = time.time()
+            crop = im[:, row_offset:row_offset+args.window_size, col_offset:col_offset+args.window_size]
+            crop = torch.clone(crop)
+            crop, _ = detector_transforms(crop, None)
+            crop = crop[0:2, :, :].to(device)
+
+            variants = []
+            for member_idx in member_indices:
+                _, _, args_fliplr, args_flipud = member_infos[member_idx]
+                variant = crop
+                if args_fliplr:
+                    variant = torch.flip(variant, dims=[2])
+                if args_flipud:
+                    variant = torch.flip(variant, dims=[1])
+                variants.append(variant)
+            stage_times['crops'] += time.time() - stage_start_time
+
+            # Only keep output detections that are within bounds based
+            # on window size and padding.
+            keep_bounds = get_keep_bounds(row_offset, col_offset, im.shape, args.window_size, args.padding, args.overlap)
+
+            for model_idx, model in enumerate(models):
+                stage_start_time = time.time()
+                outputs = model(variants)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                stage_times['model'] += time.time() - stage_start_time
+
+                stage_start_time = time.time()
+                for member_idx, output in zip(member_indices, outputs):
+                    _, _, args_fliplr, args_flipud = member_infos[member_idx]
+                    buffers[model_idx][member_idx].append(decode_detections(
+                        output,
+                        crop_size=(crop.shape[1], crop.shape[2]),
+                        scene_id=scene_id,
+                        row_offset=row_offset,
+                        col_offset=col_offset,
+                        clip_boxes=clip_boxes,
+                        bbox_size=bbox_size,
+                        fliplr=args_fliplr,
+                        flipud=args_flipud,
+                        keep_bounds=keep_bounds,
+                    ))
+                stage_times['decode'] += time.time() - stage_start_time
+
+    member_outputs = []
+    for model_buffers in buffers:
+        for member_idx, predicted_points in enumerate(model_buffers):
+            member_pred = predicted_points.to_dataframe()
+            print("[ensemble-member {}] {} detections found".format(member_idx, len(member_pred)))
+            member_outputs.append(member_pred)
+    return member_outputs
+
+
+def process_scene(args, clip_boxes, bbox_size, device, models, postprocess_model, detector_transforms, postprocess_transforms, scene_id, im, stage_times=None, planner=None):
+    # Seconds spent reading and transforming crops, running the detector, decoding, and postprocessing.
+    if stage_times is None:
+        stage_times = {}
+    for stage in ['crops', 'model', 'decode', 'postprocess']:
+        stage_times.setdefault(stage, 0.0)
+    if planner is None:
+        planner = WindowPlanner(args.window_size, args.padding, overlap=args.overlap, skip_nodata=False)
 
-            return cur
-
-        im_channels = [get_channel(self.channels[0])] # nb this precludes vv/vh being first channel
-        for channel in self.channels[1:]:
-            if channel == "vv_over_vh":
-                vvovervh = get_channel("vv", shape=im_channels[0].shape) / get_channel("vh", shape=im_channels[0].shape)
-                vvovervh = np.nan_to_num(vvovervh, nan=0, posinf=0, neginf=0)
-                im_channels.append(torch.tensor(vvovervh, dtype=torch.float32))
-            else:
-                im_channels.append(get_channel(channel, shape=im_channels[0].shape))
-
-        # Stack channels.
-        im = torch.stack(im_channels, dim=0)
-
-        print(scene_id, 'done reading')
-        return scene_id, im
-
-def process_scene(args, clip_boxes, bbox_size, device, weight_files, model, postprocess_model, detector_transforms, postprocess_transforms, scene_id, im):
     with torch.no_grad():
         if im.shape[1] < args.window_size or im.shape[2] < args.window_size:
             raise Exception('image for scene {} is smaller than window size'.format(scene_id))
 
-        # Outputs for each member of the ensemble/test-time-augmentation.
-        member_outputs = []
-
         member_infos = [(0, 0, False, False)]
         #member_infos = [(0, 0, False, False), (0, 0, True, False), (757, 757, False, False), (1515, 1515, True, False)]
         #member_infos = [(0, 0, False, False), (757, 757, True, False)]
         #member_infos = [(0, 0, False, False), (0, 0, True, False), (0, 0, False, True), (0, 0, True, True)]
 
-        for weight_file in weight_files:
-            model.load_state_dict(torch.load(weight_file, map_location=device))
-            for member_idx, (args_row_offset, args_col_offset, args_fliplr, args_flipud) in enumerate(member_infos):
-                predicted_points = []
-
-                # Loop over windows.
-                row_offsets = [0] + list(range(
-                    args.window_size-2*args.padding - args_row_offset,
-                    im.shape[1]-args.window_size,
-                    args.window_size-2*args.padding,
-                )) + [im.shape[1]-args.window_size]
-                col_offsets = [0] + list(range(
-                    args.window_size-2*args.padding - args_col_offset,
-                    im.shape[2]-args.window_size,
-                    args.window_size-2*args.padding,
-                )) + [im.shape[2]-args.window_size]
-
-                member_start_time = time.time()
-                for row_offset in row_offsets:
-                    print('{} [{}/{}] (elapsed={})'.format(scene_id, row_offset, row_offsets[-1], time.time()-member_start_time))
-                    for col_offset in col_offsets:
-                        crop = im[:, row_offset:row_offset+args.window_size, col_offset:col_offset+args.window_size]
-                        crop = torch.clone(crop)
-                        crop, _ = detector_transforms(crop, None)
-                        crop = crop[0:2, :, :]
-
-                        if args_fliplr:
-                            crop = torch.flip(crop, dims=[2])
-                        if args_flipud:
-                            crop = torch.flip(crop, dims=[1])
-
-                        crop = crop.to(device)
-                        output = model([crop])[0]
-                        output = {k: v.to("cpu") for k, v in output.items()}
-
-                        # Only keep output detections that are within bounds based
-                        # on window size and padding.
-                        keep_bounds = [
-                            args.padding,
-                            args.padding,
-                            args.window_size - args.padding,
-                            args.window_size - args.padding,
-                        ]
-                        if row_offset == 0:
-                            keep_bounds[0] = 0
-                        if col_offset == 0:
-                            keep_bounds[1] = 0
-                        if row_offset >= im.shape[1] - args.window_size:
-                            keep_bounds[2] = args.window_size
-                        if col_offset >= im.shape[2] - args.window_size:
-                            keep_bounds[3] = args.window_size
-
-                        keep_bounds[0] -= args.overlap
-                        keep_bounds[1] -= args.overlap
-                        keep_bounds[2] += args.overlap
-                        keep_bounds[3] += args.overlap
-
-                        for idx, box in enumerate(output["boxes"]):
-                            # Determine the predicted point, in transformed image coordinates.
-                            if clip_boxes:
-                                # Boxes on edges of image might not be the right size.
-                                if box[0] < bbox_size:
-                                    pred_col = int(box[2] - bbox_size)
-                                elif box[2] >= crop.shape[2]-bbox_size:
-                                    pred_col = int(box[0] + bbox_size)
-                                else:
-                                    pred_col = int(np.mean([box[0], box[2]]))
-
-                                if box[1] < bbox_size:
-                                    pred_row = int(box[3] - bbox_size)
-                                elif box[3] >= crop.shape[1]-bbox_size:
-                                    pred_row = int(box[1] + bbox_size)
-                                else:
-                                    pred_row = int(np.mean([box[1], box[3]]))
-                            else:
-                                pred_row = int(np.mean([box[1], box[3]]))
-                                pred_col = int(np.mean([box[0], box[2]]))
-
-                            # Undo any transformations.
-                            if args_fliplr:
-                                pred_col = crop.shape[2] - pred_col
-                            if args_flipud:
-                                pred_row = crop.shape[1] - pred_row
-
-                            # Compare against keep_bounds, which is pre-transformation.
-                            if pred_row < keep_bounds[0] or pred_row >= keep_bounds[2]:
-                                continue
-                            if pred_col < keep_bounds[1] or pred_col >= keep_bounds[3]:
-                                continue
-
-                            label = output["labels"][idx].item()
-                            is_fishing = label == FISHING
-                            is_vessel = label in [FISHING, NONFISHING]
-                            if "lengths" in output:
-                                length = output["lengths"][idx].item()
-                            else:
-                                length = 0
-                            score = output["scores"][idx].item()
-
-                            scene_pred_row = row_offset + pred_row
-                            scene_pred_col = col_offset + pred_col
-
-                            predicted_points.append([
-                                scene_pred_row,
-                                scene_pred_col,
-                                scene_id,
-                                is_vessel,
-                                is_fishing,
-                                length,
-                                score,
-                            ])
-
-                member_pred = pd.DataFrame(
-                    data=predicted_points,
-                    columns=(
-                        "detect_scene_row",
-                        "detect_scene_column",
-                        "scene_id",
-                        "is_vessel",
-                        "is_fishing",
-                        "vessel_length_m",
-                        "score",
-                    ),
-                )
-                print("[ensemble-member {}] {} detections found".format(member_idx, len(member_pred)))
-                member_outputs.append(member_pred)
+        # Outputs for each member of the ensemble/test-time-augmentation.
+        member_outputs = run_members(args, clip_boxes, bbox_size, device, models, member_infos, detector_transforms, planner, scene_id, im, stage_times)
 
         # Merge ensemble members into one dataframe.
         pred = xview3.eval.ensemble.merge(member_outputs)
@@ -232,19 +150,23 @@ def process_scene(args, clip_boxes, bbox_size, device, weight_files, model, post
             pred = confidence_pruning(pred, threshold=args.conf)
 
         # Postprocessing Code
+        stage_start_time = time.time()
         bs = 32
         crop_size = 128
         pred = pred.reset_index(drop=True)
+        detections = DetectionBuffer.from_dataframe(pred)
+        if args.mode in ['full', 'attribute'] and len(pred) > 0:
+            for name, dtype, fill in ATTRIBUTE_SCHEMA:
+                detections.add_column(name, dtype, fill)
+        keep = np.ones((len(pred),), dtype=bool)
+        # Crops are read through a cache of scene tiles, nearby detections together.
+        scene_crops = iter_crops(im, pred['detect_scene_row'].to_numpy(), pred['detect_scene_column'].to_numpy(), crop_size)
         for x in range(0, len(pred), bs):
             batch_df = pred.iloc[x : min((x+bs), len(pred))]
 
-            crops, indices = [], []
-            for idx,b in batch_df.iterrows():
-                indices.append(idx)
-                row, col = b['detect_scene_row'], b['detect_scene_column']
-
-                crop = im[:, row-crop_size//2:row+crop_size//2, col-crop_size//2:col+crop_size//2]
-                crop = torch.clone(crop)
+            crops = []
+            for _ in range(len(batch_df)):
+                crop = torch.clone(next(scene_crops))
                 crop, _ = postprocess_transforms(crop, None)
                 crop = crop[:, 8:120, 8:120]
                 crop = torch.nn.functional.pad(crop, (8, 8, 8, 8))
@@ -252,28 +174,15 @@ def process_scene(args, clip_boxes, bbox_size, device, weight_files, model, post
 
             t = postprocess_model(torch.stack(crops, dim=0).to(device))
             t = [tt.cpu() for tt in t]
-            pred_length, pred_confidence, pred_correct, pred_source, pred_fishing, pred_vessel = t
-
-            for i in range(len(indices)):
-                index = x + i
-
-                # Prune confidence=LOW.
-                if pred_confidence[i, :].argmax() == 0 and args.mode == 'full':
-                    elim_inds.append(index)
-                    continue
-
-                pred.loc[index, 'vessel_length_m'] = pred_length[i].item()
 
-                if args.mode in ['full', 'attribute']:
-                    pred.loc[index, 'fishing_score'] = pred_fishing[i, 1].item()
-                    pred.loc[index, 'vessel_score'] = pred_vessel[i, 1].item()
-                    pred.loc[index, 'low_score'] = pred_confidence[i, 0].item()
-                    pred.loc[index, 'is_fishing'] = (pred_fishing[i, 1] > 0.5).item() & (pred_vessel[i, 1] > 0.5).item()
-                    pred.loc[index, 'is_vessel'] = (pred_vessel[i, 1] > 0.5).item()
-                    pred.loc[index, 'correct_score'] = pred_correct[i, 1].item()
+            # Prune confidence=LOW (in full mode), and update the rest.
+            rows = np.arange(x, x+len(crops))
+            low, block = get_attribute_updates(t, args.mode)
+            keep[rows[low]] = False
+            detections.update(rows[~low], block)
 
-                if args.mode == 'full':
-                    pred.loc[index, 'score'] = pred_correct[i, 1].item()
+        pred = detections.to_dataframe(keep=keep)
+        stage_times['postprocess'] += time.time() - stage_start_time
 
     if args.drop_cols:
         good_columns = [
@@ -298,11 +207,10 @@ def process_scene(args, clip_boxes, bbox_size, device, weight_files, model, post
         pred = pred.reset_index(drop=True)
         detect_ids = [None]*len(pred)
 
-        for index, label in pred.iterrows():
-            row, col = label['detect_scene_row'], label['detect_scene_column']
-
-            vh = im[0, row-crop_size//2:row+crop_size//2, col-crop_size//2:col+crop_size//2].numpy()
-            vv = im[1, row-crop_size//2:row+crop_size//2, col-crop_size//2:col+crop_size//2].numpy()
+        scene_crops = iter_crops(im, pred['detect_scene_row'].to_numpy(), pred['detect_scene_column'].to_numpy(), crop_size)
+        for index, crop in zip(range(len(pred)), scene_crops):
+            vh = crop[0].numpy()
+            vv = crop[1].numpy()
             vh = np.clip((vh+50)*255/70, 0, 255).astype('uint8')
             vv = np.clip((vv+50)*255/70, 0, 255).astype('uint8')
 
@@ -340,27 +248,46 @@ def main(args, config):
     detector_transforms = xview3.transforms.get_transforms(transform_names, transform_info)
     postprocess_transforms = xview3.transforms.get_transforms(['CustomNormalize3'], transform_info)
 
-    dataset = SceneDataset(
+    # Windows that only cover nodata (or land, if set) are not run.
+    planner = WindowPlanner(
+        window_size=args.window_size,
+        padding=args.padding,
+        overlap=args.overlap,
+        skip_nodata=not args.no_window_skip,
+        land_threshold=args.skip_land_thresh,
+        land_padding=args.skip_land_padding,
+        margin=args.skip_margin,
+    )
+    # Windows of upcoming scenes are read in background processes.
+    # Crops are still transformed in process_scene, since they are also used for postprocessing.
+    dataset = ScenePrefetcher(
         image_folder=args.image_folder,
         scene_ids=scene_ids,
         channels=channels,
+        transforms=None,
+        window_size=args.window_size,
+        padding=args.padding,
+        num_workers=args.prefetch_workers,
+        memory_budget=args.prefetch_memory*1024*1024,
+        planner=planner,
     )
 
+    # Each weight file is loaded once, into its own model that is kept for all scenes.
     model_cls = xview3.models.models[model_name]
-    model = model_cls(
-        num_classes=4,
-        num_channels=len(channels),
-        image_size=args.window_size,
-        device=device,
-        config=config["training"],
-        disable_multihead=True,
-    )
-
-    weight_files = args.weights.split(',')
-
-    model.load_state_dict(torch.load(weight_files[0], map_location=device))
-    model.to(device)
-    model.eval()
+    models = []
+    for weight_file in args.weights.split(','):
+        model = model_cls(
+            num_classes=4,
+            num_channels=len(channels),
+            image_size=args.window_size,
+            device=device,
+            config=config["training"],
+            disable_multihead=True,
+        )
+        model.load_state_dict(torch.load(weight_file, map_location=device))
+        model.to(device)
+        model.eval()
+        models.append(model)
 
     postprocess_model = Model()
     postprocess_model.load_state_dict(torch.load(args.postprocess_weights))
@@ -368,9 +295,19 @@ def main(args, config):
     postprocess_model.to(device)
 
     preds = []
+    stage_times = {}
+    start_time = time.time()
     for scene_id, im in dataset:
         print('processing scene', scene_id)
-        preds.append(process_scene(args, clip_boxes, bbox_size, device, weight_files, model, postprocess_model, detector_transforms, postprocess_transforms, scene_id, im))
+        scene_start_time = time.time()
+        scene_stage_times = {}
+        preds.append(process_scene(args, clip_boxes, bbox_size, device, models, postprocess_model, detector_transforms, postprocess_transforms, scene_id, im, stage_times=scene_stage_times, planner=planner))
+        im.close()
+        print('{}: {}'.format(scene_id, format_stage_times(scene_stage_times, time.time() - scene_start_time)))
+        for k, v in scene_stage_times.items():
+            stage_times[k] = stage_times.get(k, 0) + v
+    elapsed = time.time() - start_time
+    print('{} scenes in {:.1f} sec; stages: {}; prefetch: {}'.format(len(preds), elapsed, format_stage_times(stage_times, elapsed), dataset.report(elapsed)))
 
     pred = pd.concat(preds)
 
@@ -393,6 +330,12 @@ if __name__ == "__main__":
     parser.add_argument("--padding", type=int, help="Padding between sliding window", default=128)
     parser.add_argument("--window_size", type=int, help="Inference sliding window size", default=1024)
     parser.add_argument("--overlap", type=int, help="Overlap allowed for predictions between windows", default=0)
+    parser.add_argument("--prefetch_workers", type=int, help="Background processes reading upcoming scenes (0 to read on demand)", default=2)
+    parser.add_argument("--prefetch_memory", type=int, help="Memory budget in MB for prefetched windows", default=4096)
+    parser.add_argument("--no_window_skip", action="store_true", help="Run windows that only cover nodata")
+    parser.add_argument("--skip_margin", type=int, help="Pixels around a window's kept region that must be nodata/land to skip it", default=32)
+    parser.add_argument("--skip_land_thresh", type=int, help="Skip windows that bathymetry pruning with this threshold would clear (default off)", default=None)
+    parser.add_argument("--skip_land_padding", type=int, help="Bathymetry padding of that pruning (min over padding)", default=0)
 
     # pruning
     parser.add_argument("--nms_thresh", type=int, help="Run NMS, with this threshold", default=None)
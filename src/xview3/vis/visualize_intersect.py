@@ -8,6 +8,7 @@ import os, os.path
 import rasterio
 import skimage.io, skimage.transform
 import sys
+from xview3.processing.chip_store import load_chip
 
 in_path = sys.argv[1]
 scene_path = sys.argv[2]
@@ -85,12 +86,12 @@ for fname in os.listdir(in_path):
             dst_col_offset = max(chip_bounds[0]-file_chip_bounds[0], 0)
             dst_row_offset = max(chip_bounds[1]-file_chip_bounds[1], 0)
 
-            vh = numpy.load(os.path.join(chip_path, other_scene_id, 'vh/{}_vh.npy'.format(chip_idx)))
-            if vh.min() < -30000:
+            vh = load_chip(os.path.join(chip_path, other_scene_id), 'vh', chip_idx)
+            if vh is None or vh.min() < -30000:
                 bad = True
                 break
 
-            vh = numpy.clip((vh+50)*(255/55), 0, 255).astype('uint8')
+            vh = numpy.clip((vh.astype('float32')+50)*(255/55), 0, 255).astype('uint8')
             im[dst_row_offset:dst_row_offset+row_overlap, dst_col_offset:dst_col_offset+col_overlap] = vh[src_row_offset:src_row_offset+row_overlap, src_col_offset:src_col_offset+col_overlap]
 
         if bad:
@@ -8,6 +8,7 @@ import pandas as pd
 import random
 import skimage.io, skimage.transform
 import sys
+from xview3.processing.chip_store import load_chip
 
 
 parser = argparse.ArgumentParser(
@@ -89,7 +90,10 @@ elif args.chip:
 for i, (scene_id, chip_idx, start_row, start_col) in enumerate(vis_chips):
     # Load background.
     dir = os.path.join(args.chip_path, scene_id)
-    vh_im = numpy.load(os.path.join(dir, 'vh/{}_vh.npy'.format(chip_idx)))
+    vh_im = load_chip(dir, 'vh', chip_idx)
+    if vh_im is None:
+        continue
+    vh_im = vh_im.astype('float32')
     vh_im = numpy.clip((vh_im+50)*(255/55), 0, 255).astype('uint8')
     chip_im = numpy.stack([vh_im]*3, axis=2)
 
@@ -6,6 +6,7 @@ import os, os.path
 import random
 import skimage.io, skimage.transform
 import sys
+from xview3.processing.chip_store import load_chip
 
 json_path = sys.argv[1]
 chip_path = sys.argv[2]
@@ -119,8 +120,11 @@ random.shuffle(vis_chips)
 for i, (scene_id, chip_idx) in enumerate(vis_chips):
     # Load background.
     dir = os.path.join(chip_path, scene_id)
-    #vv_im = numpy.load(os.path.join(dir, 'vv/{}_vv.npy'.format(chip_idx)))
-    vh_im = numpy.load(os.path.join(dir, 'vh/{}_vh.npy'.format(chip_idx)))
+    #vv_im = load_chip(dir, 'vv', chip_idx).astype('float32')
+    vh_im = load_chip(dir, 'vh', chip_idx)
+    if vh_im is None:
+        continue
+    vh_im = vh_im.astype('float32')
     #vv_im = numpy.clip((vv_im+50)*(255/55), 0, 255).astype('uint8')
     vh_im = numpy.clip((vh_im+50)*(255/55), 0, 255).astype('uint8')
     chip_im = numpy.stack([vh_im, vh_im, vh_im], axis=2)